@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Batch Clustering
+Clusters many independent caller-supplied feature matrices (e.g. one per
+school) on a process pool and yields every result as soon as it is ready
+"""
+
+import base64
+import io
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from threadpoolctl import threadpool_limits
+
+from cluster_stats import cluster_overall_means, cluster_statistics
+from clustering_engine import ENGINE_MODES, fit_clusters, performance_labels
+from feature_builder import feature_columns
+from features import ACCURACY, LITERACY, MATH, standardize_features
+
+BATCH_WORKERS = min(4, os.cpu_count() or 1)
+
+# Limits on one request
+BATCH_MAX_DATASETS = 100
+BATCH_MAX_ROWS = 500000
+
+BATCH_DTYPES = ('float64', 'float32')
+
+# Arrays named "<id>__user_ids" in an .npz upload hold that dataset's user ids
+NPZ_USER_IDS_SUFFIX = '__user_ids'
+
+# Accepted column counts: the basic or the extended feature set, in that order
+BATCH_COLUMN_COUNTS = (len(feature_columns('basic')), len(feature_columns('extended')))
+
+def _check_matrix(raw_features):
+    """Reject matrices the pipeline can't cluster"""
+    if raw_features.ndim != 2 or raw_features.shape[1] not in BATCH_COLUMN_COUNTS:
+        raise ValueError(f"features must be rows of {' or '.join(map(str, BATCH_COLUMN_COUNTS))} "
+                         f"values in feature column order, got shape {raw_features.shape}")
+    if not np.isfinite(raw_features).all():
+        raise ValueError('features contain NaN or infinite values')
+    return raw_features
+
+def decode_dataset(spec, dtype='float64'):
+    """
+    (dataset_id, user_ids, raw_features) from one JSON dataset entry.
+    "features" is a list of rows, or with "encoding": "base64" a raw
+    little-endian buffer described by "dtype" and "shape".
+    """
+    dataset_id = str(spec.get('id', ''))
+    if 'features' not in spec:
+        raise ValueError('dataset has no features')
+    if spec.get('encoding') == 'base64':
+        buffer_dtype = spec.get('dtype', 'float64')
+        if buffer_dtype not in BATCH_DTYPES:
+            raise ValueError(f"Unknown dtype: {buffer_dtype}")
+        raw_features = np.frombuffer(base64.b64decode(spec['features']),
+                                     dtype=np.dtype(buffer_dtype).newbyteorder('<'))
+        raw_features = raw_features.reshape(spec['shape']).astype(buffer_dtype)
+    else:
+        raw_features = np.array(spec['features'], dtype=dtype)
+
+    user_ids = spec.get('user_ids')
+    if user_ids is not None:
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        if len(user_ids) != len(raw_features):
+            raise ValueError('user_ids and features have different lengths')
+
+    return dataset_id, user_ids, _check_matrix(raw_features)
+
+def _check_limits(datasets):
+    """Enforce BATCH_MAX_DATASETS and BATCH_MAX_ROWS on a whole request"""
+    if not datasets:
+        raise ValueError('No datasets given')
+    if len(datasets) > BATCH_MAX_DATASETS:
+        raise ValueError(f'At most {BATCH_MAX_DATASETS} datasets per request')
+    rows = sum(len(dataset[2]) for dataset in datasets if len(dataset) == 3)
+    if rows > BATCH_MAX_ROWS:
+        raise ValueError(f'At most {BATCH_MAX_ROWS} rows per request, got {rows}')
+    return datasets
+
+def decode_datasets(specs, dtype='float64'):
+    """
+    Decode the "datasets" list of a JSON request. Entries that fail to decode
+    become (dataset_id, exception) so they are reported without failing the
+    others.
+    """
+    if dtype not in BATCH_DTYPES:
+        raise ValueError(f'Unknown dtype: {dtype}')
+
+    datasets = []
+    for position, spec in enumerate(specs):
+        if not isinstance(spec, dict):
+            datasets.append((str(position), ValueError('dataset entries must be objects')))
+            continue
+        try:
+            datasets.append(decode_dataset(spec, dtype))
+        except Exception as e:
+            datasets.append((str(spec.get('id', position)), e))
+    return _check_limits(datasets)
+
+def load_npz_datasets(data):
+    """
+    Datasets from an .npz upload: every array is one dataset's feature matrix,
+    named by its id, with optional "<id>__user_ids" arrays alongside.
+    """
+    archive = np.load(io.BytesIO(data), allow_pickle=False)
+    names = [name for name in archive.files if not name.endswith(NPZ_USER_IDS_SUFFIX)]
+
+    datasets = []
+    for name in names:
+        user_ids = None
+        if name + NPZ_USER_IDS_SUFFIX in archive.files:
+            user_ids = archive[name + NPZ_USER_IDS_SUFFIX].astype(np.int64)
+        datasets.append((name, user_ids, archive[name]))
+    return _check_limits(datasets)
+
+def cluster_dataset(dataset_id, user_ids, raw_features, n_clusters, engine):
+    """Standardize, cluster and label one dataset (runs in a worker)"""
+    started = time.perf_counter()
+    _check_matrix(raw_features)
+    if user_ids is not None and len(user_ids) != len(raw_features):
+        raise ValueError('user_ids and features have different lengths')
+    n_clusters = min(n_clusters, len(raw_features))
+    if n_clusters < 2:
+        raise ValueError('need at least 2 rows to cluster')
+
+    # One BLAS/OpenMP thread per worker so parallel datasets don't oversubscribe
+    with threadpool_limits(limits=1):
+        features, _ = standardize_features(raw_features)
+        cluster_labels, model, engine_used = fit_clusters(features, n_clusters, engine)
+
+    # Label clusters by their performance ranking within this dataset
+    averages = cluster_overall_means(cluster_labels, raw_features)
+    ranked = sorted(averages.items(), key=lambda item: item[1], reverse=True)
+    labels = performance_labels(len(ranked))
+    stats = cluster_statistics(cluster_labels, raw_features, n_clusters)
+
+    clusters = []
+    for rank, (cluster, avg_score) in enumerate(ranked):
+        count = int(stats['counts'][cluster])
+        clusters.append({
+            'cluster_number': cluster,
+            'label': labels[rank],
+            'student_count': count,
+            'percentage': round(count / len(raw_features) * 100, 1),
+            'average_performance': round(avg_score, 2),
+            'literacy_average': round(float(stats['mean'][cluster, LITERACY]), 2),
+            'math_average': round(float(stats['mean'][cluster, MATH]), 2),
+            'accuracy_average': round(float(stats['mean'][cluster, ACCURACY]), 2)
+        })
+
+    result = {
+        'id': dataset_id,
+        'success': True,
+        'students': len(raw_features),
+        'n_clusters': n_clusters,
+        'engine': engine_used,
+        'inertia': round(float(model.inertia_), 4),
+        'clusters': sorted(clusters, key=lambda cluster: cluster['cluster_number']),
+        # Cluster number of every input row, in input order
+        'assignments': cluster_labels.astype(int).tolist()
+    }
+    if user_ids is not None:
+        result['user_ids'] = user_ids.astype(int).tolist()
+    result['seconds'] = round(time.perf_counter() - started, 4)
+    return result
+
+def _failure(dataset_id, error):
+    """Result line of a dataset that could not be clustered"""
+    return {'id': dataset_id, 'success': False, 'error': str(error)}
+
+def cluster_batch(datasets, n_clusters=3, engine='auto', workers=BATCH_WORKERS):
+    """
+    Cluster every dataset and yield its result dict as soon as it finishes,
+    in completion order. datasets holds (dataset_id, user_ids, raw_features)
+    tuples, or (dataset_id, exception) for entries that failed to decode;
+    a failing dataset yields a result with success False and the rest go on.
+    """
+    if engine not in ENGINE_MODES:
+        raise ValueError(f'Unknown engine: {engine}')
+
+    pending = []
+    for dataset in datasets:
+        if isinstance(dataset[1], Exception):
+            yield _failure(dataset[0], dataset[1])
+        else:
+            pending.append(dataset)
+
+    if workers <= 1 or len(pending) <= 1:
+        for dataset_id, user_ids, raw_features in pending:
+            try:
+                yield cluster_dataset(dataset_id, user_ids, raw_features, n_clusters, engine)
+            except Exception as e:
+                yield _failure(dataset_id, e)
+        return
+
+    pool = ProcessPoolExecutor(max_workers=min(workers, len(pending)))
+    try:
+        futures = {
+            pool.submit(cluster_dataset, dataset_id, user_ids, raw_features, n_clusters, engine): dataset_id
+            for dataset_id, user_ids, raw_features in pending
+        }
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as e:
+                yield _failure(futures[future], e)
+    finally:
+        # A client that disconnects mid-stream cancels the datasets not started yet
+        pool.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+End-to-End Clustering Benchmark
+Generates synthetic cohorts, runs every pipeline stage against them and
+records wall time and peak memory per stage as JSON, so runs from different
+commits can be compared
+"""
+
+import sys
+import io
+
+# Fix Windows console encoding issues
+if sys.platform == 'win32':
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
+    sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+import tracemalloc
+from contextlib import closing, redirect_stdout
+from datetime import datetime
+
+import numpy as np
+import sklearn
+
+from clustering_engine import ENGINE_MODES
+from neighbors import DEFAULT_NEIGHBORS, NeighborIndex
+from cluster_students import (assign_cluster_labels, extract_features, generate_report,
+                              perform_clustering, prepare_feature_matrix)
+from result_writer import RESULT_BATCH_SIZE, save_clustering_results
+from synthetic_data import generate_cohort, open_cohort
+
+BENCHMARK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks')
+
+# Cohort sizes (students) run by default; 100000 and 1000000 are opt-in
+DEFAULT_SIZES = (1000, 10000)
+
+# Stages timed for every cohort, in pipeline order
+BENCHMARK_STAGES = (
+    'extract_features',
+    'prepare_feature_matrix',
+    'perform_clustering',
+    'assign_cluster_labels',
+    'save_clustering_results',
+    'generate_report',
+    'build_neighbor_index',
+    'query_neighbors'
+)
+
+# Students looked up by query_neighbors in one batched call; the same students
+# are then queried one at a time for the single-request latency percentiles
+NEIGHBOR_QUERIES = 1000
+
+# A stage is flagged as a regression when it is this much slower than the baseline
+REGRESSION_TOLERANCE = 0.10
+
+# ...and at least this many seconds slower, so millisecond stages don't flag on noise
+REGRESSION_MIN_SECONDS = 0.05
+
+# The SQLite stand-in has no feature store tables, so extraction uses the full query
+BENCHMARK_FEATURE_MODE = 'full'
+
+def git_commit():
+    """Current commit hash, or None outside a git checkout"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def max_rss_mb():
+    """Peak resident set size of this process, or None where unsupported"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def cohort_path(data_dir, n_students, sessions_per_student, skew, seed):
+    return os.path.join(
+        data_dir, f'cohort_{n_students}_{sessions_per_student:g}_{skew:g}_{seed}.sqlite3'
+    )
+
+def _timed(timings, stage, quiet, func, *args):
+    """Run one stage, recording wall time and peak traced memory"""
+    tracemalloc.reset_peak()
+    started = time.perf_counter()
+    if quiet:
+        with redirect_stdout(io.StringIO()):
+            result = func(*args)
+    else:
+        result = func(*args)
+    seconds = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+
+    timings[stage] = {'seconds': seconds, 'peak_mb': peak / (1024 * 1024)}
+    return result
+
+def run_pipeline(connection, args, connect=None):
+    """
+    Run every stage once and return {stage: {seconds, peak_mb}}.
+    connect() opens the extra connections used by sharded extraction.
+    """
+    quiet = not args.verbose
+    dtype = np.dtype(args.dtype)
+    timings = {}
+
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM clustering_results")
+    connection.commit()
+    cursor.close()
+
+    tracemalloc.start()
+    try:
+        user_ids, raw_features = _timed(timings, 'extract_features', quiet, extract_features,
+                                        connection, BENCHMARK_FEATURE_MODE, args.chunk_size, dtype,
+                                        'basic', args.shards, connect)
+        features, scaler = _timed(timings, 'prepare_feature_matrix', quiet,
+                                  prepare_feature_matrix, raw_features)
+        cluster_labels, _ = _timed(timings, 'perform_clustering', quiet, perform_clustering,
+                                   features, args.clusters, args.engine, scaler, False)
+        label_mapping = _timed(timings, 'assign_cluster_labels', quiet, assign_cluster_labels,
+                               cluster_labels, raw_features)
+        _timed(timings, 'save_clustering_results', quiet, save_clustering_results, connection,
+               cluster_labels, user_ids, raw_features, label_mapping, args.batch_size)
+        _timed(timings, 'generate_report', quiet, generate_report,
+               cluster_labels, raw_features, label_mapping)
+        index = _timed(timings, 'build_neighbor_index', quiet, NeighborIndex,
+                       0, user_ids, features, cluster_labels, label_mapping)
+        rows = np.random.default_rng(args.seed).choice(len(index), min(NEIGHBOR_QUERIES, len(index)),
+                                                       replace=False)
+        _timed(timings, 'query_neighbors', quiet, index.query_rows, rows, args.neighbors)
+    finally:
+        tracemalloc.stop()
+
+    timings['neighbor_latency'] = neighbor_latency(index, rows, args.neighbors)
+    return timings
+
+def neighbor_latency(index, rows, k):
+    """p50/p95/p99 milliseconds of single-student neighbor queries"""
+    latencies = []
+    for row in rows:
+        started = time.perf_counter()
+        index.query_rows([row], k)
+        latencies.append((time.perf_counter() - started) * 1000)
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {'queries': len(latencies), 'k': k,
+            'p50_ms': round(p50, 4), 'p95_ms': round(p95, 4), 'p99_ms': round(p99, 4)}
+
+def benchmark_size(n_students, args):
+    """Generate (or reuse) one cohort and benchmark it args.repeat times"""
+    os.makedirs(args.data_dir, exist_ok=True)
+    path = cohort_path(args.data_dir, n_students, args.sessions, args.skew, args.seed)
+
+    if args.regenerate or not os.path.exists(path):
+        cohort = generate_cohort(path, n_students, args.sessions, args.skew, args.seed)
+    else:
+        connection = open_cohort(path)
+        cursor = connection.cursor()
+        cursor.execute("SELECT SUM(c), MAX(c) FROM (SELECT COUNT(*) AS c FROM game_sessions GROUP BY user_id)")
+        n_sessions, max_sessions = cursor.fetchone()
+        cursor.close()
+        connection.close()
+        cohort = {'students': n_students, 'sessions': n_sessions,
+                  'max_sessions_per_student': max_sessions, 'generate_seconds': None}
+        print(f"[OK] Reusing cohort {path}")
+
+    connection = open_cohort(path)
+    try:
+        runs = [run_pipeline(connection, args, lambda: closing(open_cohort(path)))
+                for _ in range(args.repeat)]
+    finally:
+        connection.close()
+
+    # Median over repeats damps one-off noise
+    stages = {
+        stage: {
+            'seconds': round(statistics.median(run[stage]['seconds'] for run in runs), 4),
+            'peak_mb': round(max(run[stage]['peak_mb'] for run in runs), 2)
+        }
+        for stage in BENCHMARK_STAGES
+    }
+    total = round(sum(stage['seconds'] for stage in stages.values()), 4)
+    latency = min((run['neighbor_latency'] for run in runs), key=lambda run: run['p50_ms'])
+
+    print(f"\n[OK] {n_students} students, {cohort['sessions']} sessions: {total:.3f}s total")
+    for stage, result in stages.items():
+        print(f"  {stage:<26} {result['seconds']:>9.4f}s  peak {result['peak_mb']:>8.2f} MB")
+    print(f"  single-student neighbor query (k={latency['k']}): p50 {latency['p50_ms']:.3f} ms, "
+          f"p95 {latency['p95_ms']:.3f} ms, p99 {latency['p99_ms']:.3f} ms")
+
+    return {
+        'students': n_students,
+        'sessions': int(cohort['sessions']),
+        'max_sessions_per_student': int(cohort['max_sessions_per_student']),
+        'generate_seconds': cohort['generate_seconds'],
+        'stages': stages,
+        'total_seconds': total,
+        'neighbor_latency': latency,
+        'max_rss_mb': max_rss_mb()
+    }
+
+def compare_results(current, baseline_path):
+    """Print per-stage ratios against a previous results file; returns the regression count"""
+    with open(baseline_path) as handle:
+        baseline = json.load(handle)
+
+    previous = {size['students']: size for size in baseline.get('sizes', [])}
+    regressions = 0
+
+    print("\n" + "="*60)
+    print(f"COMPARISON WITH {baseline.get('commit') or baseline_path}")
+    print("="*60)
+
+    for size in current['sizes']:
+        before = previous.get(size['students'])
+        if before is None:
+            print(f"\n{size['students']} students: no baseline")
+            continue
+
+        print(f"\n{size['students']} students:")
+        for stage in BENCHMARK_STAGES:
+            old = before['stages'].get(stage, {}).get('seconds')
+            new = size['stages'][stage]['seconds']
+            if not old:
+                print(f"  {stage:<26} {new:>9.4f}s  (no baseline)")
+                continue
+
+            ratio = new / old
+            flag = ''
+            if ratio > 1 + REGRESSION_TOLERANCE and new - old >= REGRESSION_MIN_SECONDS:
+                flag = '  [WARNING] regression'
+                regressions += 1
+            print(f"  {stage:<26} {old:>9.4f}s -> {new:>9.4f}s  x{ratio:.2f}{flag}")
+
+    return regressions
+
+def parse_args():
+    """Parse command line options"""
+    parser = argparse.ArgumentParser(description='End-to-end clustering benchmark on synthetic cohorts')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES),
+                        help='cohort sizes in students (default: %(default)s)')
+    parser.add_argument('--sessions', type=float, default=8.0,
+                        help='mean completed sessions per student (default: %(default)s)')
+    parser.add_argument('--skew', type=float, default=1.0,
+                        help='log-normal sigma of sessions per student (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=42,
+                        help='random seed for the generator (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per size; stage times are the median (default: %(default)s)')
+    parser.add_argument('--clusters', type=int, default=3,
+                        help='number of clusters (default: %(default)s)')
+    parser.add_argument('--engine', choices=ENGINE_MODES, default='auto',
+                        help='K-Means implementation (default: %(default)s)')
+    parser.add_argument('--dtype', choices=('float64', 'float32'), default='float64',
+                        help='feature matrix precision (default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=RESULT_BATCH_SIZE,
+                        help='rows per batched result write (default: %(default)s)')
+    parser.add_argument('--chunk-size', type=int, default=5000,
+                        help='rows fetched per round-trip during extraction (default: %(default)s)')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='user_id range shards extracted concurrently (default: %(default)s)')
+    parser.add_argument('--neighbors', type=int, default=DEFAULT_NEIGHBORS,
+                        help='peers per neighbor query (default: %(default)s)')
+    parser.add_argument('--data-dir', default=os.path.join(BENCHMARK_DIR, 'data'),
+                        help='where generated cohorts are cached (default: %(default)s)')
+    parser.add_argument('--regenerate', action='store_true',
+                        help='rebuild cohorts even when a cached copy exists')
+    parser.add_argument('--output',
+                        help='results file (default: benchmarks/results_<commit>.json)')
+    parser.add_argument('--compare',
+                        help='previous results file to compare against')
+    parser.add_argument('--verbose', action='store_true',
+                        help='show pipeline output for every stage')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    print("\n[AI] Clustering Benchmark")
+    print("="*60)
+
+    commit = git_commit()
+    results = {
+        'commit': commit,
+        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'sklearn': sklearn.__version__,
+        'platform': platform.platform(),
+        'settings': {
+            'sessions_per_student': args.sessions,
+            'skew': args.skew,
+            'seed': args.seed,
+            'repeat': args.repeat,
+            'clusters': args.clusters,
+            'engine': args.engine,
+            'dtype': args.dtype,
+            'batch_size': args.batch_size,
+            'chunk_size': args.chunk_size,
+            'shards': args.shards,
+            'neighbors': args.neighbors,
+            'feature_mode': BENCHMARK_FEATURE_MODE
+        },
+        'sizes': [benchmark_size(n_students, args) for n_students in args.sizes]
+    }
+
+    output = args.output or os.path.join(BENCHMARK_DIR, f"results_{commit or 'local'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as handle:
+        json.dump(results, handle, indent=2)
+    print(f"\n[OK] Results written to {output}")
+
+    if args.compare:
+        regressions = compare_results(results, args.compare)
+        if regressions:
+            print(f"\n[WARNING] {regressions} stage(s) slower than baseline by more than "
+                  f"{REGRESSION_TOLERANCE:.0%}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cluster Statistics
+Grouped per-cluster reductions over the raw feature matrix, used for cluster
+labels and the clustering report
+"""
+
+import numpy as np
+
+from features import FEATURE_COLUMNS, LITERACY, MATH
+
+# Percentiles reported for every feature, besides min / max
+REPORT_PERCENTILES = (25, 50, 75)
+
+def _grouped_sums(cluster_labels, values, n_clusters):
+    """(n_clusters, n_features) column sums per cluster in a single bincount"""
+    n_features = values.shape[1]
+    flat_index = cluster_labels[:, None] * n_features + np.arange(n_features)
+    sums = np.bincount(flat_index.ravel(), weights=values.ravel(), minlength=n_clusters * n_features)
+    return sums.reshape(n_clusters, n_features)
+
+def cluster_overall_means(cluster_labels, raw_features):
+    """
+    Mean overall performance ((literacy + math) / 2) of each cluster.
+    Returns {cluster: mean} for every non-empty cluster.
+    """
+    cluster_labels = np.asarray(cluster_labels, dtype=np.intp)
+    overall = (np.asarray(raw_features[:, LITERACY], dtype=np.float64)
+               + np.asarray(raw_features[:, MATH], dtype=np.float64)) / 2
+
+    counts = np.bincount(cluster_labels)
+    sums = np.bincount(cluster_labels, weights=overall, minlength=len(counts))
+
+    return {int(cluster): float(sums[cluster] / counts[cluster]) for cluster in np.flatnonzero(counts)}
+
+def cluster_statistics(cluster_labels, raw_features, n_clusters=None, percentiles=REPORT_PERCENTILES):
+    """
+    Count, mean, standard deviation, min, max and percentiles of every feature
+    for every cluster. Counts, means and deviations come from grouped bincount
+    sums; order statistics from one stable sort by cluster.
+    Returns a dict of arrays indexed [cluster] or [cluster, feature]; empty
+    clusters get NaN statistics.
+    """
+    cluster_labels = np.asarray(cluster_labels, dtype=np.intp)
+    values = np.asarray(raw_features, dtype=np.float64)
+    if n_clusters is None:
+        n_clusters = int(cluster_labels.max()) + 1 if len(cluster_labels) else 0
+    n_features = values.shape[1]
+
+    counts = np.bincount(cluster_labels, minlength=n_clusters)
+    divisor = np.where(counts > 0, counts, 1)[:, None]
+
+    with np.errstate(invalid='ignore'):
+        mean = np.where(counts[:, None] > 0, _grouped_sums(cluster_labels, values, n_clusters) / divisor, np.nan)
+
+        # Sum of squared deviations from the cluster mean (population std, as np.std)
+        deviations = values - mean[cluster_labels]
+        variance = _grouped_sums(cluster_labels, deviations * deviations, n_clusters) / divisor
+        std = np.where(counts[:, None] > 0, np.sqrt(variance), np.nan)
+
+    # Rows of each cluster are contiguous after a stable sort by label
+    order = np.argsort(cluster_labels, kind='stable')
+    grouped = values[order]
+    ends = np.cumsum(counts)
+    starts = ends - counts
+
+    quantiles = (0,) + tuple(percentiles) + (100,)
+    order_stats = np.full((len(quantiles), n_clusters, n_features), np.nan)
+    for cluster in np.flatnonzero(counts):
+        order_stats[:, cluster] = np.percentile(grouped[starts[cluster]:ends[cluster]], quantiles, axis=0)
+
+    return {
+        'counts': counts,
+        'mean': mean,
+        'std': std,
+        'min': order_stats[0],
+        'max': order_stats[-1],
+        'percentiles': dict(zip(percentiles, order_stats[1:-1]))
+    }
+
+def feature_summary(stats, cluster):
+    """Per-feature statistics of one cluster as a JSON-ready dict"""
+    summary = {}
+    for index, column in enumerate(FEATURE_COLUMNS):
+        feature = {
+            'mean': round(float(stats['mean'][cluster, index]), 2),
+            'std': round(float(stats['std'][cluster, index]), 2),
+            'min': round(float(stats['min'][cluster, index]), 2),
+            'max': round(float(stats['max'][cluster, index]), 2)
+        }
+        for percentile, values in stats['percentiles'].items():
+            feature[f'p{percentile}'] = round(float(values[cluster, index]), 2)
+        summary[column] = feature
+    return summary
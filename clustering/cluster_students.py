@@ -16,13 +16,30 @@ if sys.platform == 'win32':
 import mysql.connector
 from mysql.connector import Error
 import numpy as np
-from sklearn.cluster import KMeans
-from sklearn.preprocessing import StandardScaler
 from datetime import datetime
-import json
+import argparse
 import warnings
 warnings.filterwarnings('ignore')
 
+from cluster_stats import cluster_overall_means, cluster_statistics
+from clustering_engine import (ENGINE_MODES, K_MAX, K_MIN, check_parity, check_precision,
+                               fit_clusters, performance_labels, select_k, warm_start_centers)
+from feature_builder import FEATURE_SETS, feature_columns, load_game_features
+from feature_store import FEATURE_MODES, verify_feature_store
+from db_pool import ConnectionPool
+from features import (ACCURACY, EXTRACT_CHUNK_SIZE, EXTRACT_SHARDS, FEATURE_COLUMNS, LITERACY, MATH,
+                      MAX_EXTRACT_SHARDS, standardize_features, stream_feature_matrix,
+                      stream_sharded_feature_matrix)
+from metrics import PipelineMetrics
+from model_store import activate_model, load_model_state, mark_segmented, save_model_state
+from neighbors import build_neighbor_index, save_neighbor_index
+from online import apply_new_sessions, reset_online_state, session_watermark
+from projection import PROJECTION_SOLVERS, build_projection, save_projection
+from result_writer import (HISTORY_KEEP_DAYS, RESULT_BATCH_SIZE, WRITE_MODE, WRITE_MODES,
+                           compact_results, save_clustering_results)
+from segments import SEGMENT_KEYS, cluster_segments, load_segments
+from snapshot import SNAPSHOT_DIR, open_snapshot, snapshot_feature_matrix, update_snapshot
+
 # Database configuration
 DB_CONFIG = {
     'host': 'localhost',
@@ -31,6 +48,20 @@ DB_CONFIG = {
     'password': ''
 }
 
+# Feature extraction mode: 'incremental' folds only new sessions into the
+# feature store, 'rebuild' re-aggregates the store, 'full' scans game_sessions
+FEATURE_MODE = 'incremental'
+
+# Feature set: 'basic' (7 columns) or 'extended' (adds per-game-type and
+# per-difficulty aggregates from feature_builder.py)
+FEATURE_SET = 'basic'
+
+# Clustering engine: 'auto' picks MiniBatchKMeans for large cohorts
+ENGINE_MODE = 'auto'
+
+# Number of clusters, or 'auto' to pick k between K_MIN and K_MAX
+N_CLUSTERS = 3
+
 def get_db_connection():
     """Create database connection"""
     try:
@@ -42,110 +73,84 @@ def get_db_connection():
         print(f"[ERROR] Error connecting to MySQL: {e}")
         return None
 
-def extract_features(connection):
-    """Extract features for clustering from database"""
-    cursor = connection.cursor(dictionary=True)
-    
-    query = """
-        SELECT 
-            u.user_id,
-            u.full_name,
-            COALESCE(sp.literacy_progress, 0) as literacy_score,
-            COALESCE(sp.math_progress, 0) as math_score,
-            COALESCE(sp.total_score, 0) as total_score,
-            COALESCE(sp.games_played, 0) as games_played,
-            COALESCE(AVG(gs.accuracy), 0) as avg_accuracy,
-            COALESCE(AVG(gs.time_taken), 0) as avg_time,
-            COALESCE(SUM(gs.hints_used), 0) as total_hints
-        FROM users   u  
-        LEFT JOIN student_progress sp ON u.user_id = sp.user_id
-        LEFT JOIN game_sessions gs ON u.user_id = gs.user_id 
-            AND gs.completed_at IS NOT NULL
-        WHERE u.is_active = 1
-        GROUP BY u.user_id, u.full_name, sp.literacy_progress, 
-                 sp.math_progress, sp.total_score, sp.games_played
-        HAVING games_played > 0
+def extract_features(connection, mode=FEATURE_MODE, chunk_size=EXTRACT_CHUNK_SIZE,
+                     dtype=np.float64, feature_set=FEATURE_SET, shards=EXTRACT_SHARDS, connect=None):
+    """
+    Extract features for clustering from database.
+    With shards > 1 the aggregation runs as concurrent user_id range queries,
+    each on a connection from connect() (default: a pool on DB_CONFIG).
     """
+    if shards > 1:
+        pool = None
+        if connect is None:
+            pool = ConnectionPool(DB_CONFIG, size=shards)
+            connect = pool.connection
+        try:
+            user_ids, raw_features = stream_sharded_feature_matrix(connection, connect, mode, shards,
+                                                                   chunk_size, dtype)
+        finally:
+            if pool is not None:
+                pool.close_all()
+    else:
+        user_ids, raw_features = stream_feature_matrix(connection, mode, chunk_size, dtype)
     
-    cursor.execute(query)
-    students = cursor.fetchall()
-    cursor.close()
+    if feature_set == 'extended':
+        # Per-game-type and per-difficulty columns after the base features
+        game_features = load_game_features(connection, user_ids, dtype=dtype)
+        raw_features = np.hstack([raw_features, game_features])
     
-    print(f"[OK] Extracted data for {len(students)} students")
-    return students
+    sharding = f", {shards} shards" if shards > 1 else ''
+    print(f"[OK] Extracted data for {len(user_ids)} students "
+          f"({mode} features, {feature_set} set: {raw_features.shape[1]} columns{sharding})")
+    return user_ids, raw_features
 
-def prepare_feature_matrix(students):
+def prepare_feature_matrix(raw_features):
     """Prepare feature matrix for clustering"""
-    if len(students) == 0:
+    if len(raw_features) == 0:
         print("[ERROR] No students to cluster")
-        return None, None, None
+        return None, None
     
-    # Extract features
-    features = []
-    user_ids = []
-    
-    for student in students:
-        feature_vector = [
-            float(student['literacy_score']),
-            float(student['math_score']),
-            float(student['avg_accuracy']),
-            float(student['games_played']),
-            float(student['total_score']) / 100.0,  # Normalize
-            float(student['avg_time']) / 60.0,  # Convert to minutes
-            float(student['total_hints'])
-        ]
-        features.append(feature_vector)
-        user_ids.append(student['user_id'])
-    
-    feature_matrix = np.array(features)
-    
-    # Standardize features
-    scaler = StandardScaler()
-    normalized_features = scaler.fit_transform(feature_matrix)
+    # Normalize total score, convert time to minutes, then standardize
+    normalized_features, scaler = standardize_features(raw_features)
     
     print(f"[OK] Prepared feature matrix: {normalized_features.shape}")
-    return normalized_features, user_ids, students
+    return normalized_features, scaler
 
-def perform_clustering(features, n_clusters=3):
+def perform_clustering(features, n_clusters=3, engine=ENGINE_MODE, scaler=None,
+                       warm_start=True):
     """Perform K-Means clustering"""
     if features is None or len(features) < n_clusters:
         print(f"[ERROR] Not enough data for clustering (need at least {n_clusters} students)")
         return None
     
-    kmeans = KMeans(
-        n_clusters=n_clusters,
-        init='k-means++',
-        n_init=10,
-        max_iter=300,
-        random_state=42
-    )
+    # Seed centroids from the previous run when one is available
+    init_centers = None
+    if warm_start and scaler is not None:
+        init_centers = warm_start_centers(load_model_state(), scaler, n_clusters)
     
-    cluster_labels = kmeans.fit_predict(features)
+    cluster_labels, kmeans, engine_used = fit_clusters(features, n_clusters, engine, init_centers)
     
-    print(f"[OK] Clustering completed with {n_clusters} clusters")
+    start = 'warm start' if init_centers is not None else 'cold start'
+    print(f"[OK] Clustering completed with {n_clusters} clusters ({engine_used}, {start})")
     print(f"  Inertia: {kmeans.inertia_:.2f}")
+    print(f"  Iterations: {kmeans.n_iter_}")
     
     return cluster_labels, kmeans
 
-def assign_cluster_labels(cluster_labels, students):
-    """Assign human-readable labels to clusters"""
-    cluster_scores = {}
-    
-    for i, student in enumerate(students):
-        cluster = int(cluster_labels[i])
-        if cluster not in cluster_scores:
-            cluster_scores[cluster] = []
-        
-        # Calculate overall performance
-        overall = (float(student['literacy_score']) + 
-                  float(student['math_score'])) / 2
-        cluster_scores[cluster].append(overall)
+def perform_segmented_clustering(connection, user_ids, raw_features, segment_by,
+                                 n_clusters=3, engine=ENGINE_MODE):
+    """Cluster each segment of students independently, in parallel"""
+    segments = load_segments(connection, user_ids, segment_by)
+    cluster_labels, label_mapping, summary = cluster_segments(raw_features, segments,
+                                                              n_clusters, engine)
     
-    # Calculate average score for each cluster
-    cluster_avgs = {
-        cluster: np.mean(scores) 
-        for cluster, scores in cluster_scores.items()
-    }
+    print(f"[OK] Segmented clustering by {segment_by} completed")
+    return cluster_labels, label_mapping, summary
+
+def assign_cluster_labels(cluster_labels, raw_features):
+    """Assign human-readable labels to clusters"""
+    # Average overall performance per cluster
+    cluster_avgs = cluster_overall_means(cluster_labels, raw_features)
     
     # Sort clusters by average score
     sorted_clusters = sorted(cluster_avgs.items(), 
@@ -154,11 +159,11 @@ def assign_cluster_labels(cluster_labels, students):
     
     # Assign labels
     label_mapping = {}
-    labels = ['High Achievers', 'Average Performers', 'Needs Support']
+    labels = performance_labels(len(sorted_clusters))
     
     for i, (cluster, avg_score) in enumerate(sorted_clusters):
         label_mapping[cluster] = {
-            'label': labels[i] if i < len(labels) else f'Cluster {i+1}',
+            'label': labels[i],
             'avg_score': avg_score
         }
     
@@ -168,138 +173,278 @@ def assign_cluster_labels(cluster_labels, students):
     
     return label_mapping
 
-def save_clustering_results(connection, cluster_labels, user_ids, students, label_mapping):
-    """Save clustering results to database"""
-    cursor = connection.cursor()
-    
-    # Mark all previous clustering results as not current
-    cursor.execute("UPDATE clustering_results SET is_current = 0")
-    
-    # Insert new clustering results
-    insert_query = """
-        INSERT INTO clustering_results (
-            user_id, cluster_number, cluster_label, 
-            literacy_score, math_score, overall_performance,
-            features, analysis_date, is_current
-        ) VALUES (%s, %s, %s, %s, %s, %s, %s, NOW(), 1)
-    """
-    
-    for i, user_id in enumerate(user_ids):
-        student = students[i]
-        cluster = int(cluster_labels[i])
-        cluster_info = label_mapping[cluster]
-        
-        literacy_score = float(student['literacy_score'])
-        math_score = float(student['math_score'])
-        overall_performance = (literacy_score + math_score) / 2
-        
-        # Create feature JSON
-        features = {
-            'literacy_score': literacy_score,
-            'math_score': math_score,
-            'total_score': float(student['total_score']),
-            'games_played': int(student['games_played']),
-            'avg_accuracy': float(student['avg_accuracy']),
-            'avg_time': float(student['avg_time']),
-            'total_hints': int(student['total_hints'])
-        }
-        
-        cursor.execute(insert_query, (
-            user_id,
-            cluster,
-            cluster_info['label'],
-            literacy_score,
-            math_score,
-            overall_performance,
-            json.dumps(features),
-        ))
-    
-    connection.commit()
-    cursor.close()
-    
-    print(f"[OK] Saved {len(user_ids)} clustering results to database")
-
-def generate_report(cluster_labels, students, label_mapping):
+def generate_report(cluster_labels, raw_features, label_mapping):
     """Generate clustering report"""
     print("\n" + "="*60)
     print("CLUSTERING ANALYSIS REPORT")
     print("="*60)
     print(f"Analysis Date: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-    print(f"Total Students Analyzed: {len(students)}")
+    print(f"Total Students Analyzed: {len(raw_features)}")
     print(f"Number of Clusters: {len(label_mapping)}")
     print("-"*60)
     
+    # All per-cluster statistics in one grouped pass
+    stats = cluster_statistics(cluster_labels, raw_features, max(label_mapping) + 1)
+    
     for cluster_num in sorted(label_mapping.keys()):
         cluster_info = label_mapping[cluster_num]
-        count = np.sum(cluster_labels == cluster_num)
-        percentage = (count / len(students)) * 100
+        count = int(stats['counts'][cluster_num])
+        percentage = (count / len(raw_features)) * 100
         
-        print(f"\nCluster {cluster_num}: {cluster_info['label']}")
+        segment = f" [{cluster_info['segment']}]" if 'segment' in cluster_info else ''
+        print(f"\nCluster {cluster_num}: {cluster_info['label']}{segment}")
         print(f"  Students: {count} ({percentage:.1f}%)")
         print(f"  Average Performance: {cluster_info['avg_score']:.2f}%")
+        print(f"  Literacy Avg: {stats['mean'][cluster_num, LITERACY]:.2f}%")
+        print(f"  Math Avg: {stats['mean'][cluster_num, MATH]:.2f}%")
+        print(f"  Accuracy Avg: {stats['mean'][cluster_num, ACCURACY]:.2f}%")
         
-        # Get students in this cluster
-        cluster_students = [
-            students[i] for i in range(len(students)) 
-            if cluster_labels[i] == cluster_num
-        ]
-        
-        # Calculate cluster statistics
-        literacy_avg = np.mean([s['literacy_score'] for s in cluster_students])
-        math_avg = np.mean([s['math_score'] for s in cluster_students])
-        accuracy_avg = np.mean([s['avg_accuracy'] for s in cluster_students])
-        
-        print(f"  Literacy Avg: {literacy_avg:.2f}%")
-        print(f"  Math Avg: {math_avg:.2f}%")
-        print(f"  Accuracy Avg: {accuracy_avg:.2f}%")
+        print(f"  {'Feature':<16}{'Mean':>10}{'Std':>10}{'P25':>10}{'Median':>10}{'P75':>10}")
+        for index, column in enumerate(FEATURE_COLUMNS):
+            print(f"  {column:<16}"
+                  f"{stats['mean'][cluster_num, index]:>10.2f}"
+                  f"{stats['std'][cluster_num, index]:>10.2f}"
+                  f"{stats['percentiles'][25][cluster_num, index]:>10.2f}"
+                  f"{stats['percentiles'][50][cluster_num, index]:>10.2f}"
+                  f"{stats['percentiles'][75][cluster_num, index]:>10.2f}")
     
     print("\n" + "="*60)
 
+def parse_args():
+    """Parse command line options"""
+    parser = argparse.ArgumentParser(description='Student clustering pipeline')
+    parser.add_argument('--feature-mode', choices=FEATURE_MODES, default=FEATURE_MODE,
+                        help='how student features are aggregated (default: %(default)s)')
+    parser.add_argument('--feature-set', choices=FEATURE_SETS, default=FEATURE_SET,
+                        help='basic columns, or extended per-game-type features (default: %(default)s)')
+    parser.add_argument('--verify-features', action='store_true',
+                        help='check the feature store against the full query and exit')
+    parser.add_argument('--batch-size', type=int, default=RESULT_BATCH_SIZE,
+                        help='rows per batched result write (default: %(default)s)')
+    parser.add_argument('--write-mode', choices=WRITE_MODES, default=WRITE_MODE,
+                        help="'delta' only writes students whose cluster changed (default: %(default)s)")
+    parser.add_argument('--compact-results', action='store_true',
+                        help='prune old non-current result rows and exit')
+    parser.add_argument('--keep-days', type=int, default=HISTORY_KEEP_DAYS,
+                        help='with --compact-results, history rows to keep (default: %(default)s days)')
+    parser.add_argument('--no-summary', action='store_true',
+                        help='with --compact-results, delete without summarizing the pruned runs')
+    parser.add_argument('--chunk-size', type=int, default=EXTRACT_CHUNK_SIZE,
+                        help='rows fetched per round-trip during extraction (default: %(default)s)')
+    parser.add_argument('--shards', type=int, default=EXTRACT_SHARDS,
+                        choices=range(1, MAX_EXTRACT_SHARDS + 1), metavar=f'1-{MAX_EXTRACT_SHARDS}',
+                        help='user_id range shards extracted concurrently (default: %(default)s)')
+    parser.add_argument('--dtype', choices=('float64', 'float32'), default='float64',
+                        help='feature matrix precision (default: %(default)s)')
+    parser.add_argument('--check-precision', action='store_true',
+                        help='with --dtype float32, compare labels against a float64 run')
+    parser.add_argument('--engine', choices=ENGINE_MODES, default=ENGINE_MODE,
+                        help='K-Means implementation (default: %(default)s)')
+    parser.add_argument('--no-warm-start', action='store_true',
+                        help="ignore the previous run's centroids")
+    parser.add_argument('--clusters', default=str(N_CLUSTERS),
+                        help="number of clusters, or 'auto' to evaluate a range (default: %(default)s)")
+    parser.add_argument('--k-min', type=int, default=K_MIN,
+                        help='smallest k tried by --clusters auto (default: %(default)s)')
+    parser.add_argument('--k-max', type=int, default=K_MAX,
+                        help='largest k tried by --clusters auto (default: %(default)s)')
+    parser.add_argument('--check-parity', action='store_true',
+                        help='compare labels against a from-scratch full K-Means fit')
+    parser.add_argument('--projection-solver', choices=PROJECTION_SOLVERS, default='auto',
+                        help="PCA solver for the 2D plot coordinates; 'auto' uses the covariance "
+                             "solver for the basic and extended feature sets (default: %(default)s)")
+    parser.add_argument('--segment-by', choices=SEGMENT_KEYS,
+                        help='cluster each segment of students separately, in parallel')
+    parser.add_argument('--profile', action='store_true',
+                        help='write a cProfile dump of the run to models/profiles/')
+    parser.add_argument('--export-snapshot', action='store_true',
+                        help='append new sessions to the offline snapshot and exit')
+    parser.add_argument('--rebuild-snapshot', action='store_true',
+                        help='with --export-snapshot, re-export everything from scratch')
+    parser.add_argument('--from-snapshot', action='store_true',
+                        help='read features from the offline snapshot instead of the database')
+    parser.add_argument('--snapshot-dir', default=SNAPSHOT_DIR,
+                        help='snapshot location (default: %(default)s)')
+    parser.add_argument('--save-results', action='store_true',
+                        help='with --from-snapshot, still write results and the model')
+    parser.add_argument('--online', action='store_true',
+                        help='fold new sessions into the current clusters; refit only on drift')
+    return parser.parse_args()
+
 def main():
     """Main clustering pipeline"""
+    args = parse_args()
+    if args.segment_by and args.clusters == 'auto':
+        print("[ERROR] --clusters auto is not supported with --segment-by")
+        return
+    if args.from_snapshot and args.segment_by and not args.save_results:
+        print("[ERROR] --segment-by reads segments from the database; add --save-results")
+        return
+    if args.online and (args.segment_by or args.from_snapshot):
+        print("[ERROR] --online updates the global model from the database; "
+              "it can't be combined with --segment-by or --from-snapshot")
+        return
+    
+    # Snapshot runs only need the database to write results
+    offline = args.from_snapshot and not args.save_results
+    
     print("\n[AI] Student Clustering Algorithm")
     print("="*60)
     
+    # Stage timings (and an optional cProfile dump) for this run
+    run = PipelineMetrics().start_run(profile=args.profile)
+    status = 'failed'
+    
     # Connect to database
-    connection = get_db_connection()
-    if not connection:
-        return
+    connection = None
+    if not offline:
+        run.stage('connect')
+        connection = get_db_connection()
+        if not connection:
+            run.finish(status)
+            return
     
     try:
+        if args.verify_features:
+            if not verify_feature_store(connection):
+                sys.exit(1)
+            status = 'succeeded'
+            return
+        
+        if args.compact_results:
+            run.stage('compact_results')
+            compaction = compact_results(connection, args.keep_days, not args.no_summary,
+                                         args.batch_size)
+            run.rows(compaction['rows_deleted'])
+            status = 'succeeded'
+            return
+        
+        if args.export_snapshot:
+            run.stage('export_snapshot')
+            manifest = update_snapshot(connection, args.snapshot_dir, args.rebuild_snapshot)
+            run.rows(manifest['rows'])
+            status = 'succeeded'
+            return
+        
+        if args.online:
+            run.stage('online_update')
+            model = load_model_state()
+            summary = apply_new_sessions(connection, model, batch_size=args.batch_size)
+            run.rows(summary['students'])
+            if not summary['drift']['refit']:
+                status = 'succeeded'
+                return
+            
+            # Refit with the columns the drifted model was trained on
+            if len(model['feature_columns']) > len(FEATURE_COLUMNS):
+                args.feature_set = 'extended'
+            print("[OK] Running a full refit")
+        
         # Extract features
-        students = extract_features(connection)
+        run.stage('extract_features')
+        if args.from_snapshot:
+            snapshot = open_snapshot(args.snapshot_dir)
+            watermark = snapshot['manifest']['watermark']
+            user_ids, raw_features = snapshot_feature_matrix(snapshot, args.feature_set,
+                                                             np.dtype(args.dtype))
+        else:
+            # Sessions after this point are left to the next online update
+            watermark = session_watermark(connection)
+            user_ids, raw_features = extract_features(connection, args.feature_mode,
+                                                      args.chunk_size, np.dtype(args.dtype),
+                                                      args.feature_set, args.shards)
+        run.rows(len(user_ids))
         
-        if len(students) == 0:
+        if len(raw_features) == 0:
             print("[ERROR] No students with game data found")
             return
         
-        # Prepare feature matrix
-        features, user_ids, students = prepare_feature_matrix(students)
+        kmeans = None
+        if args.segment_by:
+            # Every segment is standardized, clustered and labelled on its own
+            run.stage('perform_clustering')
+            cluster_labels, label_mapping, _ = perform_segmented_clustering(
+                connection, user_ids, raw_features, args.segment_by, int(args.clusters), args.engine)
+            run.rows(len(cluster_labels))
+        else:
+            # Prepare feature matrix
+            run.stage('prepare_feature_matrix')
+            features, scaler = prepare_feature_matrix(raw_features)
         
-        if features is None:
-            return
+            if features is None:
+                return
+            run.rows(len(features))
         
-        # Determine optimal number of clusters
-        n_clusters = min(3, len(students))  # Max 3 clusters, or less if fewer students
+            # Determine optimal number of clusters
+            if args.clusters == 'auto':
+                n_clusters, _ = select_k(features, args.k_min, args.k_max)
+            else:
+                n_clusters = min(int(args.clusters), len(raw_features))  # Or less if fewer students
         
-        # Perform clustering
-        result = perform_clustering(features, n_clusters)
+            # Perform clustering
+            run.stage('perform_clustering')
+            result = perform_clustering(features, n_clusters, args.engine, scaler,
+                                        not args.no_warm_start)
         
-        if result is None:
-            return
+            if result is None:
+                return
         
-        cluster_labels, kmeans = result
+            cluster_labels, kmeans = result
+            run.rows(len(cluster_labels))
         
-        # Assign labels
-        label_mapping = assign_cluster_labels(cluster_labels, students)
+            if args.check_parity:
+                check_parity(features, cluster_labels, n_clusters)
+            if args.check_precision and args.dtype == 'float32':
+                previous = None if args.no_warm_start else load_model_state()
+                check_precision(raw_features, cluster_labels, n_clusters, args.engine, previous)
+        
+            # Assign labels
+            run.stage('assign_cluster_labels')
+            label_mapping = assign_cluster_labels(cluster_labels, raw_features)
+            run.rows(len(cluster_labels))
         
         # Save results
-        save_clustering_results(connection, cluster_labels, user_ids, 
-                              students, label_mapping)
+        if not offline:
+            run.stage('save_clustering_results')
+            write_stats = save_clustering_results(connection, cluster_labels, user_ids, 
+                                                  raw_features, label_mapping, args.batch_size,
+                                                  write_mode=args.write_mode)
+            run.rows(write_stats['rows_written'])
         
         # Generate report
-        generate_report(cluster_labels, students, label_mapping)
+        run.stage('generate_report')
+        generate_report(cluster_labels, raw_features, label_mapping)
+        run.rows(len(raw_features))
+        
+        if args.segment_by and not offline:
+            # The global model no longer matches the stored cluster numbers
+            mark_segmented(args.segment_by)
+        
+        # Keep the model for single-student assignment and the next warm start
+        if kmeans is not None and not offline:
+            # Made current only once its neighbor index and projection are
+            # saved, so a running app keeps serving the previous model meanwhile
+            version = save_model_state(kmeans, scaler, label_mapping,
+                                       feature_columns=feature_columns(args.feature_set),
+                                       activate=False)
+            model = load_model_state(version=version)
+            
+            # Peers of every student, saved with the model
+            run.stage('build_neighbor_index')
+            save_neighbor_index(build_neighbor_index(model, user_ids, features, cluster_labels))
+            run.rows(len(user_ids))
+            
+            # 2D coordinates for the dashboard scatter plot
+            run.stage('compute_projection')
+            save_projection(build_projection(model, user_ids, features, cluster_labels,
+                                             args.projection_solver))
+            run.rows(len(user_ids))
+            
+            # Switch over; online updates continue from this fit
+            activate_model(version)
+            reset_online_state(model, user_ids, features, cluster_labels, watermark)
         
+        status = 'succeeded'
         print("\n[SUCCESS] Clustering completed successfully!")
         
     except Exception as e:
@@ -308,6 +453,7 @@ def main():
         traceback.print_exc()
     
     finally:
+        run.finish(status)
         if connection and connection.is_connected():
             connection.close()
             print("[OK] Database connection closed")
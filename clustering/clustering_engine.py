@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Clustering Engine
+Chooses between full K-Means and MiniBatchKMeans, warm-starts either one
+from the previous run's centroids, and selects the number of clusters
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import adjusted_rand_score, davies_bouldin_score, silhouette_score
+from threadpoolctl import threadpool_limits
+
+from features import standardize_features
+
+ENGINE_MODES = ('auto', 'full', 'minibatch')
+
+# 'auto' switches to MiniBatchKMeans at this many students
+MINIBATCH_THRESHOLD = 50000
+MINIBATCH_SIZE = 4096
+
+# Minimum adjusted Rand index against full K-Means for the parity check
+PARITY_THRESHOLD = 0.95
+
+# Automatic k selection: candidate range, rows used to fit each candidate,
+# rows used for the silhouette estimate, and worker processes
+K_MIN = 2
+K_MAX = 8
+K_SELECTION_SAMPLE = 20000
+SILHOUETTE_SAMPLE = 2000
+K_SELECTION_WORKERS = min(4, os.cpu_count() or 1)
+
+# Label tiers from best to worst performing cluster
+LABEL_TIERS = ['High Achievers', 'Above Average', 'Average Performers', 'Below Average', 'Needs Support']
+
+def select_engine(n_rows, mode='auto'):
+    """Resolve 'auto' to a concrete engine by row count"""
+    if mode not in ENGINE_MODES:
+        raise ValueError(f"Unknown clustering engine '{mode}' (expected one of {', '.join(ENGINE_MODES)})")
+
+    if mode == 'auto':
+        return 'minibatch' if n_rows >= MINIBATCH_THRESHOLD else 'full'
+    return mode
+
+def warm_start_centers(previous, scaler, n_clusters):
+    """
+    Map the previous run's centroids into this run's standardized space.
+    Centroids are un-scaled with the old scaler statistics and re-scaled with
+    the new ones. Returns None when there is no compatible previous run.
+    """
+    if previous is None:
+        return None
+
+    centers = previous['centers']
+    if centers.shape != (n_clusters, len(scaler.mean_)):
+        return None
+
+    original = centers * previous['scaler_scale'] + previous['scaler_mean']
+    return (original - scaler.mean_) / scaler.scale_
+
+def build_model(engine, n_clusters, init_centers=None):
+    """Create an unfitted K-Means model for the given engine"""
+    if init_centers is not None:
+        init, n_init = init_centers, 1
+    else:
+        init, n_init = 'k-means++', (10 if engine == 'full' else 3)
+
+    if engine == 'minibatch':
+        return MiniBatchKMeans(
+            n_clusters=n_clusters,
+            init=init,
+            n_init=n_init,
+            batch_size=MINIBATCH_SIZE,
+            max_iter=100,
+            random_state=42
+        )
+
+    return KMeans(
+        n_clusters=n_clusters,
+        init=init,
+        n_init=n_init,
+        max_iter=300,
+        random_state=42
+    )
+
+def fit_clusters(features, n_clusters, engine='auto', init_centers=None):
+    """Fit the selected engine and return (labels, model, engine_used)"""
+    engine_used = select_engine(len(features), engine)
+
+    if init_centers is not None:
+        init_centers = np.asarray(init_centers, dtype=features.dtype)
+
+    model = build_model(engine_used, n_clusters, init_centers)
+    cluster_labels = model.fit_predict(features)
+
+    return cluster_labels, model, engine_used
+
+def check_parity(features, cluster_labels, n_clusters):
+    """
+    Compare labels against a from-scratch full K-Means fit.
+    Returns the adjusted Rand index (1.0 means the same partition).
+    """
+    reference = build_model('full', n_clusters).fit_predict(features)
+    score = float(adjusted_rand_score(reference, cluster_labels))
+
+    status = 'OK' if score >= PARITY_THRESHOLD else 'WARNING'
+    print(f"[{status}] Parity with full K-Means: ARI {score:.4f} (threshold {PARITY_THRESHOLD})")
+    return score
+
+def check_precision(raw_features, cluster_labels, n_clusters, engine='auto', previous=None):
+    """
+    Compare labels from a float32 run against the same run on a float64 copy
+    of the raw features (standardized and warm-started from previous, the
+    model the run started from, the same way). Returns the adjusted Rand index.
+    """
+    reference_features, scaler = standardize_features(raw_features.astype(np.float64), copy=False)
+    init_centers = warm_start_centers(previous, scaler, n_clusters)
+    reference, _, _ = fit_clusters(reference_features, n_clusters, engine, init_centers)
+    score = float(adjusted_rand_score(reference, cluster_labels))
+
+    status = 'OK' if score >= PARITY_THRESHOLD else 'WARNING'
+    print(f"[{status}] {raw_features.dtype} labels vs float64: ARI {score:.4f} "
+          f"(threshold {PARITY_THRESHOLD}; matrix {raw_features.nbytes / 2**20:.1f} MB "
+          f"vs {reference_features.nbytes / 2**20:.1f} MB)")
+    return score
+
+def _evaluate_k(features, k):
+    """Fit one candidate k and score it (runs in a worker process)"""
+    # One BLAS/OpenMP thread per worker so parallel candidates don't oversubscribe
+    with threadpool_limits(limits=1):
+        model = build_model(select_engine(len(features), 'auto'), k)
+        labels = model.fit_predict(features)
+
+        if len(np.unique(labels)) < 2:
+            return {'k': k, 'inertia': float(model.inertia_), 'silhouette': -1.0,
+                    'davies_bouldin': float('inf')}
+
+        sample_size = min(SILHOUETTE_SAMPLE, len(features))
+        return {
+            'k': k,
+            'inertia': float(model.inertia_),
+            'silhouette': float(silhouette_score(features, labels, sample_size=sample_size,
+                                                 random_state=42)),
+            'davies_bouldin': float(davies_bouldin_score(features, labels))
+        }
+
+def elbow_k(scores):
+    """k at the inertia elbow: the point farthest from the chord between the ends of the curve"""
+    if len(scores) < 3:
+        return scores[0]['k']
+
+    ks = np.array([score['k'] for score in scores], dtype=np.float64)
+    inertia = np.array([score['inertia'] for score in scores], dtype=np.float64)
+
+    # Normalize both axes to [0, 1] so the distance is scale-free
+    x = (ks - ks[0]) / (ks[-1] - ks[0])
+    span = inertia[0] - inertia[-1]
+    y = (inertia - inertia[-1]) / span if span > 0 else np.zeros_like(inertia)
+
+    # Chord runs from (0, 1) to (1, 0); distance is proportional to |x + y - 1|
+    return int(ks[np.argmax(np.abs(x + y - 1.0))])
+
+def select_k(features, k_min=K_MIN, k_max=K_MAX, workers=K_SELECTION_WORKERS):
+    """
+    Evaluate candidate cluster counts in parallel and pick the best one.
+    Candidates are fitted on a random sample of at most K_SELECTION_SAMPLE rows
+    and scored with a sampled silhouette, Davies-Bouldin and the inertia elbow.
+    Returns (best_k, scores).
+    """
+    k_max = min(k_max, len(features) - 1)
+    if k_max < k_min:
+        return min(k_min, len(features)), []
+
+    if len(features) > K_SELECTION_SAMPLE:
+        rng = np.random.default_rng(42)
+        sample = features[rng.choice(len(features), K_SELECTION_SAMPLE, replace=False)]
+    else:
+        sample = features
+
+    candidates = list(range(k_min, k_max + 1))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(candidates))) as pool:
+            scores = list(pool.map(_evaluate_k, [sample] * len(candidates), candidates))
+    else:
+        scores = [_evaluate_k(sample, k) for k in candidates]
+
+    # Rank-sum of silhouette (higher is better) and Davies-Bouldin (lower is better);
+    # ties go to the k closest to the elbow, then the smaller k
+    elbow = elbow_k(scores)
+    silhouette_rank = np.argsort(np.argsort([-score['silhouette'] for score in scores]))
+    db_rank = np.argsort(np.argsort([score['davies_bouldin'] for score in scores]))
+    for score, s_rank, d_rank in zip(scores, silhouette_rank, db_rank):
+        score['rank'] = int(s_rank + d_rank)
+
+    best = min(scores, key=lambda score: (score['rank'], abs(score['k'] - elbow), score['k']))
+
+    print(f"[OK] Selected k={best['k']} from {k_min}-{k_max} (elbow at k={elbow})")
+    for score in scores:
+        print(f"  k={score['k']}: silhouette {score['silhouette']:.3f}, "
+              f"Davies-Bouldin {score['davies_bouldin']:.3f}, inertia {score['inertia']:.1f}")
+
+    return best['k'], scores
+
+def performance_labels(n_clusters):
+    """Label names from best to worst cluster for any number of clusters"""
+    if n_clusters <= 3:
+        return [LABEL_TIERS[0], LABEL_TIERS[2], LABEL_TIERS[4]][:n_clusters]
+    if n_clusters == 4:
+        return [LABEL_TIERS[0], LABEL_TIERS[1], LABEL_TIERS[3], LABEL_TIERS[4]]
+    if n_clusters == 5:
+        return list(LABEL_TIERS)
+
+    middle = [f'Performance Band {i}' for i in range(2, n_clusters)]
+    return [LABEL_TIERS[0]] + middle + [LABEL_TIERS[4]]
@@ -1,17 +1,25 @@
 # app.py - Complete Flask App for PythonAnywhere
 # Upload this to /home/matts/mysite/flask_app.py
 
-from flask import Flask, request, jsonify
-import mysql.connector
-from mysql.connector import Error
-import numpy as np
-from sklearn.cluster import KMeans
-from sklearn.preprocessing import StandardScaler
+from flask import Flask, Response, request, jsonify
 from datetime import datetime
 import json
+import os
+import sys
+import threading
+import time
 import warnings
 warnings.filterwarnings('ignore')
 
+# Only standard-library based modules are imported at start-up. NumPy,
+# scikit-learn, the MySQL driver and the pipeline modules built on them are
+# imported inside the functions that use them, on the first clustering
+# request or by the warm-up thread, so worker restarts and /health stay fast.
+from feature_store import FEATURE_MODES
+from jobs import JobQueue
+from metrics import PipelineMetrics
+from result_cache import ResultCache, cache_key, dataset_fingerprint, results_marker
+
 app = Flask(__name__)
 
 # Database config - connect to your Hostinger DB
@@ -23,121 +31,290 @@ DB_CONFIG = {
     'port': 3306
 }
 
+# Connections kept open and shared by requests and background jobs;
+# the pool (and the MySQL driver) is created on first use
+DB_POOL_SIZE = 4
+DB_POOL = None
+_DB_POOL_LOCK = threading.Lock()
+
+# Feature extraction mode: 'incremental' folds only new sessions into the
+# feature store, 'rebuild' re-aggregates the store, 'full' scans game_sessions
+FEATURE_MODE = 'incremental'
+
+# Feature set: 'basic' (7 columns) or 'extended' (adds per-game-type and
+# per-difficulty aggregates from feature_builder.py)
+FEATURE_SET = 'basic'
+
+# Feature source: 'database', or 'snapshot' to read the offline snapshot
+# refreshed by POST /snapshot/refresh (results are still saved to the database)
+FEATURE_SOURCES = ('database', 'snapshot')
+
+# Clustering engine: 'auto' picks MiniBatchKMeans for large cohorts
+ENGINE_MODE = 'auto'
+
+# Number of clusters, or 'auto' to pick k between K_MIN and K_MAX
+N_CLUSTERS = 3
+
+# Seconds a "wait": true request blocks before returning the job id instead
+JOB_WAIT_TIMEOUT = 50
+
+# Per-stage timings across runs, served by /metrics
+PIPELINE_METRICS = PipelineMetrics()
+
+# Results of earlier runs, reused while the input data is unchanged
+RESULT_CACHE = ResultCache()
+
+# Fitted model served by /assign: loaded on first use, replaced after each run
+# and reloaded when current.json, re-read every MODEL_TTL seconds, names
+# another version (a run in another worker)
+MODEL_TTL = int(os.environ.get('CLUSTERING_MODEL_TTL', '30'))
+CURRENT_MODEL = None
+_MODEL_CHECKED_AT = None
+_MODEL_LOCK = threading.Lock()
+
+# Similar-students index served by /neighbors: loaded with the model it was
+# built from, replaced after each run
+NEIGHBORS = None
+_NEIGHBORS_LOCK = threading.Lock()
+
+# 2D plot coordinates served by /projection, kept like the neighbor index
+PROJECTION = None
+_PROJECTION_LOCK = threading.Lock()
+
+# Online updates and full runs both rewrite the online state
+ONLINE_LOCK = threading.Lock()
+
+# Current assignment served by the /clusters and /students read endpoints:
+# loaded on first use, rebuilt after every write from this process and
+# reloaded when older than MEMBERSHIP_TTL seconds (writes by other workers)
+MEMBERSHIP_TTL = int(os.environ.get('CLUSTERING_MEMBERSHIP_TTL', '300'))
+MEMBERSHIP = None
+_MEMBERSHIP_LOCK = threading.Lock()
+
+# Import the clustering stack in a background thread at start-up so the first
+# /cluster request doesn't pay for it; CLUSTERING_WARM_UP=0 disables it
+WARM_UP = os.environ.get('CLUSTERING_WARM_UP', '1') != '0'
+
+def get_db_pool():
+    """The shared connection pool, created on first use"""
+    global DB_POOL
+    with _DB_POOL_LOCK:
+        if DB_POOL is None:
+            from db_pool import ConnectionPool
+            DB_POOL = ConnectionPool(DB_CONFIG, size=DB_POOL_SIZE)
+        return DB_POOL
+
 def get_db_connection():
-    """Create database connection"""
+    """Check out a pooled database connection; use as a context manager"""
+    return get_db_pool().connection()
+
+def current_model(reload=False):
+    """
+    Model served by /assign, read from disk on first use, when reload is set
+    or when current.json changed since it was loaded (checked every MODEL_TTL
+    seconds). The neighbor index and projection follow its version.
+    """
+    global CURRENT_MODEL, _MODEL_CHECKED_AT
+    with _MODEL_LOCK:
+        now = time.time()
+        if not reload and _MODEL_CHECKED_AT is not None:
+            if now - _MODEL_CHECKED_AT < MODEL_TTL:
+                return CURRENT_MODEL
+            from model_store import read_current
+            current = read_current()
+            loaded = CURRENT_MODEL or {}
+            _MODEL_CHECKED_AT = now
+            if (current.get('version'), current.get('segmented')) == \
+                    (loaded.get('version'), loaded.get('segmented')):
+                return CURRENT_MODEL
+        
+        from model_store import load_model_state
+        CURRENT_MODEL = load_model_state()
+        _MODEL_CHECKED_AT = now
+        return CURRENT_MODEL
+
+def neighbor_index(index=None):
+    """
+    Neighbor index of the current model, read from disk on first use or when
+    the model changed; a freshly built index is installed by passing it in
+    """
+    global NEIGHBORS
+    with _NEIGHBORS_LOCK:
+        if index is not None:
+            NEIGHBORS = index
+            return index
+        
+        model = current_model()
+        if model is None:
+            return None
+        if NEIGHBORS is None or NEIGHBORS.model_version != model['version']:
+            from neighbors import load_neighbor_index
+            # A failed load isn't cached, and the previous index keeps serving
+            index = load_neighbor_index(model)
+            if index is None:
+                return NEIGHBORS
+            NEIGHBORS = index
+        return NEIGHBORS
+
+def current_projection(projection=None):
+    """
+    Projection of the current model, read from disk on first use or when the
+    model changed; a freshly computed projection is installed by passing it in
+    """
+    global PROJECTION
+    with _PROJECTION_LOCK:
+        if projection is not None:
+            PROJECTION = projection
+            return projection
+        
+        model = current_model()
+        if model is None:
+            return None
+        if PROJECTION is None or PROJECTION.model_version != model['version']:
+            from projection import load_projection
+            # A failed load isn't cached, and the previous projection keeps serving
+            projection = load_projection(model)
+            if projection is None:
+                return PROJECTION
+            PROJECTION = projection
+        return PROJECTION
+
+def membership_index(connection=None, reload=False):
+    """
+    The in-memory membership index, rebuilt on first use, when reload is set
+    or when older than MEMBERSHIP_TTL. The new index replaces the old one in
+    a single assignment, so readers never see a partial rebuild.
+    """
+    global MEMBERSHIP
+    index = MEMBERSHIP
+    if not reload and index is not None and time.time() - index.loaded_at < MEMBERSHIP_TTL:
+        return index
+    
+    with _MEMBERSHIP_LOCK:
+        index = MEMBERSHIP
+        if reload or index is None or time.time() - index.loaded_at >= MEMBERSHIP_TTL:
+            from membership_index import load_membership_index
+            try:
+                if connection is not None:
+                    index = load_membership_index(connection)
+                else:
+                    with get_db_connection() as pooled:
+                        index = load_membership_index(pooled)
+            except Exception as e:
+                # Keep answering from the previous index while the database is unavailable
+                if index is None or reload:
+                    raise
+                print(f"[WARNING] Membership index reload failed, serving the previous one: {e}")
+                return index
+            MEMBERSHIP = index
+        return index
+
+def warm_up():
+    """Import the clustering stack and load the current model"""
+    started = time.perf_counter()
     try:
-        connection = mysql.connector.connect(**DB_CONFIG)
-        if connection.is_connected():
-            print("[OK] Connected to MySQL database")
-        return connection
-    except Error as e:
-        print(f"[ERROR] Error connecting to MySQL: {e}")
-        return None
+        import batch_clustering, cluster_stats, clustering_engine, db_pool, feature_builder, features  # noqa: F401
+        import membership_index, model_store, neighbors, online, projection, result_writer  # noqa: F401
+        import segments, snapshot  # noqa: F401
+        current_model()
+        get_db_pool()
+    except Exception as e:
+        print(f"[WARNING] Warm-up failed: {e}")
+        return
+    print(f"[OK] Clustering stack loaded in {time.perf_counter() - started:.2f}s")
 
-def extract_features(connection):
-    """Extract features for clustering from database"""
-    cursor = connection.cursor(dictionary=True)
-    
-    query = """
-        SELECT 
-            u.user_id,
-            u.full_name,
-            COALESCE(sp.literacy_progress, 0) as literacy_score,
-            COALESCE(sp.math_progress, 0) as math_score,
-            COALESCE(sp.total_score, 0) as total_score,
-            COALESCE(sp.games_played, 0) as games_played,
-            COALESCE(AVG(gs.accuracy), 0) as avg_accuracy,
-            COALESCE(AVG(gs.time_taken), 0) as avg_time,
-            COALESCE(SUM(gs.hints_used), 0) as total_hints
-        FROM users u  
-        LEFT JOIN student_progress sp ON u.user_id = sp.user_id
-        LEFT JOIN game_sessions gs ON u.user_id = gs.user_id 
-            AND gs.completed_at IS NOT NULL
-        WHERE u.is_active = 1
-        GROUP BY u.user_id, u.full_name, sp.literacy_progress, 
-                 sp.math_progress, sp.total_score, sp.games_played
-        HAVING games_played > 0
+def extract_features(connection, mode=FEATURE_MODE, chunk_size=None,
+                     dtype='float64', feature_set=FEATURE_SET, shards=1):
     """
+    Extract features for clustering from database.
+    With shards > 1 the aggregation runs as concurrent user_id range queries,
+    each on a connection of its own pool sized to shards: the request pool
+    stays free for other requests and no shard waits for a checkout.
+    """
+    import numpy as np
+    from db_pool import ConnectionPool
+    from feature_builder import load_game_features
+    from features import EXTRACT_CHUNK_SIZE, stream_feature_matrix, stream_sharded_feature_matrix
+    
+    if shards > 1:
+        pool = ConnectionPool(DB_CONFIG, size=shards)
+        try:
+            user_ids, raw_features = stream_sharded_feature_matrix(
+                connection, pool.connection, mode, shards,
+                chunk_size or EXTRACT_CHUNK_SIZE, np.dtype(dtype))
+        finally:
+            pool.close_all()
+    else:
+        user_ids, raw_features = stream_feature_matrix(connection, mode, chunk_size or EXTRACT_CHUNK_SIZE,
+                                                       np.dtype(dtype))
     
-    cursor.execute(query)
-    students = cursor.fetchall()
-    cursor.close()
+    if feature_set == 'extended':
+        # Per-game-type and per-difficulty columns after the base features
+        game_features = load_game_features(connection, user_ids, dtype=dtype)
+        raw_features = np.hstack([raw_features, game_features])
     
-    print(f"[OK] Extracted data for {len(students)} students")
-    return students
+    sharding = f", {shards} shards" if shards > 1 else ''
+    print(f"[OK] Extracted data for {len(user_ids)} students "
+          f"({mode} features, {feature_set} set: {raw_features.shape[1]} columns{sharding})")
+    return user_ids, raw_features
 
-def prepare_feature_matrix(students):
+def prepare_feature_matrix(raw_features):
     """Prepare feature matrix for clustering"""
-    if len(students) == 0:
-        print("[ERROR] No students to cluster")
-        return None, None, None
-    
-    # Extract features
-    features = []
-    user_ids = []
-    
-    for student in students:
-        feature_vector = [
-            float(student['literacy_score']),
-            float(student['math_score']),
-            float(student['avg_accuracy']),
-            float(student['games_played']),
-            float(student['total_score']) / 100.0,  # Normalize
-            float(student['avg_time']) / 60.0,  # Convert to minutes
-            float(student['total_hints'])
-        ]
-        features.append(feature_vector)
-        user_ids.append(student['user_id'])
+    from features import standardize_features
     
-    feature_matrix = np.array(features)
+    if len(raw_features) == 0:
+        print("[ERROR] No students to cluster")
+        return None, None
     
-    # Standardize features
-    scaler = StandardScaler()
-    normalized_features = scaler.fit_transform(feature_matrix)
+    # Normalize total score, convert time to minutes, then standardize
+    normalized_features, scaler = standardize_features(raw_features)
     
     print(f"[OK] Prepared feature matrix: {normalized_features.shape}")
-    return normalized_features, user_ids, students
+    return normalized_features, scaler
 
-def perform_clustering(features, n_clusters=3):
+def perform_clustering(features, n_clusters=3, engine=ENGINE_MODE, scaler=None,
+                       warm_start=True):
     """Perform K-Means clustering"""
+    from clustering_engine import fit_clusters, warm_start_centers
+    from model_store import load_model_state
+    
     if features is None or len(features) < n_clusters:
         print(f"[ERROR] Not enough data for clustering (need at least {n_clusters} students)")
         return None
     
-    kmeans = KMeans(
-        n_clusters=n_clusters,
-        init='k-means++',
-        n_init=10,
-        max_iter=300,
-        random_state=42
-    )
+    # Seed centroids from the previous run when one is available
+    init_centers = None
+    if warm_start and scaler is not None:
+        init_centers = warm_start_centers(load_model_state(), scaler, n_clusters)
     
-    cluster_labels = kmeans.fit_predict(features)
+    cluster_labels, kmeans, engine_used = fit_clusters(features, n_clusters, engine, init_centers)
     
-    print(f"[OK] Clustering completed with {n_clusters} clusters")
+    start = 'warm start' if init_centers is not None else 'cold start'
+    print(f"[OK] Clustering completed with {n_clusters} clusters ({engine_used}, {start})")
     print(f"  Inertia: {kmeans.inertia_:.2f}")
+    print(f"  Iterations: {kmeans.n_iter_}")
     
     return cluster_labels, kmeans
 
-def assign_cluster_labels(cluster_labels, students):
+def perform_segmented_clustering(connection, user_ids, raw_features, segment_by,
+                                 n_clusters=3, engine=ENGINE_MODE):
+    """Cluster each segment of students independently, in parallel"""
+    from segments import cluster_segments, load_segments
+    
+    segments = load_segments(connection, user_ids, segment_by)
+    cluster_labels, label_mapping, summary = cluster_segments(raw_features, segments,
+                                                              n_clusters, engine)
+    
+    print(f"[OK] Segmented clustering by {segment_by} completed")
+    return cluster_labels, label_mapping, summary
+
+def assign_cluster_labels(cluster_labels, raw_features):
     """Assign human-readable labels to clusters"""
-    cluster_scores = {}
-    
-    for i, student in enumerate(students):
-        cluster = int(cluster_labels[i])
-        if cluster not in cluster_scores:
-            cluster_scores[cluster] = []
-        
-        # Calculate overall performance
-        overall = (float(student['literacy_score']) + 
-                  float(student['math_score'])) / 2
-        cluster_scores[cluster].append(overall)
-    
-    # Calculate average score for each cluster
-    cluster_avgs = {
-        cluster: np.mean(scores) 
-        for cluster, scores in cluster_scores.items()
-    }
+    from cluster_stats import cluster_overall_means
+    from clustering_engine import performance_labels
+    
+    # Average overall performance per cluster
+    cluster_avgs = cluster_overall_means(cluster_labels, raw_features)
     
     # Sort clusters by average score
     sorted_clusters = sorted(cluster_avgs.items(), 
@@ -146,11 +323,11 @@ def assign_cluster_labels(cluster_labels, students):
     
     # Assign labels
     label_mapping = {}
-    labels = ['High Achievers', 'Average Performers', 'Needs Support']
+    labels = performance_labels(len(sorted_clusters))
     
     for i, (cluster, avg_score) in enumerate(sorted_clusters):
         label_mapping[cluster] = {
-            'label': labels[i] if i < len(labels) else f'Cluster {i+1}',
+            'label': labels[i],
             'avg_score': avg_score
         }
     
@@ -160,97 +337,280 @@ def assign_cluster_labels(cluster_labels, students):
     
     return label_mapping
 
-def save_clustering_results(connection, cluster_labels, user_ids, students, label_mapping):
-    """Save clustering results to database"""
-    cursor = connection.cursor()
-    
-    # Mark all previous clustering results as not current
-    cursor.execute("UPDATE clustering_results SET is_current = 0")
-    
-    # Insert new clustering results
-    insert_query = """
-        INSERT INTO clustering_results (
-            user_id, cluster_number, cluster_label, 
-            literacy_score, math_score, overall_performance,
-            features, analysis_date, is_current
-        ) VALUES (%s, %s, %s, %s, %s, %s, %s, NOW(), 1)
-    """
-    
-    for i, user_id in enumerate(user_ids):
-        student = students[i]
-        cluster = int(cluster_labels[i])
-        cluster_info = label_mapping[cluster]
-        
-        literacy_score = float(student['literacy_score'])
-        math_score = float(student['math_score'])
-        overall_performance = (literacy_score + math_score) / 2
-        
-        # Create feature JSON
-        features = {
-            'literacy_score': literacy_score,
-            'math_score': math_score,
-            'total_score': float(student['total_score']),
-            'games_played': int(student['games_played']),
-            'avg_accuracy': float(student['avg_accuracy']),
-            'avg_time': float(student['avg_time']),
-            'total_hints': int(student['total_hints'])
-        }
-        
-        cursor.execute(insert_query, (
-            user_id,
-            cluster,
-            cluster_info['label'],
-            literacy_score,
-            math_score,
-            overall_performance,
-            json.dumps(features),
-        ))
-    
-    connection.commit()
-    cursor.close()
-    
-    print(f"[OK] Saved {len(user_ids)} clustering results to database")
-
-def generate_report(cluster_labels, students, label_mapping):
+def generate_report(cluster_labels, raw_features, label_mapping):
     """Generate clustering report"""
+    from cluster_stats import cluster_statistics, feature_summary
+    from features import ACCURACY, LITERACY, MATH
+    
     report = {
         'analysis_date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-        'total_students': len(students),
+        'total_students': len(raw_features),
         'number_of_clusters': len(label_mapping),
         'clusters': []
     }
     
+    # All per-cluster statistics in one grouped pass
+    stats = cluster_statistics(cluster_labels, raw_features, max(label_mapping) + 1)
+    
     for cluster_num in sorted(label_mapping.keys()):
         cluster_info = label_mapping[cluster_num]
-        count = np.sum(cluster_labels == cluster_num)
-        percentage = (count / len(students)) * 100
-        
-        # Get students in this cluster
-        cluster_students = [
-            students[i] for i in range(len(students)) 
-            if cluster_labels[i] == cluster_num
-        ]
-        
-        # Calculate cluster statistics
-        literacy_avg = np.mean([s['literacy_score'] for s in cluster_students])
-        math_avg = np.mean([s['math_score'] for s in cluster_students])
-        accuracy_avg = np.mean([s['avg_accuracy'] for s in cluster_students])
+        count = int(stats['counts'][cluster_num])
+        percentage = (count / len(raw_features)) * 100
         
         cluster_data = {
             'cluster_number': cluster_num,
             'label': cluster_info['label'],
-            'student_count': int(count),
+            'student_count': count,
             'percentage': round(percentage, 1),
             'average_performance': round(cluster_info['avg_score'], 2),
-            'literacy_average': round(literacy_avg, 2),
-            'math_average': round(math_avg, 2),
-            'accuracy_average': round(accuracy_avg, 2)
+            'literacy_average': round(float(stats['mean'][cluster_num, LITERACY]), 2),
+            'math_average': round(float(stats['mean'][cluster_num, MATH]), 2),
+            'accuracy_average': round(float(stats['mean'][cluster_num, ACCURACY]), 2),
+            'features': feature_summary(stats, cluster_num)
         }
+        if 'segment' in cluster_info:
+            cluster_data['segment'] = cluster_info['segment']
         
         report['clusters'].append(cluster_data)
     
     return report
 
+def clustering_params(body):
+    """Validate a /cluster request body into normalized pipeline parameters"""
+    from clustering_engine import ENGINE_MODES, K_MAX, K_MIN
+    from feature_builder import FEATURE_SETS
+    from features import EXTRACT_CHUNK_SIZE, EXTRACT_SHARDS, MAX_EXTRACT_SHARDS
+    from result_writer import RESULT_BATCH_SIZE, WRITE_MODE, WRITE_MODES
+    from segments import SEGMENT_KEYS
+    
+    feature_mode = body.get('feature_mode', FEATURE_MODE)
+    if feature_mode not in FEATURE_MODES:
+        raise ValueError(f'Unknown feature_mode: {feature_mode}')
+    feature_set = body.get('feature_set', FEATURE_SET)
+    if feature_set not in FEATURE_SETS:
+        raise ValueError(f'Unknown feature_set: {feature_set}')
+    engine = body.get('engine', ENGINE_MODE)
+    if engine not in ENGINE_MODES:
+        raise ValueError(f'Unknown engine: {engine}')
+    n_clusters = body.get('n_clusters', N_CLUSTERS)
+    if n_clusters != 'auto':
+        n_clusters = int(n_clusters)
+    source = body.get('source', 'database')
+    if source not in FEATURE_SOURCES:
+        raise ValueError(f'Unknown source: {source}')
+    write_mode = body.get('write_mode', WRITE_MODE)
+    if write_mode not in WRITE_MODES:
+        raise ValueError(f'Unknown write_mode: {write_mode}')
+    shards = int(body.get('shards', EXTRACT_SHARDS))
+    if not 1 <= shards <= MAX_EXTRACT_SHARDS:
+        raise ValueError(f'shards must be between 1 and {MAX_EXTRACT_SHARDS}')
+    segment_by = body.get('segment_by')
+    if segment_by is not None:
+        if segment_by not in SEGMENT_KEYS:
+            raise ValueError(f'Unknown segment_by: {segment_by}')
+        if n_clusters == 'auto':
+            raise ValueError('n_clusters "auto" is not supported with segment_by')
+    
+    return {
+        'source': source,
+        'feature_mode': feature_mode,
+        'feature_set': feature_set,
+        'engine': engine,
+        'n_clusters': n_clusters,
+        'k_min': int(body.get('k_min', K_MIN)),
+        'k_max': int(body.get('k_max', K_MAX)),
+        'dtype': 'float32' if body.get('dtype') == 'float32' else 'float64',
+        'batch_size': int(body.get('batch_size', RESULT_BATCH_SIZE)),
+        'write_mode': write_mode,
+        'chunk_size': int(body.get('chunk_size', EXTRACT_CHUNK_SIZE)),
+        'shards': shards,
+        'warm_start': bool(body.get('warm_start', True)),
+        'check_parity': bool(body.get('check_parity', False)),
+        'check_precision': bool(body.get('check_precision', False)),
+        'segment_by': segment_by,
+        'profile': bool(body.get('profile', False))
+    }
+
+def input_fingerprint(source):
+    """
+    Result-cache fingerprint of the clustering input for a feature source,
+    and the marker of the results currently stored
+    """
+    with get_db_connection() as connection:
+        if source == 'snapshot':
+            from snapshot import read_manifest, snapshot_fingerprint
+            manifest = read_manifest()
+            if manifest is None:
+                raise ValueError('No snapshot available, POST /snapshot/refresh first')
+            return snapshot_fingerprint(manifest), results_marker(connection)
+        
+        return dataset_fingerprint(connection), results_marker(connection)
+
+def run_clustering(params, progress=lambda stage: None):
+    """Run the clustering pipeline and return the response payload"""
+    run = PIPELINE_METRICS.start_run(progress, profile=params.get('profile', False))
+    try:
+        result = _run_pipeline(params, run)
+    except Exception:
+        run.finish('failed')
+        raise
+    
+    result['stage_metrics'] = run.finish('succeeded' if result.get('success') else 'failed')
+    result['profile'] = run.profile_path
+    return result
+
+def _run_pipeline(params, run):
+    """Pipeline stages of run_clustering(), timed by the stage recorder"""
+    from clustering_engine import check_parity, check_precision, select_k
+    from feature_builder import feature_columns
+    from model_store import activate_model, load_model_state, mark_segmented, save_model_state
+    from neighbors import build_neighbor_index, save_neighbor_index
+    from result_writer import save_clustering_results
+    from online import reset_online_state, session_watermark
+    from projection import build_projection, save_projection
+    from snapshot import open_snapshot, snapshot_feature_matrix, snapshot_fingerprint
+    
+    run.stage('connect')
+    with get_db_connection() as connection:
+        # Extract features
+        if params['source'] == 'snapshot':
+            snapshot = open_snapshot()
+            fingerprint = snapshot_fingerprint(snapshot['manifest'])
+            watermark = snapshot['manifest']['watermark']
+            run.stage('extract_features')
+            user_ids, raw_features = snapshot_feature_matrix(snapshot, params['feature_set'],
+                                                             params['dtype'])
+        else:
+            fingerprint = dataset_fingerprint(connection)
+            watermark = session_watermark(connection)
+            run.stage('extract_features')
+            user_ids, raw_features = extract_features(connection, params['feature_mode'],
+                                                      params['chunk_size'], params['dtype'],
+                                                      params['feature_set'], params['shards'])
+        run.rows(len(user_ids))
+        
+        if len(raw_features) == 0:
+            return {'success': False, 'error': 'No students with game data found'}
+        
+        kmeans, parity, precision, k_scores, segment_summary = None, None, None, None, None
+        if params['segment_by']:
+            # Every segment is standardized, clustered and labelled on its own
+            run.stage('perform_clustering')
+            cluster_labels, label_mapping, segment_summary = perform_segmented_clustering(
+                connection, user_ids, raw_features, params['segment_by'],
+                params['n_clusters'], params['engine'])
+            run.rows(len(cluster_labels))
+        else:
+            # Prepare feature matrix
+            run.stage('prepare_feature_matrix')
+            features, scaler = prepare_feature_matrix(raw_features)
+        
+            if features is None:
+                return {'success': False, 'error': 'Failed to prepare feature matrix'}
+            run.rows(len(features))
+        
+            # Determine optimal number of clusters
+            if params['n_clusters'] == 'auto':
+                n_clusters, k_scores = select_k(features, params['k_min'], params['k_max'])
+            else:
+                n_clusters = min(params['n_clusters'], len(raw_features))  # Or less if fewer students
+        
+            # Perform clustering
+            run.stage('perform_clustering')
+            result = perform_clustering(features, n_clusters, params['engine'], scaler,
+                                        params['warm_start'])
+        
+            if result is None:
+                return {'success': False, 'error': 'Clustering failed'}
+        
+            cluster_labels, kmeans = result
+            run.rows(len(cluster_labels))
+        
+            if params['check_parity']:
+                parity = check_parity(features, cluster_labels, n_clusters)
+            if params['check_precision'] and params['dtype'] == 'float32':
+                previous = load_model_state() if params['warm_start'] else None
+                precision = check_precision(raw_features, cluster_labels, n_clusters,
+                                            params['engine'], previous)
+        
+            # Assign labels
+            run.stage('assign_cluster_labels')
+            label_mapping = assign_cluster_labels(cluster_labels, raw_features)
+            run.rows(len(cluster_labels))
+        
+        # Save results
+        run.stage('save_clustering_results')
+        write_stats = save_clustering_results(connection, cluster_labels, user_ids, 
+                                              raw_features, label_mapping, params['batch_size'],
+                                              write_mode=params['write_mode'])
+        membership_index(connection, reload=True)
+        run.rows(write_stats['rows_written'])
+        
+        # Generate report
+        run.stage('generate_report')
+        report = generate_report(cluster_labels, raw_features, label_mapping)
+        run.rows(len(raw_features))
+        
+        if params['segment_by']:
+            # The global model no longer matches the stored cluster numbers
+            mark_segmented(params['segment_by'])
+            current_model(reload=True)
+        
+        # Keep the model for /assign and the next run's warm start. It only
+        # becomes current once its neighbor index and projection are on disk,
+        # so requests meanwhile keep being answered from the previous model.
+        if kmeans is not None:
+            version = save_model_state(kmeans, scaler, label_mapping,
+                                       feature_columns=feature_columns(params['feature_set']),
+                                       activate=False)
+            model = load_model_state(version=version)
+            
+            # Peers of every student for /neighbors, saved with the model
+            run.stage('build_neighbor_index')
+            index = build_neighbor_index(model, user_ids, features, cluster_labels)
+            save_neighbor_index(index)
+            run.rows(len(user_ids))
+            
+            # 2D coordinates for /projection
+            run.stage('compute_projection')
+            projection = build_projection(model, user_ids, features, cluster_labels)
+            save_projection(projection)
+            run.rows(len(user_ids))
+            
+            # Switch over; online updates continue from this fit
+            with ONLINE_LOCK:
+                activate_model(version)
+                current_model(reload=True)
+                reset_online_state(model, user_ids, features, cluster_labels, watermark)
+            neighbor_index(index)
+            current_projection(projection)
+        
+        result = {
+            'success': True,
+            'message': 'Clustering completed successfully',
+            'report': report,
+            'labels': {str(cluster): info['label'] for cluster, info in label_mapping.items()},
+            'write_stats': write_stats,
+            'parity_ari': parity,
+            'precision_ari': precision,
+            'k_selection': k_scores,
+            'segments': segment_summary
+        }
+        
+        # Later requests on the same data get this result without a rerun, as
+        # long as nothing else has rewritten the stored results since
+        RESULT_CACHE.put(cache_key(fingerprint, params, results_marker(connection)),
+                         fingerprint, params, result)
+        result['cache'] = {'hit': False, 'fingerprint': fingerprint}
+        
+        return result
+
+# Clustering runs execute on a background worker; /cluster only queues them
+JOB_QUEUE = JobQueue(run_clustering)
+
+if WARM_UP:
+    threading.Thread(target=warm_up, name='clustering-warm-up', daemon=True).start()
+
 # Flask Routes
 @app.route('/')
 def home():
@@ -258,53 +618,438 @@ def home():
 
 @app.route('/cluster', methods=['POST'])
 def cluster_students():
-    """Main clustering endpoint"""
+    """Queue a clustering run; send "wait": true to block until it finishes"""
     try:
-        connection = get_db_connection()
-        if not connection:
-            return jsonify({'success': False, 'error': 'Database connection failed'})
+        body = request.get_json(silent=True) or {}
+        params = clustering_params(body)
+        
+        # Nothing changed since a cached run: answer without queuing a job
+        if body.get('use_cache', True):
+            fingerprint, marker = input_fingerprint(params['source'])
+            cached = RESULT_CACHE.get(cache_key(fingerprint, params, marker))
+            if cached is not None:
+                return jsonify(dict(cached, message='Clustering results are up to date (cached)'))
+        
+        # Requests for the same dataset while a run is pending share its job
+        job_id, coalesced = JOB_QUEUE.submit(params)
+        
+        if body.get('wait'):
+            job = JOB_QUEUE.wait(job_id, timeout=JOB_WAIT_TIMEOUT)
+            if job['status'] in ('succeeded', 'failed'):
+                result = job['result'] or {'success': False, 'error': job['error']}
+                return jsonify(dict(result, job_id=job_id))
+        
+        return jsonify({
+            'success': True,
+            'message': 'Clustering job queued',
+            'job_id': job_id,
+            'coalesced': coalesced,
+            'status_url': f'/jobs/{job_id}'
+        }), 202
 
-        # Extract features
-        students = extract_features(connection)
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        })
+
+@app.route('/cluster/batch', methods=['POST'])
+def cluster_batch():
+    """
+    Cluster many caller-supplied datasets (e.g. one per school) concurrently.
+    Send JSON {"datasets": [{"id", "features", "user_ids"}, ...]} or an .npz
+    file (application/x-npz, options in the query string). One NDJSON line
+    is streamed per dataset as it finishes, then a summary line.
+    """
+    try:
+        from batch_clustering import cluster_batch as run_batch, decode_datasets, load_npz_datasets
+        from clustering_engine import ENGINE_MODES
         
-        if len(students) == 0:
-            return jsonify({'success': False, 'error': 'No students with game data found'})
+        if request.mimetype == 'application/x-npz':
+            options = request.args
+            datasets = load_npz_datasets(request.get_data())
+        else:
+            options = request.get_json(silent=True) or {}
+            datasets = decode_datasets(options.get('datasets') or [], options.get('dtype', 'float64'))
         
-        # Prepare feature matrix
-        features, user_ids, students = prepare_feature_matrix(students)
+        n_clusters = int(options.get('n_clusters', N_CLUSTERS))
+        engine = options.get('engine', ENGINE_MODE)
+        if engine not in ENGINE_MODES:
+            raise ValueError(f'Unknown engine: {engine}')
         
-        if features is None:
-            return jsonify({'success': False, 'error': 'Failed to prepare feature matrix'})
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        })
+    
+    def stream():
+        started = time.perf_counter()
+        succeeded = 0
+        for result in run_batch(datasets, n_clusters, engine):
+            succeeded += result['success']
+            yield json.dumps(result) + '\n'
+        yield json.dumps({
+            'done': True,
+            'datasets': len(datasets),
+            'succeeded': succeeded,
+            'seconds': round(time.perf_counter() - started, 3)
+        }) + '\n'
+    
+    return Response(stream(), mimetype='application/x-ndjson')
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Progress of a queued clustering run"""
+    job = JOB_QUEUE.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Unknown job id'}), 404
+    
+    return jsonify({'success': True, 'job': job})
+
+@app.route('/assign', methods=['POST'])
+def assign():
+    """Score one or more students against the current model without reclustering"""
+    try:
+        import numpy as np
+        from feature_builder import load_game_features
+        from features import FEATURE_COLUMNS, fetch_user_features
+        from model_store import assign_students, check_unsegmented
+        from result_writer import save_clustering_results
         
-        # Determine optimal number of clusters
-        n_clusters = min(3, len(students))  # Max 3 clusters, or less if fewer students
+        model = current_model()
+        if model is None:
+            return jsonify({'success': False, 'error': 'No clustering model available, run /cluster first'})
+        check_unsegmented(model)
         
-        # Perform clustering
-        result = perform_clustering(features, n_clusters)
+        params = request.get_json(silent=True) or {}
+        label_mapping = model['label_mapping']
         
-        if result is None:
-            return jsonify({'success': False, 'error': 'Clustering failed'})
+        if 'features' in params:
+            # Feature values sent by the caller
+            rows = params['features']
+            if isinstance(rows, dict):
+                rows = [rows]
+            user_ids = [row.get('user_id') for row in rows]
+            raw_features = np.array([[float(row[column]) for column in model['feature_columns']]
+                                     for row in rows])
+            clusters, distances = assign_students(model, raw_features)
+        else:
+            # Current features of the given students, read from their own sessions
+            requested = params.get('user_ids') or ([params['user_id']] if 'user_id' in params else [])
+            if not requested:
+                return jsonify({'success': False, 'error': 'Provide user_id, user_ids or features'})
+            
+            with get_db_connection() as connection:
+                user_ids, raw_features = fetch_user_features(connection, requested)
+                if len(model['feature_columns']) > len(FEATURE_COLUMNS):
+                    # Model trained on the extended feature set
+                    game_features = load_game_features(connection, user_ids, filter_users=True)
+                    raw_features = np.hstack([raw_features, game_features])
+                clusters, distances = assign_students(model, raw_features)
+                
+                if params.get('save') and len(user_ids) > 0:
+                    save_clustering_results(connection, clusters, user_ids, raw_features,
+                                            label_mapping, replace_all=False)
+                    membership_index(connection, reload=True)
         
-        cluster_labels, kmeans = result
+        assignments = [
+            {
+                'user_id': int(user_id) if user_id is not None else None,
+                'cluster_number': int(cluster),
+                'cluster_label': label_mapping[int(cluster)]['label'],
+                'distance': round(float(distance), 4)
+            }
+            for user_id, cluster, distance in zip(user_ids, clusters, distances)
+        ]
         
-        # Assign labels
-        label_mapping = assign_cluster_labels(cluster_labels, students)
+        return jsonify({
+            'success': True,
+            'model_version': model['version'],
+            'assignments': assignments
+        })
+
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        })
+
+@app.route('/neighbors', methods=['POST'])
+def similar_students():
+    """Closest peers of one or many students, from the index saved with the current model"""
+    try:
+        import numpy as np
+        from model_store import check_unsegmented
+        from neighbors import DEFAULT_NEIGHBORS, MAX_NEIGHBORS, MAX_QUERY_STUDENTS
+        from online import standardize_for_model
         
-        # Save results
-        save_clustering_results(connection, cluster_labels, user_ids, 
-                              students, label_mapping)
+        # The index's cluster numbers are the global run's, not the segments'
+        check_unsegmented(current_model())
+        index = neighbor_index()
+        if index is None:
+            return jsonify({'success': False, 'error': 'No neighbor index available, run /cluster first'})
         
-        # Generate report
-        report = generate_report(cluster_labels, students, label_mapping)
+        params = request.get_json(silent=True) or {}
+        k = int(params.get('k', DEFAULT_NEIGHBORS))
+        if not 1 <= k <= MAX_NEIGHBORS:
+            return jsonify({'success': False, 'error': f'k must be between 1 and {MAX_NEIGHBORS}'})
         
-        connection.close()
+        if 'features' in params:
+            # Feature values sent by the caller, e.g. a student not clustered yet
+            rows = params['features']
+            if isinstance(rows, dict):
+                rows = [rows]
+            if len(rows) > MAX_QUERY_STUDENTS:
+                return jsonify({'success': False, 'error': f'At most {MAX_QUERY_STUDENTS} students per request'})
+            model = current_model()
+            raw_features = np.array([[float(row[column]) for column in model['feature_columns']]
+                                     for row in rows])
+            distances, peers = index.query_vectors(standardize_for_model(model, raw_features), k)
+            results = [
+                {'user_id': row.get('user_id'), 'peers': index.peers(distances[i], peers[i])}
+                for i, row in enumerate(rows)
+            ]
+        else:
+            requested = params.get('user_ids') or ([params['user_id']] if 'user_id' in params else [])
+            if not requested:
+                return jsonify({'success': False, 'error': 'Provide user_id, user_ids or features'})
+            if len(requested) > MAX_QUERY_STUDENTS:
+                return jsonify({'success': False, 'error': f'At most {MAX_QUERY_STUDENTS} students per request'})
+            
+            # All found students are answered by one batched tree query
+            rows = index.rows(requested)
+            found = rows >= 0
+            distances, peers = index.query_rows(rows[found], k) if found.any() else ([], [])
+            answers = iter(zip(distances, peers))
+            results = []
+            for user_id, is_found in zip(requested, found):
+                if is_found:
+                    results.append({'user_id': int(user_id), 'peers': index.peers(*next(answers))})
+                else:
+                    results.append({'user_id': int(user_id), 'error': 'Student not in the neighbor index'})
         
         return jsonify({
             'success': True,
-            'message': 'Clustering completed successfully',
-            'report': report
+            'model_version': index.model_version,
+            'k': k,
+            'results': results
+        })
+
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        })
+
+@app.route('/online/update', methods=['POST'])
+def online_update():
+    """Fold newly completed sessions into the current clusters; queue a full run on drift"""
+    try:
+        from online import apply_new_sessions
+        
+        body = request.get_json(silent=True) or {}
+        with ONLINE_LOCK, get_db_connection() as connection:
+            summary = apply_new_sessions(connection, current_model())
+            if summary['students']:
+                membership_index(connection, reload=True)
+        
+        if summary['drift']['refit']:
+            # Refit with the feature set the drifted model was trained on
+            from features import FEATURE_COLUMNS
+            model = current_model()
+            body.setdefault('feature_set', 'extended' if len(model['feature_columns']) > len(FEATURE_COLUMNS)
+                            else 'basic')
+            job_id, coalesced = JOB_QUEUE.submit(clustering_params(body))
+            summary.update(job_id=job_id, coalesced=coalesced, status_url=f'/jobs/{job_id}')
+        
+        return jsonify(dict(summary, success=True))
+
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        })
+
+def _membership_response(index, build):
+    """
+    JSON from build() tagged with the index (or projection) ETag, or 304 Not
+    Modified when the client's If-None-Match already names the current one
+    """
+    if request.if_none_match.contains(index.etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(dict(build(), success=True))
+    response.set_etag(index.etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def _listing(cluster=None):
+    """Sorted page of students from the membership index, per the query string"""
+    from membership_index import DEFAULT_PAGE_SIZE
+    
+    order = request.args.get('order')
+    if order not in (None, 'asc', 'desc'):
+        raise ValueError(f'Unknown order: {order}')
+    sort = request.args.get('sort', 'name')
+    page = int(request.args.get('page', 1))
+    per_page = int(request.args.get('per_page', DEFAULT_PAGE_SIZE))
+    
+    index = membership_index()
+    def build():
+        listing = index.listing(cluster, sort, None if order is None else order == 'desc', page, per_page)
+        if cluster is not None:
+            listing.update(cluster_number=cluster, cluster_label=index.labels.get(cluster))
+        return listing
+    return _membership_response(index, build)
+
+@app.route('/clusters', methods=['GET'])
+def list_clusters():
+    """Size and average scores of every current cluster, from memory"""
+    try:
+        index = membership_index()
+        return _membership_response(index, lambda: {'students': len(index), 'clusters': index.summary()})
+
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        })
+
+@app.route('/clusters/<int:cluster_number>/students', methods=['GET'])
+def cluster_members(cluster_number):
+    """Students in one cluster; ?sort=, ?order=asc|desc, ?page=, ?per_page="""
+    try:
+        if cluster_number not in membership_index().members:
+            return jsonify({'success': False, 'error': 'Unknown cluster'}), 404
+        return _listing(cluster_number)
+
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        })
+
+@app.route('/students', methods=['GET'])
+def list_students():
+    """All clustered students, paginated and sorted like /clusters/<n>/students"""
+    try:
+        return _listing()
+
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        })
+
+@app.route('/students/<int:user_id>/cluster', methods=['GET'])
+def student_cluster(user_id):
+    """Current cluster of one student, from memory"""
+    try:
+        index = membership_index()
+        student = index.lookup(user_id)
+        if student is None:
+            return jsonify({'success': False, 'error': 'Student has no current cluster'}), 404
+        return _membership_response(index, lambda: {'student': student})
+
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        })
+
+@app.route('/projection', methods=['GET'])
+def cluster_projection():
+    """
+    Scatter plot data of the current model: ?mode=points&max_points= for a
+    stratified sample of students, ?mode=bins&bins= for per-cluster counts
+    on a grid. Both are precomputed, so the size doesn't grow with the cohort.
+    """
+    try:
+        from model_store import check_unsegmented
+        from projection import DEFAULT_BINS, DEFAULT_PLOT_POINTS
+        
+        check_unsegmented(current_model())
+        current = current_projection()
+        if current is None:
+            return jsonify({'success': False, 'error': 'No projection available, run /cluster first'})
+        
+        mode = request.args.get('mode', 'points')
+        if mode == 'points':
+            max_points = int(request.args.get('max_points', DEFAULT_PLOT_POINTS))
+            return _membership_response(current, lambda: current.points(max_points))
+        if mode == 'bins':
+            bins = int(request.args.get('bins', DEFAULT_BINS))
+            return _membership_response(current, lambda: current.bins(bins))
+        return jsonify({'success': False, 'error': f'Unknown mode: {mode}'})
+
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        })
+
+@app.route('/cache/invalidate', methods=['POST'])
+def invalidate_cache():
+    """Drop cached clustering results so the next /cluster call reruns"""
+    try:
+        removed = RESULT_CACHE.invalidate()
+        return jsonify({'success': True, 'removed': removed})
+
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        })
+
+@app.route('/results/compact', methods=['POST'])
+def compact_result_history():
+    """Prune non-current result rows older than "keep_days"; "summarize": false skips the summary"""
+    try:
+        from result_writer import HISTORY_KEEP_DAYS, compact_results
+        
+        body = request.get_json(silent=True) or {}
+        with get_db_connection() as connection:
+            compaction = compact_results(connection, int(body.get('keep_days', HISTORY_KEEP_DAYS)),
+                                         bool(body.get('summarize', True)))
+        
+        return jsonify({'success': True, 'compaction': compaction})
+
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
         })
 
+@app.route('/snapshot/refresh', methods=['POST'])
+def refresh_snapshot():
+    """Append new sessions to the offline snapshot; send "rebuild": true to re-export"""
+    try:
+        from snapshot import update_snapshot
+        
+        body = request.get_json(silent=True) or {}
+        with get_db_connection() as connection:
+            manifest = update_snapshot(connection, rebuild=bool(body.get('rebuild', False)))
+        
+        return jsonify({'success': True, 'snapshot': manifest})
+
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        })
+
+@app.route('/features/verify', methods=['POST'])
+def verify_features():
+    """Check the incremental feature store against the full query"""
+    try:
+        from feature_store import verify_feature_store
+        
+        with get_db_connection() as connection:
+            matches = verify_feature_store(connection)
+        
+        return jsonify({'success': True, 'identical': matches})
+
     except Exception as e:
         return jsonify({
             'success': False,
@@ -314,6 +1059,19 @@ def cluster_students():
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    return jsonify({'status': 'healthy', 'service': 'clustering'})
+    return jsonify({
+        'status': 'healthy',
+        'service': 'clustering',
+        'pipeline_loaded': 'clustering_engine' in sys.modules,
+        'db_pool': DB_POOL.stats() if DB_POOL is not None else None
+    })
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Stage timings, run counts and pool stats in Prometheus text format"""
+    pool_stats = DB_POOL.stats() if DB_POOL is not None else {}
+    pool_gauges = {f'db_pool_{name}': value for name, value in pool_stats.items()}
+    return Response(PIPELINE_METRICS.render(pool_gauges),
+                    mimetype='text/plain; version=0.0.4')
 
 # DON'T include app.run() - PythonAnywhere handles this
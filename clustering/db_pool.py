@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+MySQL Connection Pool
+Reuses database connections across Flask requests and background jobs,
+with health checks, retry with backoff and checkout metrics
+"""
+
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+import mysql.connector
+from mysql.connector import Error
+
+# MySQL client/server error numbers worth retrying
+TRANSIENT_ERRNOS = {
+    1040,  # ER_CON_COUNT_ERROR: too many connections
+    1205,  # ER_LOCK_WAIT_TIMEOUT
+    1213,  # ER_LOCK_DEADLOCK
+    2003,  # CR_CONN_HOST_ERROR: can't connect
+    2006,  # CR_SERVER_GONE_ERROR
+    2013,  # CR_SERVER_LOST
+    2055,  # CR_SERVER_LOST_EXTENDED
+}
+
+POOL_SIZE = 4
+CHECKOUT_TIMEOUT = 30
+CONNECT_RETRIES = 3
+RETRY_BACKOFF = 0.5
+
+# Idle connections are pinged before reuse after this many seconds
+PING_AFTER_IDLE = 30
+
+class PoolTimeout(Error):
+    """No connection became available within the checkout timeout"""
+
+def is_transient(error):
+    """True for errors that a retry on a fresh connection can fix"""
+    return isinstance(error, Error) and error.errno in TRANSIENT_ERRNOS
+
+class ConnectionPool:
+    """Fixed-size pool of MySQL connections, created lazily"""
+
+    def __init__(self, config, size=POOL_SIZE, checkout_timeout=CHECKOUT_TIMEOUT,
+                 retries=CONNECT_RETRIES, backoff=RETRY_BACKOFF):
+        self.config = dict(config)
+        self.size = size
+        self.checkout_timeout = checkout_timeout
+        self.retries = retries
+        self.backoff = backoff
+
+        # (connection, returned_at) pairs; LIFO keeps recently used connections warm
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._open = 0
+        self._stats = {
+            'created_total': 0,
+            'discarded_total': 0,
+            'checkouts_total': 0,
+            'waits_total': 0,
+            'wait_seconds_total': 0.0,
+            'timeouts_total': 0,
+            'retries_total': 0,
+            'errors_total': 0
+        }
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def _connect(self):
+        """Open a new connection, retrying transient failures with exponential backoff"""
+        for attempt in range(self.retries + 1):
+            try:
+                connection = mysql.connector.connect(**self.config)
+                self._count('created_total')
+                return connection
+            except Error as e:
+                self._count('errors_total')
+                if attempt >= self.retries or not is_transient(e):
+                    raise
+                self._count('retries_total')
+                delay = self.backoff * (2 ** attempt)
+                print(f"[ERROR] Connection attempt {attempt + 1} failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+    def _discard(self, connection):
+        with self._lock:
+            self._open -= 1
+            self._stats['discarded_total'] += 1
+        try:
+            connection.close()
+        except Error:
+            pass
+
+    def _healthy(self, connection, idle_since):
+        """
+        Check a reused connection; ping only when it sat idle long enough to
+        be dropped. A recently returned connection is trusted as is, since
+        release() already ran a statement on it; if the server dropped it in
+        the meantime the caller's query fails like any other lost connection.
+        """
+        if time.monotonic() - idle_since < PING_AFTER_IDLE:
+            return True
+        try:
+            connection.ping(reconnect=False)
+            return True
+        except Error:
+            return False
+
+    def acquire(self):
+        """Check out a healthy connection, waiting up to checkout_timeout when all are in use"""
+        deadline = time.monotonic() + self.checkout_timeout
+
+        while True:
+            try:
+                connection, idle_since = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    can_create = self._open < self.size
+                    if can_create:
+                        self._open += 1
+
+                if can_create:
+                    try:
+                        connection = self._connect()
+                    except Error:
+                        with self._lock:
+                            self._open -= 1
+                        raise
+                    self._count('checkouts_total')
+                    return connection
+
+                # Pool exhausted: wait for a connection to come back
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._count('timeouts_total')
+                    raise PoolTimeout(msg=f"No database connection available after {self.checkout_timeout}s")
+
+                self._count('waits_total')
+                started = time.monotonic()
+                try:
+                    connection, idle_since = self._idle.get(timeout=remaining)
+                except queue.Empty:
+                    continue
+                finally:
+                    self._count('wait_seconds_total', time.monotonic() - started)
+
+            if self._healthy(connection, idle_since):
+                self._count('checkouts_total')
+                return connection
+
+            # Dropped by the server while idle: replace it
+            self._discard(connection)
+
+    def release(self, connection):
+        """
+        Return a connection, ending any open transaction so the next user
+        starts clean. The rollback doubles as the health check: a connection
+        it fails on is discarded.
+        """
+        try:
+            connection.rollback()
+        except Error:
+            self._discard(connection)
+            return
+        self._idle.put((connection, time.monotonic()))
+
+    @contextmanager
+    def connection(self):
+        """Context-managed checkout: the connection is always returned, even on errors"""
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def stats(self):
+        """Pool metrics for /health"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = self.size
+            stats['open'] = self._open
+        stats['idle'] = self._idle.qsize()
+        stats['in_use'] = stats['open'] - stats['idle']
+        stats['wait_seconds_total'] = round(stats['wait_seconds_total'], 3)
+        return stats
+
+    def close_all(self):
+        """Close every idle connection"""
+        while True:
+            try:
+                connection, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(connection)
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-Game Feature Builder
+Declarative per-game-type and per-difficulty features, computed with one
+grouped query over game_sessions and pivoted into a matrix with NumPy
+"""
+
+import math
+
+import numpy as np
+
+from features import FEATURE_COLUMNS
+
+# Feature sets understood by extract_features(): 'basic' is FEATURE_COLUMNS,
+# 'extended' appends the FEATURE_SPECS columns
+FEATURE_SETS = ('basic', 'extended')
+
+# Dimensions of the grouped query, in ENUM order
+GAME_TYPES = ('word_scramble', 'reading_comprehension', 'number_puzzle', 'math_challenge')
+DIFFICULTY_LEVELS = ('easy', 'medium', 'hard')
+DIMENSIONS = {'game_type': GAME_TYPES, 'difficulty_level': DIFFICULTY_LEVELS}
+
+# Per-session values that features aggregate ('sessions' counts sessions)
+SESSION_MEASURES = {
+    'sessions': '1',
+    'accuracy': 'gs.accuracy',
+    'time_taken': 'gs.time_taken',
+    'hints_used': 'gs.hints_used',
+    'streak_count': 'gs.streak_count',
+    'score': 'gs.score'
+}
+
+# Supported aggregations. 'recent_mean' weights each session by
+# 2 ** (-age / RECENCY_HALF_LIFE_DAYS).
+AGGREGATIONS = ('sum', 'mean', 'max', 'recent_mean')
+RECENCY_HALF_LIFE_DAYS = 30
+
+# One column per value of the 'by' dimensions, named <value>_<name>.
+# 'fill' is used for students without sessions in that group (default 0).
+FEATURE_SPECS = (
+    {'name': 'sessions', 'measure': 'sessions', 'agg': 'sum', 'by': ('game_type',)},
+    {'name': 'accuracy', 'measure': 'accuracy', 'agg': 'mean', 'by': ('game_type',)},
+    {'name': 'recent_accuracy', 'measure': 'accuracy', 'agg': 'recent_mean', 'by': ('game_type',)},
+    {'name': 'time', 'measure': 'time_taken', 'agg': 'mean', 'by': ('game_type',)},
+    {'name': 'hints', 'measure': 'hints_used', 'agg': 'mean', 'by': ('game_type',)},
+    {'name': 'best_streak', 'measure': 'streak_count', 'agg': 'max', 'by': ('game_type',)},
+    {'name': 'recent_score', 'measure': 'score', 'agg': 'recent_mean', 'by': ('game_type',)},
+    {'name': 'accuracy', 'measure': 'accuracy', 'agg': 'mean', 'by': ('difficulty_level',)},
+    {'name': 'time', 'measure': 'time_taken', 'agg': 'mean', 'by': ('difficulty_level',)}
+)
+
+# Partial aggregates each aggregation needs per (user, game_type, difficulty) group;
+# all of them combine across groups with sum or max
+_PARTIALS = {
+    'sum': ('sum',),
+    'mean': ('sum', 'count'),
+    'max': ('max',),
+    'recent_mean': ('wsum', 'wcount')
+}
+
+def _validate(specs):
+    for spec in specs:
+        if spec['measure'] not in SESSION_MEASURES:
+            raise ValueError(f"Unknown measure '{spec['measure']}' in feature '{spec['name']}'")
+        if spec['agg'] not in AGGREGATIONS:
+            raise ValueError(f"Unknown aggregation '{spec['agg']}' in feature '{spec['name']}'")
+        unknown = [dim for dim in spec['by'] if dim not in DIMENSIONS]
+        if unknown or not spec['by']:
+            raise ValueError(f"Feature '{spec['name']}' must be grouped by {' / '.join(DIMENSIONS)}")
+
+def _partials(specs):
+    """Ordered (measure, partial) pairs the query has to return"""
+    needed = []
+    for spec in specs:
+        for partial in _PARTIALS[spec['agg']]:
+            if (spec['measure'], partial) not in needed:
+                needed.append((spec['measure'], partial))
+    return needed
+
+def _partial_sql(measure, partial):
+    expression = SESSION_MEASURES[measure]
+    # Decay constant in seconds; the weight of a session completed now is 1
+    tau = RECENCY_HALF_LIFE_DAYS * 86400 / math.log(2)
+    weight = f"EXP((UNIX_TIMESTAMP(gs.completed_at) - UNIX_TIMESTAMP()) / {tau:.1f})"
+
+    if partial == 'sum':
+        return f"SUM({expression})"
+    if partial == 'count':
+        return f"COUNT({expression})"
+    if partial == 'max':
+        return f"MAX({expression})"
+    if partial == 'wsum':
+        return f"SUM({expression} * {weight})"
+    return f"SUM(CASE WHEN {expression} IS NOT NULL THEN {weight} ELSE 0 END)"
+
+def build_session_query(specs=FEATURE_SPECS, n_users=None):
+    """
+    One GROUP BY (user_id, game_type, difficulty_level) query returning every
+    partial aggregate the specs need. Pass n_users for a user_id IN filter.
+    """
+    _validate(specs)
+    columns = ',\n        '.join(
+        f"{_partial_sql(measure, partial)} AS {measure}_{partial}"
+        for measure, partial in _partials(specs)
+    )
+    user_filter = ''
+    if n_users is not None:
+        user_filter = f"\n        AND gs.user_id IN ({', '.join(['%s'] * n_users)})"
+
+    return f"""
+    SELECT
+        gs.user_id,
+        gs.game_type,
+        gs.difficulty_level,
+        {columns}
+    FROM game_sessions gs
+    JOIN users u ON u.user_id = gs.user_id AND u.is_active = 1
+    WHERE gs.completed_at IS NOT NULL{user_filter}
+    GROUP BY gs.user_id, gs.game_type, gs.difficulty_level
+"""
+
+def spec_columns(spec):
+    """Column names produced by one spec"""
+    # Dimensions always nest in DIMENSIONS order, matching the pivot grid
+    names = ['']
+    for dim in DIMENSIONS:
+        if dim in spec['by']:
+            names = [f"{prefix}{value}_" for prefix in names for value in DIMENSIONS[dim]]
+    return [f"{prefix}{spec['name']}" for prefix in names]
+
+def feature_columns(feature_set='basic', specs=FEATURE_SPECS):
+    """Column names of the raw feature matrix for a feature set"""
+    if feature_set not in FEATURE_SETS:
+        raise ValueError(f"Unknown feature set '{feature_set}' (expected one of {', '.join(FEATURE_SETS)})")
+
+    columns = list(FEATURE_COLUMNS)
+    if feature_set == 'extended':
+        for spec in specs:
+            columns.extend(spec_columns(spec))
+    return columns
+
+def _codes(values, names):
+    """Map a column of names to their index in names, -1 for unknown values"""
+    lookup = {name: i for i, name in enumerate(names)}
+    unique, inverse = np.unique(np.asarray(values, dtype=str), return_inverse=True)
+    return np.array([lookup.get(value, -1) for value in unique], dtype=np.intp)[inverse]
+
+def _user_index(user_ids, row_users):
+    """Row position of each row_users entry in user_ids, and whether it was found"""
+    order = np.argsort(user_ids)
+    position = np.searchsorted(user_ids, row_users, sorter=order).clip(0, len(user_ids) - 1)
+    user_idx = order[position]
+    return user_idx, user_ids[user_idx] == row_users
+
+def _n_cells(by):
+    return math.prod(len(DIMENSIONS[dim]) for dim in by)
+
+def _empty_accumulators(n_users, specs, dtype):
+    """
+    One user x group array per (measure, partial, by) the specs need, so each
+    partial is only kept at the grouping its features use; max partials start
+    as NaN
+    """
+    accumulators = {}
+    for spec in specs:
+        for partial in _PARTIALS[spec['agg']]:
+            key = (spec['measure'], partial, tuple(spec['by']))
+            if key not in accumulators:
+                fill = np.nan if partial == 'max' else 0.0
+                accumulators[key] = np.full((n_users, _n_cells(spec['by'])), fill, dtype=dtype)
+    return accumulators
+
+def _accumulate(accumulators, user_idx, game_idx, difficulty_idx, partial_values):
+    """
+    Add one batch of (user, game_type, difficulty) groups into the accumulators.
+    partial_values maps (measure, partial) to the groups' values, NaN for none.
+    """
+    for (measure, partial, by), accumulator in accumulators.items():
+        # Groups nest in DIMENSIONS order, matching spec_columns()
+        cells = np.zeros(len(user_idx), dtype=np.intp)
+        for dim, idx in (('game_type', game_idx), ('difficulty_level', difficulty_idx)):
+            if dim in by:
+                cells = cells * len(DIMENSIONS[dim]) + idx
+        flat = user_idx * accumulator.shape[1] + cells
+        values = partial_values[(measure, partial)]
+
+        # fmax ignores NaN (no sessions) unless every group is NaN
+        if partial == 'max':
+            np.fmax.at(accumulator.reshape(-1), flat, values)
+        else:
+            np.add.at(accumulator.reshape(-1), flat, np.nan_to_num(values, nan=0.0))
+
+def _accumulated_features(accumulators, specs, dtype):
+    """One block of columns per spec from the accumulated partials"""
+    blocks = []
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for spec in specs:
+            reduced = {partial: accumulators[(spec['measure'], partial, tuple(spec['by']))]
+                       for partial in _PARTIALS[spec['agg']]}
+
+            if spec['agg'] == 'sum':
+                block = reduced['sum']
+            elif spec['agg'] == 'max':
+                block = reduced['max']
+            elif spec['agg'] == 'mean':
+                block = np.where(reduced['count'] > 0, reduced['sum'] / reduced['count'], np.nan)
+            else:
+                block = np.where(reduced['wcount'] > 0, reduced['wsum'] / reduced['wcount'], np.nan)
+
+            blocks.append(np.where(np.isnan(block), spec.get('fill', 0.0), block))
+
+    return np.hstack(blocks).astype(dtype, copy=False)
+
+def _n_columns(specs):
+    return len(feature_columns('extended', specs)) - len(FEATURE_COLUMNS)
+
+def load_game_features(connection, user_ids, specs=FEATURE_SPECS, dtype=np.float64,
+                       filter_users=False, chunk_size=50000):
+    """
+    Run the grouped query and pivot it into an (n_users, n_columns) matrix
+    aligned to user_ids, columns in feature_columns('extended') order after
+    the base features. filter_users=True restricts the query to user_ids
+    (for a handful of students).
+    """
+    user_ids = np.asarray(user_ids, dtype=np.int64)
+    if len(user_ids) == 0:
+        return np.empty((0, _n_columns(specs)), dtype=dtype)
+
+    _validate(specs)
+    partials = _partials(specs)
+    accumulators = _empty_accumulators(len(user_ids), specs, dtype)
+
+    cursor = connection.cursor()
+    if filter_users:
+        cursor.execute(build_session_query(specs, len(user_ids)), [int(uid) for uid in user_ids])
+    else:
+        cursor.execute(build_session_query(specs))
+
+    # Each chunk is scattered into the accumulators as it arrives, so only
+    # chunk_size rows are ever held as Python tuples
+    while True:
+        chunk = cursor.fetchmany(chunk_size)
+        if not chunk:
+            break
+        columns = list(zip(*chunk))
+        game_idx = _codes(columns[1], GAME_TYPES)
+        difficulty_idx = _codes(columns[2], DIFFICULTY_LEVELS)
+        values = np.array([[np.nan if v is None else float(v) for v in column] for column in columns[3:]])
+
+        # Rows for students outside user_ids, or unknown types, are dropped
+        user_idx, found = _user_index(user_ids, np.asarray(columns[0], dtype=np.int64))
+        keep = found & (game_idx >= 0) & (difficulty_idx >= 0)
+        _accumulate(accumulators, user_idx[keep], game_idx[keep], difficulty_idx[keep],
+                    {key: values[p, keep] for p, key in enumerate(partials)})
+    cursor.close()
+
+    return _accumulated_features(accumulators, specs, dtype)
+
+def game_features_from_sessions(user_ids, sessions, reference_time, specs=FEATURE_SPECS, dtype=np.float64):
+    """
+    Same columns as load_game_features(), computed from per-session arrays
+    (e.g. a snapshot) with the same grouped scatter-adds instead of SQL.
+    sessions maps 'user_id', 'game_type' / 'difficulty_level' (index codes),
+    'completed_at' (unix time) and every measure column (NaN for NULL) to arrays;
+    recency weights are relative to reference_time.
+    """
+    user_ids = np.asarray(user_ids, dtype=np.int64)
+    _validate(specs)
+    if len(user_ids) == 0:
+        return np.empty((0, _n_columns(specs)), dtype=dtype)
+
+    user_idx, found = _user_index(user_ids, np.asarray(sessions['user_id'], dtype=np.int64))
+    game_idx = np.asarray(sessions['game_type'], dtype=np.intp)
+    difficulty_idx = np.asarray(sessions['difficulty_level'], dtype=np.intp)
+    keep = found & (game_idx >= 0) & (difficulty_idx >= 0)
+
+    tau = RECENCY_HALF_LIFE_DAYS * 86400 / math.log(2)
+    weights = np.exp((np.asarray(sessions['completed_at'], dtype=np.float64)[keep] - reference_time) / tau)
+
+    partial_values = {}
+    for measure, partial in _partials(specs):
+        if measure == 'sessions':
+            values = np.ones(int(keep.sum()))
+        else:
+            values = np.asarray(sessions[measure], dtype=np.float64)[keep]
+        present = ~np.isnan(values)
+        filled = np.where(present, values, 0.0)
+
+        if partial == 'sum':
+            partial_values[(measure, partial)] = filled
+        elif partial == 'count':
+            partial_values[(measure, partial)] = present.astype(np.float64)
+        elif partial == 'wsum':
+            partial_values[(measure, partial)] = filled * weights
+        elif partial == 'wcount':
+            partial_values[(measure, partial)] = present * weights
+        else:
+            partial_values[(measure, partial)] = values
+
+    accumulators = _empty_accumulators(len(user_ids), specs, dtype)
+    _accumulate(accumulators, user_idx[keep], game_idx[keep], difficulty_idx[keep], partial_values)
+    return _accumulated_features(accumulators, specs, dtype)
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Incremental Feature Store
+Keeps running per-student aggregates of completed game sessions so each
+clustering run only folds in the sessions completed since the last run
+"""
+
+from datetime import datetime, timedelta
+
+# Name of the high-water mark row in feature_store_state
+STORE_NAME = 'game_sessions'
+
+# Feature modes understood by extract_features()
+FEATURE_MODES = ('incremental', 'rebuild', 'full')
+
+# Original single-statement extraction (full scan of game_sessions)
+_FULL_QUERY_TEMPLATE = """
+    SELECT
+        u.user_id,
+        u.full_name,
+        COALESCE(sp.literacy_progress, 0) as literacy_score,
+        COALESCE(sp.math_progress, 0) as math_score,
+        COALESCE(sp.total_score, 0) as total_score,
+        COALESCE(sp.games_played, 0) as games_played,
+        COALESCE(AVG(gs.accuracy), 0) as avg_accuracy,
+        COALESCE(AVG(gs.time_taken), 0) as avg_time,
+        COALESCE(SUM(gs.hints_used), 0) as total_hints
+    FROM users u
+    LEFT JOIN student_progress sp ON u.user_id = sp.user_id
+    LEFT JOIN game_sessions gs ON u.user_id = gs.user_id
+        AND gs.completed_at IS NOT NULL
+    WHERE u.is_active = 1{user_filter}
+    GROUP BY u.user_id, u.full_name, sp.literacy_progress,
+             sp.math_progress, sp.total_score, sp.games_played
+    HAVING games_played > 0
+    ORDER BY u.user_id
+"""
+FULL_FEATURE_QUERY = _FULL_QUERY_TEMPLATE.format(user_filter='')
+
+# Same columns read from the aggregate store (one row per student, no GROUP BY).
+# SUM/COUNT division uses the same DECIMAL precision rules as AVG(), so the
+# values are identical to FULL_FEATURE_QUERY.
+_STORE_QUERY_TEMPLATE = """
+    SELECT
+        u.user_id,
+        u.full_name,
+        COALESCE(sp.literacy_progress, 0) as literacy_score,
+        COALESCE(sp.math_progress, 0) as math_score,
+        COALESCE(sp.total_score, 0) as total_score,
+        COALESCE(sp.games_played, 0) as games_played,
+        COALESCE(fa.accuracy_sum / fa.accuracy_count, 0) as avg_accuracy,
+        COALESCE(fa.time_sum / fa.time_count, 0) as avg_time,
+        COALESCE(fa.hints_sum, 0) as total_hints
+    FROM users u
+    LEFT JOIN student_progress sp ON u.user_id = sp.user_id
+    LEFT JOIN student_feature_aggregates fa ON u.user_id = fa.user_id
+    WHERE u.is_active = 1{user_filter}
+        AND COALESCE(sp.games_played, 0) > 0
+    ORDER BY u.user_id
+"""
+STORE_FEATURE_QUERY = _STORE_QUERY_TEMPLATE.format(user_filter='')
+
+# Restricts an extraction query to one shard: user_id in [%s, %s)
+SHARD_FILTER = "\n        AND u.user_id >= %s AND u.user_id < %s"
+
+CREATE_AGGREGATES_TABLE = """
+    CREATE TABLE IF NOT EXISTS student_feature_aggregates (
+        user_id INT PRIMARY KEY,
+        session_count INT NOT NULL DEFAULT 0,
+        accuracy_count INT NOT NULL DEFAULT 0,
+        accuracy_sum DECIMAL(16,2) NOT NULL DEFAULT 0.00,
+        accuracy_sumsq DECIMAL(20,4) NOT NULL DEFAULT 0.0000,
+        time_count INT NOT NULL DEFAULT 0,
+        time_sum BIGINT NOT NULL DEFAULT 0,
+        time_sumsq BIGINT NOT NULL DEFAULT 0,
+        hints_sum BIGINT NOT NULL DEFAULT 0,
+        last_session_id INT NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+"""
+
+CREATE_STATE_TABLE = """
+    CREATE TABLE IF NOT EXISTS feature_store_state (
+        store_name VARCHAR(50) PRIMARY KEY,
+        last_completed_at TIMESTAMP NULL,
+        last_session_id INT NOT NULL DEFAULT 0,
+        rebuilt_at TIMESTAMP NULL,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+"""
+
+# Sessions can commit after a later session's completed_at was already past
+# the high-water mark (a slow transaction), so each fold also re-scans the
+# FOLD_OVERLAP_SECONDS before the previous mark
+FOLD_OVERLAP_SECONDS = 600
+
+# Re-aggregate every completed session, up to (hi_completed_at, hi_session_id)
+# in (completed_at, session_id) order, of the students {user_filter} selects
+# and replace their rows. Replacing instead of adding keeps overlapping folds
+# from counting a session twice.
+FOLD_QUERY = """
+    INSERT INTO student_feature_aggregates (
+        user_id, session_count,
+        accuracy_count, accuracy_sum, accuracy_sumsq,
+        time_count, time_sum, time_sumsq,
+        hints_sum, last_session_id
+    )
+    SELECT
+        gs.user_id,
+        COUNT(*),
+        COUNT(gs.accuracy),
+        COALESCE(SUM(gs.accuracy), 0),
+        COALESCE(SUM(gs.accuracy * gs.accuracy), 0),
+        COUNT(gs.time_taken),
+        COALESCE(SUM(gs.time_taken), 0),
+        COALESCE(SUM(gs.time_taken * gs.time_taken), 0),
+        COALESCE(SUM(gs.hints_used), 0),
+        MAX(gs.session_id)
+    FROM game_sessions gs
+    WHERE gs.completed_at IS NOT NULL
+        AND {user_filter}
+        AND (gs.completed_at < %(hi_at)s
+             OR (gs.completed_at = %(hi_at)s AND gs.session_id <= %(hi_id)s))
+    GROUP BY gs.user_id
+    ON DUPLICATE KEY UPDATE
+        session_count = VALUES(session_count),
+        accuracy_count = VALUES(accuracy_count),
+        accuracy_sum = VALUES(accuracy_sum),
+        accuracy_sumsq = VALUES(accuracy_sumsq),
+        time_count = VALUES(time_count),
+        time_sum = VALUES(time_sum),
+        time_sumsq = VALUES(time_sumsq),
+        hints_sum = VALUES(hints_sum),
+        last_session_id = VALUES(last_session_id)
+"""
+
+FOLD_ALL_USERS = "1 = 1"
+# Students with a session completed since %(since)s (served by idx_completed)
+FOLD_RECENT_USERS = """gs.user_id IN (
+            SELECT recent.user_id FROM game_sessions recent
+            WHERE recent.completed_at >= %(since)s)"""
+
+# Lower bounds of the windows read by the online updates and snapshot exports:
+# everything, the half-open ((lo_completed_at, lo_session_id), ...] range, or
+# every session completed since %(since)s, from overlap_start()
+LOWER_BOUND_ALL = "1 = 1"
+LOWER_BOUND_WATERMARK = """(gs.completed_at > %(lo_at)s
+             OR (gs.completed_at = %(lo_at)s AND gs.session_id > %(lo_id)s))"""
+LOWER_BOUND_OVERLAP = "gs.completed_at >= %(since)s"
+
+def overlap_start(completed_at):
+    """
+    Start of the re-scan window behind a high-water mark, FOLD_OVERLAP_SECONDS
+    before its completed_at (a datetime or 'YYYY-MM-DD HH:MM:SS' string)
+    """
+    if isinstance(completed_at, str):
+        completed_at = datetime.fromisoformat(completed_at)
+    return completed_at - timedelta(seconds=FOLD_OVERLAP_SECONDS)
+
+
+def ensure_feature_store(connection):
+    """Create the aggregate and state tables if they do not exist"""
+    cursor = connection.cursor()
+    cursor.execute(CREATE_AGGREGATES_TABLE)
+    cursor.execute(CREATE_STATE_TABLE)
+    cursor.close()
+
+def get_watermark(connection):
+    """Return (last_completed_at, last_session_id) or None if never synced"""
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT last_completed_at, last_session_id FROM feature_store_state "
+        "WHERE store_name = %s",
+        (STORE_NAME,)
+    )
+    row = cursor.fetchone()
+    cursor.close()
+
+    if row is None or row[0] is None:
+        return None
+    return row[0], int(row[1])
+
+def latest_completed_session(cursor):
+    """Upper bound for this fold, fixed before reading so concurrent inserts wait for the next run"""
+    cursor.execute("""
+        SELECT completed_at, session_id FROM game_sessions
+        WHERE completed_at IS NOT NULL
+        ORDER BY completed_at DESC, session_id DESC
+        LIMIT 1
+    """)
+    return cursor.fetchone()
+
+def sync_feature_store(connection, rebuild=False):
+    """
+    Re-aggregate the students with sessions completed since the last
+    high-water mark, less FOLD_OVERLAP_SECONDS, and replace their rows.
+    With rebuild=True the store is cleared and re-aggregated from scratch.
+    Returns MySQL's affected-row count for the fold.
+    """
+    ensure_feature_store(connection)
+
+    watermark = None if rebuild else get_watermark(connection)
+    cursor = connection.cursor()
+
+    try:
+        if watermark is None:
+            # First run or explicit rebuild: start from an empty store
+            cursor.execute("DELETE FROM student_feature_aggregates")
+
+        latest = latest_completed_session(cursor)
+
+        if latest is None:
+            touched = 0
+            hi_at, hi_id = None, 0
+        else:
+            hi_at, hi_id = latest[0], int(latest[1])
+            if watermark is not None and (hi_at, hi_id) < watermark:
+                # The newest session was deleted; the mark never moves back
+                hi_at, hi_id = watermark
+            params = {'hi_at': hi_at, 'hi_id': hi_id}
+
+            if watermark is None:
+                user_filter = FOLD_ALL_USERS
+            else:
+                # Re-scanned even when nothing is newer than the mark, to pick
+                # up late commits behind it
+                user_filter = FOLD_RECENT_USERS
+                params['since'] = overlap_start(watermark[0])
+
+            cursor.execute(FOLD_QUERY.format(user_filter=user_filter), params)
+            # ON DUPLICATE KEY UPDATE reports 1 per insert, 2 per changed row, 0 per unchanged one
+            touched = cursor.rowcount
+
+        cursor.execute("""
+            INSERT INTO feature_store_state (store_name, last_completed_at, last_session_id, rebuilt_at)
+            VALUES (%s, %s, %s, IF(%s, NOW(), NULL))
+            ON DUPLICATE KEY UPDATE
+                last_completed_at = VALUES(last_completed_at),
+                last_session_id = VALUES(last_session_id),
+                rebuilt_at = IF(%s, NOW(), rebuilt_at)
+        """, (STORE_NAME, hi_at, hi_id, watermark is None, watermark is None))
+
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    mode = 'Rebuilt' if watermark is None else 'Updated'
+    print(f"[OK] {mode} feature store (high-water mark: session {hi_id}, rows affected: {touched})")
+    return touched
+
+def _feature_vectors(rows):
+    """Feature values exactly as prepare_feature_matrix() builds them, keyed by user_id"""
+    return {
+        row['user_id']: [
+            float(row['literacy_score']),
+            float(row['math_score']),
+            float(row['avg_accuracy']),
+            float(row['games_played']),
+            float(row['total_score']) / 100.0,
+            float(row['avg_time']) / 60.0,
+            float(row['total_hints'])
+        ]
+        for row in rows
+    }
+
+def verify_feature_store(connection):
+    """
+    Compare the store-backed extraction with the original full GROUP BY query.
+    Returns True when both produce identical feature matrices.
+    """
+    sync_feature_store(connection)
+
+    cursor = connection.cursor(dictionary=True)
+    cursor.execute(FULL_FEATURE_QUERY)
+    full_rows = cursor.fetchall()
+    cursor.execute(STORE_FEATURE_QUERY)
+    store_rows = cursor.fetchall()
+    cursor.close()
+
+    full = _feature_vectors(full_rows)
+    store = _feature_vectors(store_rows)
+
+    missing = set(full) ^ set(store)
+    mismatched = [uid for uid in set(full) & set(store) if full[uid] != store[uid]]
+
+    if missing or mismatched:
+        print(f"[ERROR] Feature store mismatch: {len(missing)} students missing, "
+              f"{len(mismatched)} with different features")
+        for uid in sorted(mismatched)[:10]:
+            print(f"  User {uid}: full={full[uid]} store={store[uid]}")
+        return False
+
+    print(f"[OK] Feature store verified against full query ({len(full)} students, "
+          f"checked {datetime.now().strftime('%Y-%m-%d %H:%M:%S')})")
+    return True
+
+def feature_query(connection, mode='incremental'):
+    """Bring the store up to date for the given feature mode and return its extraction query"""
+    if mode not in FEATURE_MODES:
+        raise ValueError(f"Unknown feature mode '{mode}' (expected one of {', '.join(FEATURE_MODES)})")
+
+    if mode == 'full':
+        return FULL_FEATURE_QUERY
+
+    sync_feature_store(connection, rebuild=(mode == 'rebuild'))
+    return STORE_FEATURE_QUERY
+
+def shard_feature_query(mode='incremental'):
+    """
+    Extraction query of a feature mode limited to one user_id range by
+    SHARD_FILTER. Rows and values are those of the unsharded query; call
+    feature_query() first so the store is up to date.
+    """
+    if mode not in FEATURE_MODES:
+        raise ValueError(f"Unknown feature mode '{mode}' (expected one of {', '.join(FEATURE_MODES)})")
+
+    template = _FULL_QUERY_TEMPLATE if mode == 'full' else _STORE_QUERY_TEMPLATE
+    return template.format(user_filter=SHARD_FILTER)
+
+def user_feature_query(n_users):
+    """Full-scan query restricted to n_users user_id placeholders (served by idx_session_user_date)"""
+    placeholders = ', '.join(['%s'] * n_users)
+    return _FULL_QUERY_TEMPLATE.format(user_filter=f"\n        AND u.user_id IN ({placeholders})")
+
+def load_feature_rows(connection, mode='incremental'):
+    """Run the extraction query for the given feature mode and return row dicts"""
+    query = feature_query(connection, mode)
+
+    cursor = connection.cursor(dictionary=True)
+    cursor.execute(query)
+    students = cursor.fetchall()
+    cursor.close()
+    return students
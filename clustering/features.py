@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Feature Matrix Extraction
+Streams student feature rows from MySQL straight into a preallocated NumPy
+matrix, without building a dict per student
+"""
+
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from sklearn.preprocessing import StandardScaler
+
+from feature_store import SHARD_FILTER, feature_query, shard_feature_query, user_feature_query
+
+# Column order of the raw feature matrix
+FEATURE_COLUMNS = (
+    'literacy_score',
+    'math_score',
+    'avg_accuracy',
+    'games_played',
+    'total_score',
+    'avg_time',
+    'total_hints'
+)
+LITERACY, MATH, ACCURACY, GAMES_PLAYED, TOTAL_SCORE, AVG_TIME, TOTAL_HINTS = range(len(FEATURE_COLUMNS))
+
+# Applied before standardization: total_score / 100, avg_time in minutes
+FEATURE_DIVISORS = np.array([1.0, 1.0, 1.0, 1.0, 100.0, 60.0, 1.0])
+
+# Rows fetched from the server per round-trip
+EXTRACT_CHUNK_SIZE = 5000
+
+# Rows per block when column statistics are accumulated in float64
+STANDARDIZE_BLOCK_ROWS = 65536
+
+# Extraction shards read concurrently over separate connections (1 = one query)
+EXTRACT_SHARDS = 1
+MAX_EXTRACT_SHARDS = 16
+
+# Same row set as the feature queries: active students with at least one game
+_COUNT_QUERY_TEMPLATE = """
+    SELECT COUNT(*)
+    FROM users u
+    JOIN student_progress sp ON u.user_id = sp.user_id
+    WHERE u.is_active = 1{user_filter}
+        AND sp.games_played > 0
+"""
+COUNT_QUERY = _COUNT_QUERY_TEMPLATE.format(user_filter='')
+SHARD_COUNT_QUERY = _COUNT_QUERY_TEMPLATE.format(user_filter=SHARD_FILTER)
+
+# First user_id of each shard: the active user at a given offset, via the primary key
+SHARD_START_QUERY = """
+    SELECT user_id FROM users
+    WHERE is_active = 1
+    ORDER BY user_id
+    LIMIT 1 OFFSET %s
+"""
+
+def _read_feature_rows(cursor, expected, chunk_size, dtype):
+    """Fill a preallocated matrix from an executed cursor, chunk_size rows at a time"""
+    raw_features = np.empty((expected, len(FEATURE_COLUMNS)), dtype=dtype)
+    user_ids = np.empty(expected, dtype=np.int64)
+
+    positions = [cursor.column_names.index(column) for column in FEATURE_COLUMNS]
+    id_position = cursor.column_names.index('user_id')
+
+    filled = 0
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+
+        end = filled + len(rows)
+        if end > len(raw_features):
+            # Students were added between the count and the read
+            capacity = max(end, len(raw_features) + chunk_size)
+            raw_features = np.resize(raw_features, (capacity, len(FEATURE_COLUMNS)))
+            user_ids = np.resize(user_ids, capacity)
+
+        raw_features[filled:end] = [[float(row[p]) for p in positions] for row in rows]
+        user_ids[filled:end] = [int(row[id_position]) for row in rows]
+        filled = end
+
+    return user_ids[:filled], raw_features[:filled]
+
+def stream_feature_matrix(connection, mode='incremental', chunk_size=EXTRACT_CHUNK_SIZE,
+                          dtype=np.float64):
+    """
+    Read feature rows with an unbuffered cursor, chunk_size rows at a time,
+    into a preallocated (n_students, n_features) matrix.
+    Returns (user_ids, raw_features); memory beyond the result is O(chunk_size).
+    """
+    query = feature_query(connection, mode)
+
+    cursor = connection.cursor()
+    cursor.execute(COUNT_QUERY)
+    expected = int(cursor.fetchone()[0])
+    cursor.close()
+
+    # raw=True skips Decimal construction; float() parses the wire values directly
+    cursor = connection.cursor(buffered=False, raw=True)
+    cursor.execute(query)
+    user_ids, raw_features = _read_feature_rows(cursor, expected, chunk_size, dtype)
+    cursor.close()
+
+    return user_ids, raw_features
+
+def shard_bounds(connection, shards):
+    """
+    Split the active users into at most shards user_id ranges of similar size.
+    Returns [(lo, hi), ...] in user_id order, hi exclusive; the last range is
+    open-ended so students added meanwhile are still read.
+    """
+    cursor = connection.cursor()
+    cursor.execute("SELECT COUNT(*) FROM users WHERE is_active = 1")
+    n_users = int(cursor.fetchone()[0])
+
+    starts = []
+    for shard in range(min(shards, n_users)):
+        cursor.execute(SHARD_START_QUERY, (shard * n_users // shards,))
+        starts.append(int(cursor.fetchone()[0]))
+    cursor.close()
+
+    if not starts:
+        return [(0, sys.maxsize)]
+
+    # The first range also covers ids below the first active user
+    starts = sorted(set(starts))
+    starts[0] = 0
+    return list(zip(starts, starts[1:] + [sys.maxsize]))
+
+def _read_shard(connect, query, lo, hi, chunk_size, dtype):
+    """Feature rows of one user_id range, on a connection of its own"""
+    with connect() as connection:
+        cursor = connection.cursor()
+        cursor.execute(SHARD_COUNT_QUERY, (lo, hi))
+        expected = int(cursor.fetchone()[0])
+        cursor.close()
+
+        cursor = connection.cursor(buffered=False, raw=True)
+        cursor.execute(query, (lo, hi))
+        user_ids, raw_features = _read_feature_rows(cursor, expected, chunk_size, dtype)
+        cursor.close()
+
+    return user_ids, raw_features
+
+def stream_sharded_feature_matrix(connection, connect, mode='incremental', shards=EXTRACT_SHARDS,
+                                  chunk_size=EXTRACT_CHUNK_SIZE, dtype=np.float64):
+    """
+    Same result as stream_feature_matrix(), with the aggregation split into
+    user_id range shards that run concurrently. connect() is a context
+    manager giving each shard its own connection (e.g. a pool's
+    connection); shards are stitched back together in user_id order.
+    """
+    # Brings the feature store up to date on the caller's connection
+    feature_query(connection, mode)
+    query = shard_feature_query(mode)
+    bounds = shard_bounds(connection, shards)
+
+    with ThreadPoolExecutor(max_workers=len(bounds)) as pool:
+        parts = list(pool.map(lambda bound: _read_shard(connect, query, bound[0], bound[1],
+                                                        chunk_size, dtype), bounds))
+
+    user_ids = np.concatenate([part[0] for part in parts])
+    raw_features = np.concatenate([part[1] for part in parts])
+    return user_ids, raw_features
+
+def fetch_user_features(connection, user_ids, dtype=np.float64):
+    """
+    Current features for just the given students, computed from their own
+    game sessions. Students without completed games are left out.
+    """
+    user_ids = [int(uid) for uid in user_ids]
+    if not user_ids:
+        return np.empty(0, dtype=np.int64), np.empty((0, len(FEATURE_COLUMNS)), dtype=dtype)
+
+    cursor = connection.cursor(buffered=False, raw=True)
+    cursor.execute(user_feature_query(len(user_ids)), user_ids)
+    found_ids, raw_features = _read_feature_rows(cursor, len(user_ids), EXTRACT_CHUNK_SIZE, dtype)
+    cursor.close()
+
+    return found_ids, raw_features
+
+def feature_divisors(n_columns):
+    """FEATURE_DIVISORS for the base columns, 1 for any columns appended after them"""
+    divisors = np.ones(n_columns)
+    divisors[:len(FEATURE_DIVISORS)] = FEATURE_DIVISORS[:n_columns]
+    return divisors
+
+def _column_moments(features):
+    """
+    Column means and variances of a matrix of any float dtype. Sums are
+    accumulated in float64 over blocks of STANDARDIZE_BLOCK_ROWS rows, so no
+    full-size float64 copy is made; the variance uses a second, centered pass.
+    """
+    n_rows = max(len(features), 1)
+    blocks = range(0, len(features), STANDARDIZE_BLOCK_ROWS)
+
+    mean = np.zeros(features.shape[1])
+    for start in blocks:
+        mean += features[start:start + STANDARDIZE_BLOCK_ROWS].sum(axis=0, dtype=np.float64)
+    mean /= n_rows
+
+    var = np.zeros(features.shape[1])
+    for start in blocks:
+        centered = features[start:start + STANDARDIZE_BLOCK_ROWS] - mean
+        var += np.einsum('ij,ij->j', centered, centered)
+    var /= n_rows
+
+    return mean, var
+
+def standardize_features(raw_features, copy=True):
+    """
+    Apply FEATURE_DIVISORS and scale each column to zero mean, unit variance.
+    The result keeps raw_features' dtype and is the only full-size allocation;
+    copy=False scales raw_features itself in place. Returns the scaled matrix
+    and a fitted StandardScaler carrying the float64 statistics.
+    """
+    divisors = feature_divisors(raw_features.shape[1]).astype(raw_features.dtype)
+    if copy:
+        features = raw_features / divisors
+    else:
+        features = raw_features
+        features /= divisors
+
+    mean, var = _column_moments(features)
+    # Constant columns are only centered, as StandardScaler does
+    scale = np.sqrt(var)
+    scale[scale <= 10 * np.finfo(np.float64).eps * np.maximum(np.abs(mean), 1.0)] = 1.0
+
+    features -= mean.astype(features.dtype)
+    features /= scale.astype(features.dtype)
+
+    scaler = StandardScaler()
+    scaler.mean_, scaler.var_, scaler.scale_ = mean, var, scale
+    scaler.n_features_in_ = features.shape[1]
+    scaler.n_samples_seen_ = len(features)
+    return features, scaler
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Background Clustering Jobs
+SQLite-backed job queue with an in-process worker thread, so clustering
+requests return immediately and callers poll for progress
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from datetime import datetime
+
+# Job database lives next to the scripts unless CLUSTERING_JOB_DB is set
+JOB_DB_PATH = os.environ.get(
+    'CLUSTERING_JOB_DB',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models', 'jobs.sqlite3')
+)
+
+# Pipeline stages reported by GET /jobs/<id>, in order
+JOB_STAGES = (
+    'connect',
+    'extract_features',
+    'prepare_feature_matrix',
+    'perform_clustering',
+    'assign_cluster_labels',
+    'save_clustering_results',
+    'generate_report',
+    'build_neighbor_index',
+    'compute_projection'
+)
+
+# Running jobs without a heartbeat for this long are treated as interrupted
+JOB_STALE_SECONDS = 1800
+
+# A running job's heartbeat is refreshed this often, however long its stages take
+JOB_HEARTBEAT_SECONDS = 60
+
+# Finished jobs are pruned after this many days
+JOB_RETENTION_DAYS = 7
+
+CREATE_JOBS_TABLE = """
+    CREATE TABLE IF NOT EXISTS jobs (
+        job_id TEXT PRIMARY KEY,
+        dataset_key TEXT NOT NULL,
+        params TEXT NOT NULL,
+        status TEXT NOT NULL,
+        stage TEXT,
+        stages TEXT NOT NULL,
+        result TEXT,
+        error TEXT,
+        created_at REAL NOT NULL,
+        started_at REAL,
+        finished_at REAL,
+        heartbeat_at REAL
+    )
+"""
+
+def _timestamp(value):
+    """Format a unix time for API responses"""
+    if value is None:
+        return None
+    return datetime.fromtimestamp(value).strftime('%Y-%m-%d %H:%M:%S')
+
+def dataset_key(params):
+    """Requests with the same key describe the same run and are coalesced"""
+    return json.dumps(params, sort_keys=True)
+
+class JobQueue:
+    """Queue of clustering runs executed one at a time on a background thread"""
+
+    def __init__(self, runner, db_path=JOB_DB_PATH):
+        # runner(params, progress) -> result dict; progress(stage) marks a stage as started
+        self.runner = runner
+        self.db_path = db_path
+        self._wake = threading.Event()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with self._connect() as db:
+            db.execute(CREATE_JOBS_TABLE)
+            db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at)")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_dataset ON jobs (dataset_key, status)")
+            db.execute(
+                "UPDATE jobs SET status = 'failed', error = 'Interrupted', finished_at = ? "
+                "WHERE status = 'running' AND heartbeat_at < ?",
+                (time.time(), time.time() - JOB_STALE_SECONDS)
+            )
+
+    def _connect(self):
+        db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA journal_mode=WAL")
+        return _Transaction(db)
+
+    def submit(self, params):
+        """
+        Queue a run, or return the queued/running job for the same dataset.
+        Returns (job_id, coalesced).
+        """
+        key = dataset_key(params)
+        now = time.time()
+
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            existing = db.execute(
+                "SELECT job_id FROM jobs WHERE dataset_key = ? AND status IN ('queued', 'running') "
+                "ORDER BY created_at LIMIT 1",
+                (key,)
+            ).fetchone()
+
+            if existing:
+                job_id, coalesced = existing['job_id'], True
+            else:
+                job_id, coalesced = uuid.uuid4().hex, False
+                stages = {stage: {'status': 'pending'} for stage in JOB_STAGES}
+                db.execute(
+                    "INSERT INTO jobs (job_id, dataset_key, params, status, stages, created_at) "
+                    "VALUES (?, ?, ?, 'queued', ?, ?)",
+                    (job_id, key, json.dumps(params), json.dumps(stages), now)
+                )
+
+            db.execute(
+                "DELETE FROM jobs WHERE status IN ('succeeded', 'failed') AND finished_at < ?",
+                (now - JOB_RETENTION_DAYS * 86400,)
+            )
+
+        self._ensure_worker()
+        self._wake.set()
+        return job_id, coalesced
+
+    def get(self, job_id):
+        """Job status as a dict, or None if the id is unknown"""
+        with self._connect() as db:
+            row = db.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+
+        if row is None:
+            return None
+
+        return {
+            'job_id': row['job_id'],
+            'status': row['status'],
+            'stage': row['stage'],
+            'stages': json.loads(row['stages']),
+            'params': json.loads(row['params']),
+            'result': json.loads(row['result']) if row['result'] else None,
+            'error': row['error'],
+            'created_at': _timestamp(row['created_at']),
+            'started_at': _timestamp(row['started_at']),
+            'finished_at': _timestamp(row['finished_at'])
+        }
+
+    def wait(self, job_id, timeout=None, poll_interval=0.2):
+        """Block until the job finishes or timeout seconds pass; returns the job dict"""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            job = self.get(job_id)
+            if job is None or job['status'] in ('succeeded', 'failed'):
+                return job
+            if deadline is not None and time.time() >= deadline:
+                return job
+            time.sleep(poll_interval)
+
+    def _ensure_worker(self):
+        with self._worker_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._work, name='clustering-jobs', daemon=True)
+                self._worker.start()
+
+    def _claim(self):
+        """Atomically move the oldest queued job to running"""
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute(
+                "SELECT job_id, params FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+
+            now = time.time()
+            db.execute(
+                "UPDATE jobs SET status = 'running', started_at = ?, heartbeat_at = ? WHERE job_id = ?",
+                (now, now, row['job_id'])
+            )
+            return row['job_id'], json.loads(row['params'])
+
+    def _progress(self, job_id, stages, state):
+        """Return the progress callback for one job"""
+        def progress(stage):
+            now = time.time()
+            current = state.get('stage')
+            if current is not None:
+                stages[current]['status'] = 'done'
+                stages[current]['seconds'] = round(now - state['stage_started'], 3)
+            stages[stage] = {'status': 'running'}
+            state['stage'], state['stage_started'] = stage, now
+
+            with self._connect() as db:
+                db.execute(
+                    "UPDATE jobs SET stage = ?, stages = ?, heartbeat_at = ? WHERE job_id = ?",
+                    (stage, json.dumps(stages), now, job_id)
+                )
+        return progress
+
+    def _heartbeat(self, job_id, stop):
+        """Refresh a running job's heartbeat until stop is set"""
+        while not stop.wait(JOB_HEARTBEAT_SECONDS):
+            try:
+                with self._connect() as db:
+                    db.execute("UPDATE jobs SET heartbeat_at = ? WHERE job_id = ?",
+                               (time.time(), job_id))
+            except sqlite3.Error as e:
+                # A missed beat is harmless; the next one catches up
+                print(f"[WARNING] Could not update heartbeat of job {job_id}: {e}")
+
+    def _work(self):
+        while True:
+            claimed = self._claim()
+            if claimed is None:
+                self._wake.wait(timeout=5)
+                self._wake.clear()
+                continue
+
+            job_id, params = claimed
+            stages = {stage: {'status': 'pending'} for stage in JOB_STAGES}
+            state = {'stage': None}
+            progress = self._progress(job_id, stages, state)
+
+            stop = threading.Event()
+            heartbeat = threading.Thread(target=self._heartbeat, args=(job_id, stop),
+                                         name='clustering-jobs-heartbeat', daemon=True)
+            heartbeat.start()
+            try:
+                result = self.runner(params, progress)
+                status = 'succeeded' if result.get('success') else 'failed'
+                error = result.get('error')
+            except Exception as e:
+                traceback.print_exc()
+                result, status, error = None, 'failed', str(e)
+            finally:
+                stop.set()
+                heartbeat.join()
+
+            current = state.get('stage')
+            if current is not None:
+                stages[current]['status'] = 'done' if status == 'succeeded' else 'failed'
+                stages[current]['seconds'] = round(time.time() - state['stage_started'], 3)
+
+            with self._connect() as db:
+                db.execute(
+                    "UPDATE jobs SET status = ?, stages = ?, result = ?, error = ?, finished_at = ? "
+                    "WHERE job_id = ?",
+                    (status, json.dumps(stages), json.dumps(result) if result is not None else None,
+                     error, time.time(), job_id)
+                )
+
+            tag = 'OK' if status == 'succeeded' else 'ERROR'
+            print(f"[{tag}] Job {job_id} {status}")
+
+class _Transaction:
+    """Context manager that commits or rolls back and always closes the SQLite connection"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if self.db.in_transaction:
+                self.db.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.db.close()
+        return False
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Flask Load Benchmark
+Serves the clustering app from a local threaded server backed by a synthetic
+cohort, drives it with concurrent clients sending a weighted mix of
+requests and records latency percentiles, throughput and error rates per
+concurrency level, so runs from different commits can be compared
+"""
+
+import sys
+import io
+
+# Fix Windows console encoding issues
+if sys.platform == 'win32':
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
+    sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
+
+import argparse
+import http.client
+import json
+import os
+import random
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlsplit
+
+BENCHMARK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks')
+
+# Marks the server child's "listening" line among the app output
+SERVER_PREFIX = 'LOAD_SERVER '
+
+# Seconds to wait for the server child to start listening
+SERVER_START_TIMEOUT = 120
+
+# Per-request client timeout; /cluster with "wait" blocks up to JOB_WAIT_TIMEOUT
+REQUEST_TIMEOUT = 90
+
+# The SQLite stand-in has no feature store tables, so runs use the full query
+LOAD_FEATURE_MODE = 'full'
+
+# Requests the clients can send: name -> builder(rng, students) returning
+# (method, path, JSON body or None). Add new endpoints here to load them.
+LOAD_ENDPOINTS = {
+    'health': lambda rng, students: ('GET', '/health', None),
+    'metrics': lambda rng, students: ('GET', '/metrics', None),
+    'cluster': lambda rng, students: (
+        'POST', '/cluster', {'wait': True, 'feature_mode': LOAD_FEATURE_MODE}),
+    'cluster_fresh': lambda rng, students: (
+        'POST', '/cluster', {'wait': True, 'use_cache': False, 'feature_mode': LOAD_FEATURE_MODE}),
+    'clusters': lambda rng, students: ('GET', '/clusters', None),
+    'cluster_students': lambda rng, students: (
+        'GET', f'/clusters/{rng.randrange(3)}/students?page={rng.randint(1, 5)}', None),
+    'students': lambda rng, students: (
+        'GET', f'/students?sort=overall_performance&page={rng.randint(1, 20)}', None),
+    'student': lambda rng, students: ('GET', f'/students/{rng.randint(1, students)}/cluster', None),
+    'neighbors': lambda rng, students: (
+        'POST', '/neighbors', {'user_id': rng.randint(1, students), 'k': 10}),
+    'assign': lambda rng, students: ('POST', '/assign', {'user_id': rng.randint(1, students)}),
+    'projection': lambda rng, students: (
+        'GET', rng.choice(['/projection', '/projection?mode=bins']), None)
+}
+
+# Default mix: admins polling /health and reading results, with the odd rerun
+DEFAULT_MIX = 'health=10,clusters=4,cluster_students=4,student=4,neighbors=2,cluster=1'
+
+DEFAULT_CONCURRENCY = (1, 4, 16)
+
+# An endpoint counts as a regression when its p95 is this much slower than
+# the baseline and at least REGRESSION_MIN_MS slower, or when its error rate
+# grows by more than REGRESSION_ERROR_RATE
+REGRESSION_TOLERANCE = 0.10
+REGRESSION_MIN_MS = 5.0
+REGRESSION_ERROR_RATE = 0.01
+
+def serve(cohort):
+    """Child process: serve the app on a free local port against the cohort"""
+    import mysql.connector
+    from werkzeug.serving import make_server
+    from synthetic_data import open_cohort
+
+    mysql.connector.connect = lambda **config: open_cohort(cohort)
+
+    import complete_app
+    server = make_server('127.0.0.1', 0, complete_app.app, threaded=True)
+    print(SERVER_PREFIX + str(server.server_port), flush=True)
+    server.serve_forever()
+
+def start_server(cohort, work_dir):
+    """Start the server child with its state under work_dir; returns (process, base_url)"""
+    env = dict(os.environ)
+    env.update({
+        'CLUSTERING_MODEL_DIR': os.path.join(work_dir, 'models'),
+        'CLUSTERING_JOB_DB': os.path.join(work_dir, 'jobs.sqlite3'),
+        'CLUSTERING_RESULT_CACHE': os.path.join(work_dir, 'result_cache.sqlite3'),
+        'CLUSTERING_PROFILE_DIR': os.path.join(work_dir, 'profiles'),
+        'CLUSTERING_SNAPSHOT_DIR': os.path.join(work_dir, 'snapshots')
+    })
+    log = open(os.path.join(work_dir, 'server.log'), 'w')
+    process = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), '--serve', cohort],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+        stdout=subprocess.PIPE, stderr=log, text=True
+    )
+
+    # The port is the first line we look for; the rest of stdout is app output
+    deadline = time.time() + SERVER_START_TIMEOUT
+    while time.time() < deadline:
+        line = process.stdout.readline()
+        if not line:
+            break
+        if line.startswith(SERVER_PREFIX):
+            threading.Thread(target=process.stdout.read, daemon=True).start()
+            return process, f'http://127.0.0.1:{line[len(SERVER_PREFIX):].strip()}'
+    process.kill()
+    raise RuntimeError(f"Server did not start, see {log.name}")
+
+def send(base_url, method, path, body=None):
+    """One request on a new connection; returns (status, parsed JSON body or None)"""
+    target = urlsplit(base_url)
+    connection = http.client.HTTPConnection(target.hostname, target.port, timeout=REQUEST_TIMEOUT)
+    try:
+        payload = json.dumps(body) if body is not None else None
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        connection.request(method, path, body=payload, headers=headers)
+        response = connection.getresponse()
+        data = response.read()
+        parsed = None
+        if response.getheader('Content-Type', '').startswith('application/json'):
+            parsed = json.loads(data)
+        return response.status, parsed
+    finally:
+        connection.close()
+
+def _failure(status, parsed):
+    """Error message of a failed response, or None when it succeeded"""
+    if status >= 400:
+        return f'HTTP {status}'
+    if isinstance(parsed, dict) and parsed.get('success') is False:
+        return str(parsed.get('error'))
+    return None
+
+def parse_mix(spec):
+    """"name=weight,..." into {name: weight} over LOAD_ENDPOINTS"""
+    mix = {}
+    for item in spec.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in LOAD_ENDPOINTS:
+            raise ValueError(f"Unknown endpoint '{name}' (expected one of {', '.join(LOAD_ENDPOINTS)})")
+        mix[name] = float(weight or 1)
+    if not any(weight > 0 for weight in mix.values()):
+        raise ValueError('The mix needs at least one endpoint with a positive weight')
+    return mix
+
+def percentiles(latencies):
+    """p50/p95/p99/max in milliseconds of a list of seconds"""
+    if not latencies:
+        return {'p50_ms': None, 'p95_ms': None, 'p99_ms': None, 'max_ms': None}
+    ordered = sorted(latencies)
+
+    def rank(q):
+        return round(ordered[min(int(q * len(ordered)), len(ordered) - 1)] * 1000, 3)
+    return {'p50_ms': rank(0.50), 'p95_ms': rank(0.95), 'p99_ms': rank(0.99),
+            'max_ms': round(ordered[-1] * 1000, 3)}
+
+def _summary(samples, seconds):
+    """Counts, throughput and latency percentiles of (latency, error) samples"""
+    errors = sum(1 for _, error in samples if error)
+    return dict({
+        'requests': len(samples),
+        'errors': errors,
+        'error_rate': round(errors / len(samples), 4) if samples else 0.0,
+        'throughput_rps': round(len(samples) / seconds, 2) if seconds else 0.0
+    }, **percentiles([latency for latency, _ in samples]))
+
+def run_level(base_url, mix, concurrency, duration, students, seed):
+    """Closed loop: concurrency clients send back-to-back requests for duration seconds"""
+    names, weights = list(mix), list(mix.values())
+    samples = {name: [] for name in names}
+    messages = {}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client(worker):
+        rng = random.Random(seed * 1000 + worker)
+        while time.perf_counter() < deadline:
+            name = rng.choices(names, weights)[0]
+            method, path, body = LOAD_ENDPOINTS[name](rng, students)
+            started = time.perf_counter()
+            try:
+                error = _failure(*send(base_url, method, path, body))
+            except Exception as e:
+                error = f'{type(e).__name__}: {e}'
+            latency = time.perf_counter() - started
+            with lock:
+                samples[name].append((latency, error))
+                if error:
+                    messages.setdefault(name, set()).add(error)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(worker,)) for worker in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - started
+
+    endpoints = {name: _summary(endpoint_samples, seconds)
+                 for name, endpoint_samples in samples.items() if endpoint_samples}
+    for name, errors in messages.items():
+        # A few distinct messages are enough to tell what went wrong
+        endpoints[name]['error_messages'] = sorted(errors)[:3]
+
+    level = dict({'concurrency': concurrency, 'seconds': round(seconds, 3)},
+                 **_summary([sample for endpoint in samples.values() for sample in endpoint], seconds))
+    level['endpoints'] = endpoints
+    return level
+
+def print_level(level):
+    print(f"\n[OK] {level['concurrency']} clients: {level['requests']} requests in {level['seconds']:.1f}s, "
+          f"{level['throughput_rps']:.1f} req/s, {level['error_rate']:.1%} errors")
+    print(f"  {'endpoint':<18} {'requests':>8} {'errors':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, result in level['endpoints'].items():
+        print(f"  {name:<18} {result['requests']:>8} {result['errors']:>7} "
+              f"{result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f} {result['p99_ms']:>9.2f}")
+        for message in result.get('error_messages', []):
+            print(f"    [WARNING] {message}")
+
+def compare_results(current, baseline_path):
+    """Print per-endpoint p95 and error rate against a previous results file; returns the regression count"""
+    with open(baseline_path) as handle:
+        baseline = json.load(handle)
+
+    previous = {level['concurrency']: level for level in baseline.get('levels', [])}
+    regressions = 0
+
+    print("\n" + "="*60)
+    print(f"COMPARISON WITH {baseline.get('commit') or baseline_path}")
+    print("="*60)
+
+    for level in current['levels']:
+        before = previous.get(level['concurrency'])
+        if before is None:
+            print(f"\n{level['concurrency']} clients: no baseline")
+            continue
+
+        print(f"\n{level['concurrency']} clients: {before['throughput_rps']:.1f} -> "
+              f"{level['throughput_rps']:.1f} req/s")
+        for name, result in level['endpoints'].items():
+            old = before['endpoints'].get(name)
+            if not old or not old['p95_ms']:
+                print(f"  {name:<18} p95 {result['p95_ms']:>9.2f} ms  (no baseline)")
+                continue
+
+            flags = []
+            if (result['p95_ms'] > old['p95_ms'] * (1 + REGRESSION_TOLERANCE)
+                    and result['p95_ms'] - old['p95_ms'] >= REGRESSION_MIN_MS):
+                flags.append('latency')
+            if result['error_rate'] - old['error_rate'] > REGRESSION_ERROR_RATE:
+                flags.append('errors')
+            regressions += len(flags)
+
+            flag = f"  [WARNING] regression ({', '.join(flags)})" if flags else ''
+            print(f"  {name:<18} p95 {old['p95_ms']:>9.2f} -> {result['p95_ms']:>9.2f} ms  "
+                  f"errors {old['error_rate']:.1%} -> {result['error_rate']:.1%}{flag}")
+
+    return regressions
+
+def parse_args():
+    """Parse command line options"""
+    parser = argparse.ArgumentParser(description='Concurrent load benchmark for the Flask clustering service')
+    parser.add_argument('--students', type=int, default=10000,
+                        help='synthetic cohort size (default: %(default)s)')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help=f"weighted request mix, from: {', '.join(LOAD_ENDPOINTS)} (default: %(default)s)")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=list(DEFAULT_CONCURRENCY),
+                        help='concurrent clients per level (default: %(default)s)')
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='seconds per concurrency level (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=42,
+                        help='random seed for the request mix (default: %(default)s)')
+    parser.add_argument('--url',
+                        help='load an already running service instead of a local server')
+    parser.add_argument('--data-dir', default=os.path.join(BENCHMARK_DIR, 'data'),
+                        help='where generated cohorts are cached (default: %(default)s)')
+    parser.add_argument('--output',
+                        help='results file (default: benchmarks/load_<commit>.json)')
+    parser.add_argument('--compare',
+                        help='previous results file to compare against')
+    parser.add_argument('--serve', metavar='COHORT', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    if args.serve:
+        serve(args.serve)
+        return
+
+    # Only the parent needs the generator and git helpers
+    from benchmark import cohort_path, git_commit
+    from synthetic_data import generate_cohort
+
+    print("\n[AI] Load Benchmark")
+    print("="*60)
+
+    mix = parse_mix(args.mix)
+    results = {
+        'commit': git_commit(),
+        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'settings': {
+            'students': args.students,
+            'mix': mix,
+            'duration': args.duration,
+            'seed': args.seed,
+            'url': args.url
+        },
+        'levels': []
+    }
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        process = None
+        base_url = args.url
+        if base_url is None:
+            os.makedirs(args.data_dir, exist_ok=True)
+            cohort = cohort_path(args.data_dir, args.students, 8.0, 1.0, 42)
+            if not os.path.exists(cohort):
+                generate_cohort(cohort, args.students)
+            process, base_url = start_server(cohort, work_dir)
+            print(f"[OK] Serving {cohort} at {base_url}")
+
+        try:
+            # One run first, so the read endpoints have results and a model to serve
+            started = time.perf_counter()
+            _, seeded = send(base_url, 'POST', '/cluster', {'wait': True, 'feature_mode': LOAD_FEATURE_MODE})
+            if not seeded or not seeded.get('success'):
+                raise RuntimeError(f"Seeding /cluster run failed: {seeded}")
+            print(f"[OK] Seeding run finished in {time.perf_counter() - started:.2f}s")
+
+            for concurrency in args.concurrency:
+                level = run_level(base_url, mix, concurrency, args.duration, args.students, args.seed)
+                results['levels'].append(level)
+                print_level(level)
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait()
+
+    output = args.output or os.path.join(BENCHMARK_DIR, f"load_{results['commit'] or 'local'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as handle:
+        json.dump(results, handle, indent=2)
+    print(f"\n[OK] Results written to {output}")
+
+    if args.compare:
+        regressions = compare_results(results, args.compare)
+        if regressions:
+            print(f"\n[WARNING] {regressions} regression(s) against the baseline")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
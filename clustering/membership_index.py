@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cluster Membership Index
+In-memory copy of the current clustering assignment, read from
+clustering_results once and answered from sorted NumPy arrays
+"""
+
+import hashlib
+import json
+import time
+
+import numpy as np
+
+from result_writer import ensure_results_schema
+
+# Current rows of every student, with the name the admin pages list them by
+CURRENT_MEMBERSHIP_QUERY = """
+    SELECT cr.user_id, u.full_name, cr.cluster_number, cr.cluster_label, cr.segment,
+           cr.literacy_score, cr.math_score, cr.overall_performance, cr.analysis_date
+    FROM clustering_results cr
+    JOIN users u ON u.user_id = cr.user_id
+    WHERE cr.is_current = 1
+    ORDER BY cr.user_id
+"""
+
+# Listing sort keys; scores sort descending by default, the rest ascending
+SORT_KEYS = ('name', 'user_id', 'overall_performance', 'literacy_score', 'math_score')
+SCORE_KEYS = ('overall_performance', 'literacy_score', 'math_score')
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+class MembershipIndex:
+    """
+    The current assignment as parallel arrays sorted by user_id, plus the
+    positions of every cluster's members. Instances are never modified
+    after construction, so readers can use one without locking while a
+    newer index is built.
+    """
+
+    def __init__(self, user_ids, names, clusters, labels, segments, scores, analysis_dates):
+        self.user_ids = np.asarray(user_ids, dtype=np.int64)
+        self.names = np.asarray(names, dtype=object)
+        self.clusters = np.asarray(clusters, dtype=np.int64)
+        self.scores = {key: np.asarray(scores[key], dtype=np.float64) for key in SCORE_KEYS}
+        self.analysis_dates = np.asarray(analysis_dates, dtype=object)
+
+        # Positions of each cluster's members, in user_id order
+        self.members = {int(cluster): np.flatnonzero(self.clusters == cluster)
+                        for cluster in np.unique(self.clusters)}
+        self.labels = {int(cluster): labels[positions[0]] for cluster, positions in self.members.items()}
+        self.segments = {int(cluster): segments[positions[0]] for cluster, positions in self.members.items()}
+
+        # Sorted positions per (cluster or None, key, descending), filled on first use
+        self._orders = {}
+
+        self.etag = self._fingerprint()
+        self.loaded_at = time.time()
+
+    def _fingerprint(self):
+        """Content hash, so every worker holding the same rows serves the same ETag"""
+        digest = hashlib.sha1()
+        for array in (self.user_ids, self.clusters, *self.scores.values()):
+            digest.update(array.tobytes())
+        digest.update(json.dumps([self.labels, self.segments, self.names.tolist(),
+                                  self.analysis_dates.tolist()], default=str).encode())
+        return digest.hexdigest()
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def _positions(self, cluster):
+        """Rows of one cluster, or all rows for None"""
+        if cluster is None:
+            return np.arange(len(self.user_ids))
+        return self.members.get(int(cluster), np.empty(0, dtype=np.intp))
+
+    def _order(self, cluster, key, descending):
+        """Positions of a cluster's rows sorted by key; ties stay in user_id order"""
+        cache_key = (cluster, key, descending)
+        order = self._orders.get(cache_key)
+        if order is None:
+            positions = self._positions(cluster)
+            if key == 'user_id':
+                order = positions[::-1] if descending else positions
+            elif key == 'name':
+                ranked = np.argsort(self.names[positions].astype(str), kind='stable')
+                order = positions[ranked[::-1] if descending else ranked]
+            else:
+                values = self.scores[key][positions]
+                order = positions[np.argsort(-values if descending else values, kind='stable')]
+            self._orders[cache_key] = order
+        return order
+
+    def student(self, position):
+        """One row as a response dict"""
+        cluster = int(self.clusters[position])
+        row = {
+            'user_id': int(self.user_ids[position]),
+            'full_name': self.names[position],
+            'cluster_number': cluster,
+            'cluster_label': self.labels[cluster],
+            'analysis_date': str(self.analysis_dates[position])
+        }
+        row.update({key: round(float(self.scores[key][position]), 2) for key in SCORE_KEYS})
+        if self.segments[cluster] is not None:
+            row['segment'] = self.segments[cluster]
+        return row
+
+    def lookup(self, user_id):
+        """Current assignment of one student, or None"""
+        position = int(np.searchsorted(self.user_ids, user_id))
+        if position < len(self.user_ids) and self.user_ids[position] == user_id:
+            return self.student(position)
+        return None
+
+    def summary(self):
+        """Size and average scores of every cluster"""
+        clusters = []
+        for cluster, positions in sorted(self.members.items()):
+            entry = {
+                'cluster_number': cluster,
+                'cluster_label': self.labels[cluster],
+                'student_count': len(positions)
+            }
+            entry.update({f'avg_{key}': round(float(self.scores[key][positions].mean()), 2)
+                          for key in SCORE_KEYS})
+            if self.segments[cluster] is not None:
+                entry['segment'] = self.segments[cluster]
+            clusters.append(entry)
+        return clusters
+
+    def listing(self, cluster=None, sort='name', descending=None, page=1, per_page=DEFAULT_PAGE_SIZE):
+        """One page of a cluster's members (or of all students), sorted by sort"""
+        if sort not in SORT_KEYS:
+            raise ValueError(f"Unknown sort key '{sort}' (expected one of {', '.join(SORT_KEYS)})")
+        if descending is None:
+            descending = sort in SCORE_KEYS
+        page = max(int(page), 1)
+        per_page = min(max(int(per_page), 1), MAX_PAGE_SIZE)
+
+        order = self._order(cluster, sort, descending)
+        start = (page - 1) * per_page
+        return {
+            'total': len(order),
+            'page': page,
+            'per_page': per_page,
+            'pages': -(-len(order) // per_page),
+            'sort': sort,
+            'order': 'desc' if descending else 'asc',
+            'students': [self.student(position) for position in order[start:start + per_page]]
+        }
+
+def load_membership_index(connection):
+    """Build the index from the current clustering_results rows in one query"""
+    started = time.perf_counter()
+    ensure_results_schema(connection)
+    cursor = connection.cursor()
+    try:
+        cursor.execute(CURRENT_MEMBERSHIP_QUERY)
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+
+    columns = list(zip(*rows)) if rows else [()] * 9
+    user_ids, names, clusters, labels, segments, literacy, math, overall, dates = columns
+    index = MembershipIndex(
+        user_ids, names, clusters, labels, segments,
+        {
+            'literacy_score': [float(value or 0) for value in literacy],
+            'math_score': [float(value or 0) for value in math],
+            'overall_performance': [float(value or 0) for value in overall]
+        },
+        dates
+    )
+
+    print(f"[OK] Loaded membership index: {len(index)} students in {len(index.members)} clusters "
+          f"({time.perf_counter() - started:.2f}s)")
+    return index
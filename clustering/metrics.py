@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pipeline Metrics
+Records wall time, CPU time of the pipeline thread, rows processed and
+resident memory for every pipeline stage, keeps histograms across runs and
+renders them in the Prometheus text format; optionally profiles whole runs
+with cProfile
+"""
+
+import cProfile
+import os
+import threading
+import time
+from datetime import datetime
+
+# Profiles are written next to the scripts unless CLUSTERING_PROFILE_DIR is set
+PROFILE_DIR = os.environ.get(
+    'CLUSTERING_PROFILE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models', 'profiles')
+)
+
+# Histogram bucket upper bounds in seconds (wall and CPU time)
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+METRIC_PREFIX = 'clustering'
+
+def rss_bytes():
+    """
+    Current resident set size of the process (Linux), or None elsewhere.
+    Read at the start and end of every stage: unlike the kernel's high-water
+    mark it goes down again, so each stage shows what it left allocated.
+    """
+    try:
+        with open('/proc/self/status') as handle:
+            for line in handle:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def _mb(value):
+    return round(value / (1024 * 1024), 1) if value is not None else None
+
+class _Histogram:
+    """Cumulative Prometheus-style histogram"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+def _labels(**labels):
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels.items()) + '}'
+
+class PipelineMetrics:
+    """Thread-safe store of per-stage observations across runs"""
+
+    def __init__(self, buckets=STAGE_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._wall = {}
+        self._cpu = {}
+        self._rows = {}
+        self._last = {}
+        self._runs = {}
+        self._last_run_at = None
+
+    def start_run(self, progress=None, profile=False, profile_dir=PROFILE_DIR):
+        """Begin recording one pipeline run"""
+        return StageRecorder(self, progress, profile, profile_dir)
+
+    def observe(self, stage, wall, cpu, rows=None, rss=None, rss_delta=None):
+        """Record one completed stage"""
+        with self._lock:
+            self._wall.setdefault(stage, _Histogram(self.buckets)).observe(wall)
+            self._cpu.setdefault(stage, _Histogram(self.buckets)).observe(cpu)
+            if rows is not None:
+                self._rows[stage] = self._rows.get(stage, 0) + rows
+            self._last[stage] = {'seconds': wall, 'cpu_seconds': cpu, 'rows': rows,
+                                 'rss': rss, 'rss_delta': rss_delta}
+
+    def run_finished(self, status):
+        with self._lock:
+            self._runs[status] = self._runs.get(status, 0) + 1
+            self._last_run_at = time.time()
+
+    def _histogram_lines(self, name, help_text, histograms):
+        lines = [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+        for stage, histogram in sorted(histograms.items()):
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                lines.append(f'{name}_bucket{_labels(stage=stage, le=bound)} {count}')
+            lines.append(f'{name}_bucket{_labels(stage=stage, le="+Inf")} {histogram.count}')
+            lines.append(f'{name}_sum{_labels(stage=stage)} {histogram.sum:.6f}')
+            lines.append(f'{name}_count{_labels(stage=stage)} {histogram.count}')
+        return lines
+
+    def render(self, extra_gauges=None):
+        """
+        Prometheus text exposition of all metrics. extra_gauges maps a metric
+        name (without prefix) to a number, e.g. connection pool stats.
+        """
+        p = METRIC_PREFIX
+        with self._lock:
+            lines = self._histogram_lines(f'{p}_stage_duration_seconds',
+                                          'Wall time per pipeline stage', self._wall)
+            lines += self._histogram_lines(f'{p}_stage_cpu_seconds',
+                                           'CPU time of the pipeline thread per stage', self._cpu)
+
+            lines += [f'# HELP {p}_stage_rows_total Rows processed per pipeline stage',
+                      f'# TYPE {p}_stage_rows_total counter']
+            lines += [f'{p}_stage_rows_total{_labels(stage=stage)} {rows}'
+                      for stage, rows in sorted(self._rows.items())]
+
+            lines += [f'# HELP {p}_stage_last_duration_seconds Wall time of the latest run of each stage',
+                      f'# TYPE {p}_stage_last_duration_seconds gauge']
+            lines += [f'{p}_stage_last_duration_seconds{_labels(stage=stage)} {last["seconds"]:.6f}'
+                      for stage, last in sorted(self._last.items())]
+
+            lines += [f'# HELP {p}_stage_rss_bytes Resident memory at the end of the latest run of each stage',
+                      f'# TYPE {p}_stage_rss_bytes gauge']
+            lines += [f'{p}_stage_rss_bytes{_labels(stage=stage)} {last["rss"]}'
+                      for stage, last in sorted(self._last.items()) if last['rss'] is not None]
+
+            lines += [f'# HELP {p}_stage_rss_delta_bytes Resident memory change over the latest run of each stage',
+                      f'# TYPE {p}_stage_rss_delta_bytes gauge']
+            lines += [f'{p}_stage_rss_delta_bytes{_labels(stage=stage)} {last["rss_delta"]}'
+                      for stage, last in sorted(self._last.items()) if last['rss_delta'] is not None]
+
+            lines += [f'# HELP {p}_runs_total Finished pipeline runs by status',
+                      f'# TYPE {p}_runs_total counter']
+            lines += [f'{p}_runs_total{_labels(status=status)} {count}'
+                      for status, count in sorted(self._runs.items())]
+
+            if self._last_run_at is not None:
+                lines += [f'# TYPE {p}_last_run_timestamp_seconds gauge',
+                          f'{p}_last_run_timestamp_seconds {self._last_run_at:.3f}']
+
+        for name, value in sorted((extra_gauges or {}).items()):
+            lines += [f'# TYPE {p}_{name} gauge', f'{p}_{name} {value}']
+
+        return '\n'.join(lines) + '\n'
+
+class StageRecorder:
+    """Times the consecutive stages of one run; stage(name) ends the previous stage"""
+
+    def __init__(self, metrics, progress=None, profile=False, profile_dir=PROFILE_DIR):
+        self.metrics = metrics
+        self.progress = progress
+        self.stages = {}
+        self.profile_path = None
+        self._current = None
+        self._rows = None
+
+        self._profiler = None
+        if profile:
+            os.makedirs(profile_dir, exist_ok=True)
+            stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+            self.profile_path = os.path.join(profile_dir, f'run_{stamp}_{os.getpid()}.prof')
+            self._profiler = cProfile.Profile()
+            try:
+                self._profiler.enable()
+            except ValueError as e:
+                # Another profiler is already active in this thread
+                print(f"[WARNING] cProfile not started: {e}")
+                self._profiler, self.profile_path = None, None
+
+    def stage(self, name):
+        """Finish the running stage and start the next one"""
+        self._end_stage()
+        if self.progress is not None:
+            self.progress(name)
+
+        self._current = name
+        self._rows = None
+        self._wall_started = time.perf_counter()
+        # CPU of this thread only: process_time() would also count concurrent
+        # requests. Work handed to BLAS threads or process pools isn't included.
+        self._cpu_started = time.thread_time()
+        self._rss_started = rss_bytes()
+
+    def rows(self, count):
+        """Rows processed by the running stage"""
+        self._rows = int(count)
+
+    def _end_stage(self):
+        if self._current is None:
+            return
+
+        wall = time.perf_counter() - self._wall_started
+        cpu = time.thread_time() - self._cpu_started
+        # Process-wide, so memory freed or taken by concurrent requests shows up too
+        rss = rss_bytes()
+        rss_delta = rss - self._rss_started if rss is not None and self._rss_started is not None else None
+        self.metrics.observe(self._current, wall, cpu, self._rows, rss, rss_delta)
+        self.stages[self._current] = {
+            'seconds': round(wall, 4),
+            'cpu_seconds': round(cpu, 4),
+            'rows': self._rows,
+            'rss_mb': _mb(rss),
+            'rss_delta_mb': _mb(rss_delta)
+        }
+        self._current = None
+
+    def finish(self, status='succeeded'):
+        """End the last stage, record the run and dump the profile; returns per-stage results"""
+        self._end_stage()
+        self.metrics.run_finished(status)
+
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.dump_stats(self.profile_path)
+            print(f"[OK] Profile written to {self.profile_path}")
+            self._profiler = None
+
+        print("[OK] Stage timings:")
+        for stage, result in self.stages.items():
+            rows = f", {result['rows']} rows" if result['rows'] is not None else ''
+            rss = (f", RSS {result['rss_mb']} MB ({result['rss_delta_mb']:+.1f})"
+                   if result['rss_mb'] is not None else '')
+            print(f"  {stage}: {result['seconds']:.3f}s wall, {result['cpu_seconds']:.3f}s CPU{rows}{rss}")
+
+        return self.stages
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Model Artifact Storage
+Saves each run's fitted scaler, centroids and cluster labels as a versioned
+artifact and scores new students against the current one
+"""
+
+import glob
+import json
+import os
+import re
+import threading
+from datetime import datetime
+
+import numpy as np
+
+from features import FEATURE_COLUMNS, feature_divisors
+
+# Model files live next to the scripts unless CLUSTERING_MODEL_DIR is set
+MODEL_DIR = os.environ.get(
+    'CLUSTERING_MODEL_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models')
+)
+CURRENT_FILE = 'current.json'
+ARTIFACT_PATTERN = 'model_v{version:04d}.npz'
+
+# Bump when the artifact layout changes
+ARTIFACT_FORMAT = 1
+
+# Number of artifact versions kept on disk
+MODEL_KEEP = 5
+
+def _artifact_versions(model_dir, written_only=False):
+    """
+    Versions of all artifacts on disk, oldest first. A version claimed by a
+    save that is still writing is an empty file; written_only skips it.
+    """
+    versions = []
+    for path in glob.glob(os.path.join(model_dir, 'model_v*.npz')):
+        match = re.search(r'model_v(\d+)\.npz$', path)
+        if match and not (written_only and os.path.getsize(path) == 0):
+            versions.append(int(match.group(1)))
+    return sorted(versions)
+
+def _claim_version(model_dir):
+    """
+    Reserve the next artifact version by creating its file exclusively, so
+    concurrent saves never pick the same version and overwrite each other.
+    Returns (version, path).
+    """
+    while True:
+        versions = _artifact_versions(model_dir)
+        version = (versions[-1] + 1) if versions else 1
+        path = os.path.join(model_dir, ARTIFACT_PATTERN.format(version=version))
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return version, path
+        except FileExistsError:
+            # Another save claimed it first; look again
+            continue
+
+def _write_atomic(path, write):
+    """Write through a temp file then rename so readers never see a partial file"""
+    # A temp file per writer, so concurrent writes of the same file don't collide
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as handle:
+            write(handle)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def prune_run_files(model_dir, prefix, extension):
+    """Remove <prefix>_vNNNN files saved with model versions that were pruned"""
+    for path in glob.glob(os.path.join(model_dir, f'{prefix}_v*{extension}')):
+        match = re.search(rf'{prefix}_v(\d+){re.escape(extension)}$', path)
+        if match and not os.path.exists(os.path.join(
+                model_dir, ARTIFACT_PATTERN.format(version=int(match.group(1))))):
+            os.remove(path)
+
+def read_current(model_dir=MODEL_DIR):
+    """Contents of current.json, or {} when there is none"""
+    try:
+        with open(os.path.join(model_dir, CURRENT_FILE)) as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return {}
+
+def mark_segmented(segment_by, model_dir=MODEL_DIR):
+    """
+    Record that the current results come from a segmented run. The global
+    model stays on disk for the next warm start, but its cluster numbers no
+    longer match the stored results until a global run replaces them.
+    """
+    os.makedirs(model_dir, exist_ok=True)
+    current = dict(read_current(model_dir), segmented=segment_by)
+    _write_atomic(os.path.join(model_dir, CURRENT_FILE),
+                  lambda handle: handle.write(json.dumps(current).encode()))
+    print(f"[OK] Current results are segmented by {segment_by}")
+
+def check_unsegmented(model):
+    """Raise when the current results are segmented and the global model doesn't describe them"""
+    if model is not None and model.get('segmented'):
+        raise ValueError(f"The current results are segmented by {model['segmented']}; "
+                         f"run a global clustering first")
+
+def activate_model(version, model_dir=MODEL_DIR):
+    """Point current.json at an artifact version; clears any segmented marker"""
+    _write_atomic(
+        os.path.join(model_dir, CURRENT_FILE),
+        lambda handle: handle.write(json.dumps({
+            'version': version, 'path': ARTIFACT_PATTERN.format(version=version)}).encode())
+    )
+
+def save_model_state(kmeans, scaler, label_mapping=None, model_dir=MODEL_DIR,
+                     feature_columns=FEATURE_COLUMNS, activate=True):
+    """
+    Save the fitted scaler, centroids and label mapping as a new artifact
+    version and return the version. With activate=False the current model is
+    left alone until activate_model(), so files saved alongside the artifact
+    can be written before anyone switches to it.
+    """
+    os.makedirs(model_dir, exist_ok=True)
+
+    version, path = _claim_version(model_dir)
+
+    label_mapping = label_mapping or {}
+    clusters = sorted(label_mapping.keys())
+    metadata = {
+        'format': ARTIFACT_FORMAT,
+        'version': version,
+        'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'feature_columns': list(feature_columns),
+        'labels': [label_mapping[c]['label'] for c in clusters]
+    }
+
+    try:
+        _write_atomic(path, lambda handle: np.savez(
+            handle,
+            centers=kmeans.cluster_centers_.astype(np.float64),
+            scaler_mean=scaler.mean_.astype(np.float64),
+            scaler_scale=scaler.scale_.astype(np.float64),
+            feature_divisors=feature_divisors(len(feature_columns)),
+            label_clusters=np.array(clusters, dtype=np.int64),
+            label_scores=np.array([float(label_mapping[c]['avg_score']) for c in clusters]),
+            metadata=np.array(json.dumps(metadata))
+        ))
+    except BaseException:
+        # Release the claimed version rather than leave an empty artifact
+        os.remove(path)
+        raise
+    if activate:
+        activate_model(version, model_dir)
+
+    # Prune old versions, never the one still being served
+    active = read_current(model_dir).get('version')
+    for old in _artifact_versions(model_dir)[:-MODEL_KEEP]:
+        if old != active:
+            try:
+                os.remove(os.path.join(model_dir, ARTIFACT_PATTERN.format(version=old)))
+            except FileNotFoundError:
+                # A concurrent save pruned it already
+                pass
+
+    print(f"[OK] Saved model artifact v{version} to {path}")
+    return version
+
+def load_model_state(model_dir=MODEL_DIR, version=None):
+    """
+    Load the current (or a given) artifact version, or None if there is none.
+    'segmented' is set when the current results come from a segmented run.
+    """
+    segmented = None
+    if version is None:
+        current = read_current(model_dir)
+        segmented = current.get('segmented')
+        version = current.get('version')
+        if version is None:
+            versions = _artifact_versions(model_dir, written_only=True)
+            if not versions:
+                return None
+            version = versions[-1]
+
+    path = os.path.join(model_dir, ARTIFACT_PATTERN.format(version=version))
+    try:
+        with np.load(path) as data:
+            metadata = json.loads(str(data['metadata']))
+            if metadata.get('format') != ARTIFACT_FORMAT:
+                print(f"[ERROR] Model artifact {path} has unsupported format {metadata.get('format')}")
+                return None
+
+            label_mapping = {
+                int(cluster): {'label': label, 'avg_score': float(score)}
+                for cluster, label, score in zip(data['label_clusters'], metadata['labels'],
+                                                 data['label_scores'])
+            }
+            return {
+                'version': metadata['version'],
+                'created_at': metadata['created_at'],
+                'feature_columns': metadata.get('feature_columns', list(FEATURE_COLUMNS)),
+                'centers': data['centers'],
+                'scaler_mean': data['scaler_mean'],
+                'scaler_scale': data['scaler_scale'],
+                'feature_divisors': data['feature_divisors'],
+                'label_mapping': label_mapping,
+                # Segment key when a segmented run replaced this model's results
+                'segmented': segmented
+            }
+    except (OSError, KeyError, ValueError) as e:
+        print(f"[ERROR] Could not read model artifact {path}: {e}")
+        return None
+
+def assign_students(model, raw_features):
+    """
+    Score raw feature rows against a loaded model without refitting.
+    Returns (cluster_numbers, distances) with one entry per row.
+    """
+    raw_features = np.atleast_2d(np.asarray(raw_features, dtype=np.float64))
+    if raw_features.shape[1] != len(model['feature_divisors']):
+        raise ValueError(f"Model expects {len(model['feature_divisors'])} features, "
+                         f"got {raw_features.shape[1]}")
+
+    standardized = (raw_features / model['feature_divisors'] - model['scaler_mean']) / model['scaler_scale']
+
+    # Squared distances to every centroid: ||x||^2 - 2 x.c + ||c||^2
+    centers = model['centers']
+    distances = (
+        np.einsum('ij,ij->i', standardized, standardized)[:, None]
+        - 2.0 * standardized @ centers.T
+        + np.einsum('ij,ij->i', centers, centers)[None, :]
+    )
+    clusters = np.argmin(distances, axis=1)
+    nearest = np.sqrt(np.maximum(distances[np.arange(len(clusters)), clusters], 0.0))
+
+    return clusters, nearest
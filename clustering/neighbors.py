@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Similar Students Index
+Nearest-neighbor tree over a full run's standardized features, saved next
+to that run's model artifact so peers of any student are found in
+O(log n) per query instead of comparing against every student
+"""
+
+import os
+import pickle
+import time
+from datetime import datetime
+
+import numpy as np
+from sklearn.neighbors import BallTree, KDTree
+
+from model_store import MODEL_DIR, _write_atomic, prune_run_files
+
+NEIGHBORS_PATTERN = 'neighbors_v{version:04d}.pkl'
+
+# Bump when the saved index layout changes
+NEIGHBORS_FORMAT = 1
+
+# KD-trees degrade towards brute force in high dimensions, so the extended
+# feature set (41 columns) gets a ball tree instead
+KDTREE_MAX_DIMS = 16
+NEIGHBORS_LEAF_SIZE = 40
+
+# Limits on one query
+DEFAULT_NEIGHBORS = 10
+MAX_NEIGHBORS = 100
+MAX_QUERY_STUDENTS = 1000
+
+class NeighborIndex:
+    """
+    Tree over the standardized feature rows of one run, with the user id,
+    cluster number and cluster label of every row
+    """
+
+    def __init__(self, model_version, user_ids, features, cluster_labels, label_mapping,
+                 leaf_size=NEIGHBORS_LEAF_SIZE):
+        started = time.perf_counter()
+        features = np.asarray(features, dtype=np.float64)
+        tree_class = KDTree if features.shape[1] <= KDTREE_MAX_DIMS else BallTree
+
+        self.model_version = model_version
+        self.user_ids = np.asarray(user_ids, dtype=np.int64)
+        self.clusters = np.asarray(cluster_labels, dtype=np.int64)
+        self.labels = {int(cluster): info['label'] for cluster, info in label_mapping.items()}
+        self.tree = tree_class(features, leaf_size=leaf_size)
+        self.created_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.build_seconds = time.perf_counter() - started
+
+        # Rows sorted by user_id, for lookups
+        self._order = np.argsort(self.user_ids, kind='stable')
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def rows(self, user_ids):
+        """Tree rows of the given students; -1 for students not in the index"""
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        sorted_ids = self.user_ids[self._order]
+        positions = np.minimum(np.searchsorted(sorted_ids, user_ids), len(sorted_ids) - 1)
+        found = sorted_ids[positions] == user_ids if len(sorted_ids) else np.zeros(len(user_ids), bool)
+        return np.where(found, self._order[positions], -1)
+
+    def query_rows(self, rows, k=DEFAULT_NEIGHBORS):
+        """
+        (distances, rows) of the k nearest other students of every given row,
+        closest first; a student is never listed as their own peer
+        """
+        rows = np.asarray(rows, dtype=np.intp)
+        k = min(k, len(self.user_ids) - 1)
+        if k < 1:
+            raise ValueError('The index needs at least 2 students')
+        vectors = np.asarray(self.tree.get_arrays()[0])[rows]
+        distances, neighbors = self.tree.query(vectors, k=k + 1)
+
+        # Drop the student themself, or the farthest hit when duplicates of
+        # their vector pushed them out of the first k + 1
+        keep = neighbors != rows[:, None]
+        keep[keep.all(axis=1), -1] = False
+        return distances[keep].reshape(len(rows), k), neighbors[keep].reshape(len(rows), k)
+
+    def query_vectors(self, vectors, k=DEFAULT_NEIGHBORS):
+        """(distances, rows) of the k nearest students to standardized vectors"""
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float64))
+        return self.tree.query(vectors, k=min(k, len(self.user_ids)))
+
+    def peers(self, distances, rows):
+        """Response entries for one query's neighbors"""
+        return [
+            {
+                'user_id': int(self.user_ids[row]),
+                'cluster_number': int(self.clusters[row]),
+                'cluster_label': self.labels.get(int(self.clusters[row])),
+                'distance': round(float(distance), 4)
+            }
+            for distance, row in zip(distances, rows)
+        ]
+
+def build_neighbor_index(model, user_ids, features, cluster_labels):
+    """Index one run's standardized features under the run's model version"""
+    index = NeighborIndex(model['version'], user_ids, features, cluster_labels, model['label_mapping'])
+    print(f"[OK] Built {type(index.tree).__name__} neighbor index over {len(index)} students "
+          f"({index.build_seconds:.2f}s)")
+    return index
+
+def save_neighbor_index(index, model_dir=MODEL_DIR):
+    """Write the index next to its model artifact and drop indexes of pruned models"""
+    os.makedirs(model_dir, exist_ok=True)
+    path = os.path.join(model_dir, NEIGHBORS_PATTERN.format(version=index.model_version))
+    _write_atomic(path, lambda handle: pickle.dump(
+        {'format': NEIGHBORS_FORMAT, 'index': index}, handle, protocol=pickle.HIGHEST_PROTOCOL))
+
+    prune_run_files(model_dir, 'neighbors', '.pkl')
+
+    print(f"[OK] Saved neighbor index for model v{index.model_version} to {path}")
+    return path
+
+def load_neighbor_index(model, model_dir=MODEL_DIR):
+    """Saved index of the given model, or None when the model has none"""
+    if model is None:
+        return None
+    path = os.path.join(model_dir, NEIGHBORS_PATTERN.format(version=model['version']))
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, 'rb') as handle:
+            saved = pickle.load(handle)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError) as e:
+        print(f"[ERROR] Could not read neighbor index {path}: {e}")
+        return None
+    if saved.get('format') != NEIGHBORS_FORMAT:
+        print(f"[ERROR] Neighbor index {path} has unsupported format {saved.get('format')}")
+        return None
+    return saved['index']
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Online Cluster Updates
+Folds newly completed game sessions into the current clustering without a
+refit: affected students are re-scored, running centroids are kept as
+per-cluster sufficient statistics, and drift metrics decide when a full
+refit is due
+"""
+
+import json
+import os
+from datetime import datetime
+
+import numpy as np
+
+from feature_builder import load_game_features
+from feature_store import (LOWER_BOUND_ALL, LOWER_BOUND_OVERLAP, LOWER_BOUND_WATERMARK,
+                           latest_completed_session, overlap_start)
+from features import FEATURE_COLUMNS, fetch_user_features, stream_feature_matrix
+from model_store import MODEL_DIR, assign_students, check_unsegmented
+from result_writer import RESULT_BATCH_SIZE, save_clustering_results
+
+ONLINE_STATE_FILE = 'online_state.npz'
+
+# Bump when the state layout changes
+ONLINE_STATE_FORMAT = 1
+
+# A full refit is due when any drift metric crosses its threshold:
+# largest centroid move since the last fit, in standard deviations
+DRIFT_CENTROID_SHIFT = 0.5
+# share of students whose cluster differs from the last fit
+DRIFT_LABEL_CHURN = 0.10
+# growth of the mean squared distance to the assigned centroid
+DRIFT_INERTIA_GROWTH = 0.20
+
+# Students with sessions in the window, up to the (completed_at, session_id)
+# mark, and how many of their sessions are past the previous mark ({new_sessions})
+CHANGED_STUDENTS_QUERY = """
+    SELECT gs.user_id, SUM(CASE WHEN {new_sessions} THEN 1 ELSE 0 END) AS sessions
+    FROM game_sessions gs
+    WHERE gs.completed_at IS NOT NULL
+        AND {lower_bound}
+        AND (gs.completed_at < %(hi_at)s
+             OR (gs.completed_at = %(hi_at)s AND gs.session_id <= %(hi_id)s))
+    GROUP BY gs.user_id
+"""
+
+def session_watermark(connection):
+    """(completed_at, session_id) of the latest completed session, or None"""
+    cursor = connection.cursor()
+    latest = latest_completed_session(cursor)
+    cursor.close()
+    return None if latest is None else (str(latest[0]), int(latest[1]))
+
+def standardize_for_model(model, raw_features):
+    """Raw feature rows in the model's standardized space"""
+    raw_features = np.atleast_2d(np.asarray(raw_features, dtype=np.float64))
+    return (raw_features / model['feature_divisors'] - model['scaler_mean']) / model['scaler_scale']
+
+class OnlineClusters:
+    """
+    Per-student standardized vectors and cluster assignments, with per-cluster
+    counts, vector sums and squared-norm sums from which the running
+    centroids and inertia follow exactly
+    """
+
+    def __init__(self, model_version, user_ids, vectors, labels, baseline_labels,
+                 baseline_centers, baseline_inertia, watermark, metadata=None):
+        order = np.argsort(user_ids)
+        self.model_version = model_version
+        self.user_ids = np.asarray(user_ids, dtype=np.int64)[order]
+        self.vectors = np.asarray(vectors, dtype=np.float64)[order]
+        self.labels = np.asarray(labels, dtype=np.int64)[order]
+        self.baseline_labels = np.asarray(baseline_labels, dtype=np.int64)[order]
+        self.baseline_centers = np.asarray(baseline_centers, dtype=np.float64)
+        self.baseline_inertia = float(baseline_inertia)
+        self.watermark = tuple(watermark) if watermark else None
+        self.metadata = metadata or {'sessions_processed': 0, 'students_updated': 0}
+
+        n_clusters = len(self.baseline_centers)
+        self.counts = np.bincount(self.labels, minlength=n_clusters).astype(np.float64)
+        self.sums = np.zeros_like(self.baseline_centers)
+        np.add.at(self.sums, self.labels, self.vectors)
+        self.sq_sums = np.bincount(self.labels, weights=np.einsum('ij,ij->i', self.vectors, self.vectors),
+                                   minlength=n_clusters)
+
+    @classmethod
+    def from_assignment(cls, model, user_ids, vectors, labels, watermark):
+        """Start tracking from a full fit (or a bootstrap assignment); it becomes the drift baseline"""
+        state = cls(model['version'], user_ids, vectors, labels, labels,
+                    model['centers'], 0.0, watermark)
+        state.baseline_centers = state.centers()
+        state.baseline_inertia = state.mean_inertia()
+        return state
+
+    def centers(self):
+        """Running centroids; a cluster that lost every student keeps its baseline centroid"""
+        centers = self.baseline_centers.copy()
+        occupied = self.counts > 0
+        centers[occupied] = self.sums[occupied] / self.counts[occupied, None]
+        return centers
+
+    def mean_inertia(self):
+        """Mean squared distance of a student to its cluster's centroid"""
+        if not len(self.user_ids):
+            return 0.0
+        occupied = self.counts > 0
+        sq_norms = np.einsum('ij,ij->i', self.sums[occupied], self.sums[occupied])
+        inertia = float(np.sum(self.sq_sums[occupied] - sq_norms / self.counts[occupied]))
+        return max(inertia, 0.0) / len(self.user_ids)
+
+    def update(self, user_ids, vectors):
+        """
+        Replace (or add) the students' vectors and move each to the nearest
+        running centroid. Returns their new cluster numbers.
+        """
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float64))
+        if not len(user_ids):
+            return np.empty(0, dtype=np.int64)
+
+        # Take the students out of their clusters' statistics first
+        position = np.searchsorted(self.user_ids, user_ids).clip(0, max(len(self.user_ids) - 1, 0))
+        known = (self.user_ids[position] == user_ids) if len(self.user_ids) else np.zeros(len(user_ids), bool)
+        old = position[known]
+        np.subtract.at(self.counts, self.labels[old], 1.0)
+        np.subtract.at(self.sums, self.labels[old], self.vectors[old])
+        np.subtract.at(self.sq_sums, self.labels[old], np.einsum('ij,ij->i', self.vectors[old], self.vectors[old]))
+
+        # Nearest running centroid, then put them back with their new vectors
+        centers = self.centers()
+        distances = (np.einsum('ij,ij->i', vectors, vectors)[:, None] - 2.0 * vectors @ centers.T
+                     + np.einsum('ij,ij->i', centers, centers)[None, :])
+        labels = np.argmin(distances, axis=1).astype(np.int64)
+
+        np.add.at(self.counts, labels, 1.0)
+        np.add.at(self.sums, labels, vectors)
+        np.add.at(self.sq_sums, labels, np.einsum('ij,ij->i', vectors, vectors))
+
+        self.vectors[old] = vectors[known]
+        self.labels[old] = labels[known]
+
+        if not known.all():
+            # New students have no baseline cluster of their own: use their first one
+            new = ~known
+            user_order = np.concatenate([self.user_ids, user_ids[new]])
+            order = np.argsort(user_order, kind='stable')
+            self.user_ids = user_order[order]
+            self.vectors = np.concatenate([self.vectors, vectors[new]])[order]
+            self.labels = np.concatenate([self.labels, labels[new]])[order]
+            self.baseline_labels = np.concatenate([self.baseline_labels, labels[new]])[order]
+
+        return labels
+
+    def drift(self):
+        """Drift metrics against the baseline and whether any crosses its threshold"""
+        shift = np.linalg.norm(self.centers() - self.baseline_centers, axis=1)
+        churn = float(np.mean(self.labels != self.baseline_labels)) if len(self.labels) else 0.0
+        inertia = self.mean_inertia()
+        growth = inertia / self.baseline_inertia - 1.0 if self.baseline_inertia > 0 else 0.0
+
+        reasons = []
+        if shift.max(initial=0.0) > DRIFT_CENTROID_SHIFT:
+            reasons.append('centroid_shift')
+        if churn > DRIFT_LABEL_CHURN:
+            reasons.append('label_churn')
+        if growth > DRIFT_INERTIA_GROWTH:
+            reasons.append('inertia_growth')
+
+        return {
+            'centroid_shift': round(float(shift.max(initial=0.0)), 4),
+            'label_churn': round(churn, 4),
+            'inertia_growth': round(growth, 4),
+            'refit': bool(reasons),
+            'reasons': reasons
+        }
+
+    def save(self, model_dir=MODEL_DIR):
+        """Write the state next to the model artifacts"""
+        os.makedirs(model_dir, exist_ok=True)
+        metadata = dict(self.metadata, format=ONLINE_STATE_FORMAT, model_version=self.model_version,
+                        watermark=list(self.watermark) if self.watermark else None,
+                        baseline_inertia=self.baseline_inertia,
+                        updated_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        # Temp file then rename, so a reader never sees a partial state
+        path = os.path.join(model_dir, ONLINE_STATE_FILE)
+        with open(path + '.tmp', 'wb') as handle:
+            np.savez(handle, user_ids=self.user_ids, vectors=self.vectors, labels=self.labels,
+                     baseline_labels=self.baseline_labels, baseline_centers=self.baseline_centers,
+                     metadata=np.array(json.dumps(metadata)))
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, model, model_dir=MODEL_DIR):
+        """Saved state for the given model, or None when missing or from another model version"""
+        path = os.path.join(model_dir, ONLINE_STATE_FILE)
+        if model is None or not os.path.exists(path):
+            return None
+
+        with np.load(path) as data:
+            metadata = json.loads(str(data['metadata']))
+            if metadata.get('format') != ONLINE_STATE_FORMAT or metadata.get('model_version') != model['version']:
+                return None
+            return cls(metadata['model_version'], data['user_ids'], data['vectors'], data['labels'],
+                       data['baseline_labels'], data['baseline_centers'], metadata['baseline_inertia'],
+                       metadata['watermark'], {key: metadata[key] for key in ('sessions_processed', 'students_updated')})
+
+def reset_online_state(model, user_ids, features, cluster_labels, watermark, model_dir=MODEL_DIR):
+    """Start online tracking from a full run's standardized features and labels"""
+    state = OnlineClusters.from_assignment(model, user_ids, features, cluster_labels, watermark)
+    state.save(model_dir)
+    print(f"[OK] Online state reset to model v{model['version']} ({len(state.user_ids)} students)")
+    return state
+
+def _student_features(connection, model, user_ids):
+    """Current raw features of the given students, in the model's columns"""
+    found_ids, raw_features = fetch_user_features(connection, user_ids)
+    if len(model['feature_columns']) > len(FEATURE_COLUMNS):
+        game_features = load_game_features(connection, found_ids, filter_users=True)
+        raw_features = np.hstack([raw_features, game_features])
+    return found_ids, raw_features
+
+def bootstrap_online_state(connection, model, model_dir=MODEL_DIR):
+    """Assign every student to the current model's centroids and start tracking from there"""
+    watermark = session_watermark(connection)
+    user_ids, raw_features = stream_feature_matrix(connection, 'full')
+    if len(model['feature_columns']) > len(FEATURE_COLUMNS):
+        raw_features = np.hstack([raw_features, load_game_features(connection, user_ids)])
+
+    labels, _ = assign_students(model, raw_features)
+    return reset_online_state(model, user_ids, standardize_for_model(model, raw_features),
+                              labels, watermark, model_dir)
+
+def apply_new_sessions(connection, model, state=None, batch_size=RESULT_BATCH_SIZE, model_dir=MODEL_DIR):
+    """
+    Fold sessions completed since the state's watermark into the clustering:
+    re-score the students who played, update the running centroids, replace
+    those students' clustering_results rows and save the state.
+    Returns a summary with the drift metrics; 'refit' says a full run is due.
+    """
+    if model is None:
+        raise ValueError("No clustering model available, run a full clustering first")
+    check_unsegmented(model)
+
+    state = state or OnlineClusters.load(model, model_dir)
+    if state is None:
+        print("[WARNING] No online state for the current model, assigning all students")
+        state = bootstrap_online_state(connection, model, model_dir)
+
+    latest = session_watermark(connection)
+    summary = {'sessions': 0, 'students': 0, 'reassigned': 0, 'watermark': latest}
+
+    if latest is not None and (state.watermark is None or latest > state.watermark):
+        params = {'hi_at': latest[0], 'hi_id': latest[1]}
+        if state.watermark is None:
+            lower_bound = new_sessions = LOWER_BOUND_ALL
+        else:
+            # Students whose sessions committed late, behind the previous
+            # mark, are re-scored too; their rows are replaced, not added
+            lower_bound, new_sessions = LOWER_BOUND_OVERLAP, LOWER_BOUND_WATERMARK
+            params['lo_at'], params['lo_id'] = state.watermark
+            params['since'] = overlap_start(state.watermark[0])
+
+        cursor = connection.cursor()
+        cursor.execute(CHANGED_STUDENTS_QUERY.format(lower_bound=lower_bound, new_sessions=new_sessions),
+                       params)
+        changed = cursor.fetchall()
+        cursor.close()
+
+        user_ids, raw_features = _student_features(connection, model, [row[0] for row in changed])
+        if len(user_ids):
+            position = np.searchsorted(state.user_ids, user_ids).clip(0, max(len(state.user_ids) - 1, 0))
+            if len(state.user_ids):
+                known = state.user_ids[position] == user_ids
+                previous = state.labels[position]
+            else:
+                # Nobody tracked yet, e.g. bootstrapped before any student played
+                known = np.zeros(len(user_ids), dtype=bool)
+                previous = np.full(len(user_ids), -1, dtype=np.int64)
+            labels = state.update(user_ids, standardize_for_model(model, raw_features))
+            summary['reassigned'] = int(np.sum(known & (labels != previous)))
+
+            save_clustering_results(connection, labels, user_ids, raw_features,
+                                    model['label_mapping'], batch_size, replace_all=False)
+
+        summary['sessions'] = int(sum(int(row[1]) for row in changed))
+        summary['students'] = int(len(user_ids))
+        state.watermark = latest
+        state.metadata['sessions_processed'] += summary['sessions']
+        state.metadata['students_updated'] += summary['students']
+        state.save(model_dir)
+
+    summary['drift'] = state.drift()
+    drift = summary['drift']
+    print(f"[OK] Online update: {summary['sessions']} sessions, {summary['students']} students, "
+          f"{summary['reassigned']} changed cluster")
+    print(f"  Drift: centroid shift {drift['centroid_shift']:.3f}, label churn {drift['label_churn']:.1%}, "
+          f"inertia growth {drift['inertia_growth']:+.1%}")
+    if drift['refit']:
+        print(f"[WARNING] Drift threshold crossed ({', '.join(drift['reasons'])}), full refit needed")
+    return summary
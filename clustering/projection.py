@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cluster Projection
+2D PCA embedding of a full run's standardized features, saved next to the
+run's model artifact together with a fixed plotting sample and per-cluster
+density grid, so scatter plots are served without touching every student
+"""
+
+import hashlib
+import json
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+from sklearn.decomposition import PCA
+
+from features import STANDARDIZE_BLOCK_ROWS
+from model_store import MODEL_DIR, _write_atomic, prune_run_files
+
+PROJECTION_PATTERN = 'projection_v{version:04d}.npz'
+
+# Bump when the saved projection layout changes
+PROJECTION_FORMAT = 1
+
+# 'covariance' takes the top eigenvectors of the column covariance, summed
+# over row blocks: for a few dozen columns it beats both SVD solvers and makes
+# no centered copy. 'auto' uses it up to COVARIANCE_MAX_COLUMNS columns, which
+# covers both feature sets; only wider matrices fall back to SVD (randomized
+# above RANDOMIZED_SVD_ROWS students, full below).
+PROJECTION_SOLVERS = ('auto', 'covariance', 'full', 'randomized')
+COVARIANCE_MAX_COLUMNS = 256
+RANDOMIZED_SVD_ROWS = 100000
+
+# Points kept for scatter plots, and the default number sent
+PROJECTION_MAX_POINTS = 5000
+DEFAULT_PLOT_POINTS = 2000
+# Point counts whose response bodies are kept; other sizes are built per request
+CACHED_PLOT_POINTS = (DEFAULT_PLOT_POINTS, PROJECTION_MAX_POINTS)
+
+# Density grid kept per cluster; coarser grids are summed from it
+PROJECTION_GRID = 64
+# The grid spans these percentiles of each axis so a few outliers don't squeeze
+# everyone into one cell; students beyond them fall in the edge cells
+PROJECTION_BOUNDS_PERCENTILES = (0.5, 99.5)
+PROJECTION_BIN_SIZES = (8, 16, 32, 64)
+DEFAULT_BINS = 32
+
+def _covariance_pca(features):
+    """(coordinates, explained variance ratios) from the eigenvectors of the covariance matrix"""
+    blocks = range(0, len(features), STANDARDIZE_BLOCK_ROWS)
+    mean = features.mean(axis=0, dtype=np.float64)
+
+    covariance = np.zeros((features.shape[1], features.shape[1]))
+    for start in blocks:
+        block = features[start:start + STANDARDIZE_BLOCK_ROWS] - mean
+        covariance += block.T @ block
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance / max(len(features) - 1, 1))
+
+    # Largest two first; signs fixed so the largest loading is positive, as sklearn does
+    components = eigenvectors[:, ::-1][:, :2].T
+    components *= np.sign(components[np.arange(2), np.abs(components).argmax(axis=1)])[:, None]
+
+    coordinates = np.empty((len(features), 2), dtype=np.float32)
+    for start in blocks:
+        coordinates[start:start + STANDARDIZE_BLOCK_ROWS] = \
+            (features[start:start + STANDARDIZE_BLOCK_ROWS] - mean) @ components.T
+    return coordinates, eigenvalues[::-1][:2] / max(eigenvalues.sum(), 1e-12)
+
+def fit_projection(features, solver='auto', seed=42):
+    """(coordinates, explained variance ratios, solver used) of a 2D PCA of standardized features"""
+    if solver not in PROJECTION_SOLVERS:
+        raise ValueError(f'Unknown projection solver: {solver}')
+    if solver == 'auto':
+        if features.shape[1] <= COVARIANCE_MAX_COLUMNS:
+            solver = 'covariance'
+        else:
+            solver = 'randomized' if len(features) > RANDOMIZED_SVD_ROWS else 'full'
+
+    if solver == 'covariance':
+        coordinates, explained_variance = _covariance_pca(features)
+        return coordinates, explained_variance, solver
+
+    pca = PCA(n_components=2, svd_solver=solver, random_state=seed)
+    coordinates = pca.fit_transform(features)
+    return coordinates, pca.explained_variance_ratio_, solver
+
+def plot_order(clusters, seed=42):
+    """
+    Row order in which every prefix is a stratified sample: each cluster's
+    rows are shuffled and interleaved in proportion to the cluster's size,
+    and every cluster's first row comes first so small clusters always show
+    """
+    rng = np.random.default_rng(seed)
+    keys = np.empty(len(clusters), dtype=np.float64)
+    for cluster in np.unique(clusters):
+        rows = np.flatnonzero(clusters == cluster)
+        keys[rng.permutation(rows)] = np.arange(len(rows)) / len(rows)
+    return np.argsort(keys, kind='stable')
+
+class Projection:
+    """
+    Coordinates of every student (float16) with the precomputed plotting
+    sample and density grid the endpoint answers from
+    """
+
+    def __init__(self, model_version, user_ids, coordinates, clusters, labels, explained_variance,
+                 solver, sample=None, grid=None, created_at=None):
+        self.model_version = model_version
+        self.user_ids = np.asarray(user_ids, dtype=np.int64)
+        self.coordinates = np.asarray(coordinates, dtype=np.float16)
+        self.clusters = np.asarray(clusters, dtype=np.int64)
+        self.labels = {int(cluster): label for cluster, label in labels.items()}
+        self.explained_variance = [round(float(ratio), 4) for ratio in explained_variance]
+        self.solver = solver
+        self.created_at = created_at or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+        coordinates = self.coordinates.astype(np.float64)
+        if len(coordinates):
+            low, high = np.percentile(coordinates, PROJECTION_BOUNDS_PERCENTILES, axis=0)
+            self.bounds = [float(low[0]), float(high[0]), float(low[1]), float(high[1])]
+        else:
+            self.bounds = [0.0, 0.0, 0.0, 0.0]
+        self.sample = plot_order(self.clusters)[:PROJECTION_MAX_POINTS] if sample is None else np.asarray(sample)
+        self.grid = self._grid(coordinates) if grid is None else np.asarray(grid)
+        self.cluster_numbers = sorted(self.labels)
+
+        self.etag = hashlib.sha1(f'{self.model_version}:{self.created_at}'.encode()).hexdigest()
+
+        # Response bodies per (mode, size), built on first request. Only the
+        # fixed bin sizes and CACHED_PLOT_POINTS are kept, so callers can't
+        # grow it with arbitrary max_points.
+        self._payloads = {}
+
+    def _grid(self, coordinates):
+        """Students per (cluster, x bin, y bin) over the bounds"""
+        cells = []
+        for axis in (0, 1):
+            low, high = self.bounds[2 * axis], self.bounds[2 * axis + 1]
+            scaled = (coordinates[:, axis] - low) / ((high - low) or 1.0) * PROJECTION_GRID
+            cells.append(np.clip(scaled.astype(np.int64), 0, PROJECTION_GRID - 1))
+
+        cluster_numbers = np.array(sorted(self.labels), dtype=np.int64)
+        slots = np.searchsorted(cluster_numbers, self.clusters)
+        flat = (slots * PROJECTION_GRID + cells[0]) * PROJECTION_GRID + cells[1]
+        return np.bincount(flat, minlength=len(cluster_numbers) * PROJECTION_GRID ** 2).reshape(
+            len(cluster_numbers), PROJECTION_GRID, PROJECTION_GRID).astype(np.int32)
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def _header(self):
+        counts = self.grid.sum(axis=(1, 2))
+        return {
+            'model_version': self.model_version,
+            'created_at': self.created_at,
+            'students': len(self),
+            'solver': self.solver,
+            'explained_variance': self.explained_variance,
+            'bounds': [round(bound, 3) for bound in self.bounds],
+            'clusters': [
+                {'cluster_number': cluster, 'cluster_label': self.labels[cluster], 'student_count': int(count)}
+                for cluster, count in zip(self.cluster_numbers, counts)
+            ]
+        }
+
+    def points(self, max_points=DEFAULT_PLOT_POINTS):
+        """Stratified sample of at most max_points students, as parallel lists"""
+        max_points = min(max(int(max_points), 1), PROJECTION_MAX_POINTS)
+        payload = self._payloads.get(('points', max_points))
+        if payload is None:
+            rows = self.sample[:max_points]
+            xy = self.coordinates[rows].astype(np.float64).round(3)
+            payload = dict(self._header(), mode='points', points={
+                'user_id': self.user_ids[rows].tolist(),
+                'x': xy[:, 0].tolist(),
+                'y': xy[:, 1].tolist(),
+                'cluster': self.clusters[rows].tolist()
+            })
+            if max_points in CACHED_PLOT_POINTS:
+                self._payloads[('points', max_points)] = payload
+        return payload
+
+    def bins(self, bins=DEFAULT_BINS):
+        """Non-empty cells of a bins x bins grid as [x_bin, y_bin, cluster, students]"""
+        if bins not in PROJECTION_BIN_SIZES:
+            raise ValueError(f"bins must be one of {', '.join(map(str, PROJECTION_BIN_SIZES))}")
+        payload = self._payloads.get(('bins', bins))
+        if payload is None:
+            step = PROJECTION_GRID // bins
+            grid = self.grid.reshape(len(self.grid), bins, step, bins, step).sum(axis=(2, 4))
+            slots, xs, ys = np.nonzero(grid)
+            cells = np.column_stack([xs, ys, np.array(self.cluster_numbers, dtype=np.int64)[slots],
+                                     grid[slots, xs, ys]])
+            payload = dict(self._header(), mode='bins', bins=bins, cells=cells.tolist())
+            self._payloads[('bins', bins)] = payload
+        return payload
+
+def build_projection(model, user_ids, features, cluster_labels, solver='auto'):
+    """Project one run's standardized features under the run's model version"""
+    started = time.perf_counter()
+    coordinates, explained_variance, solver = fit_projection(features, solver)
+    projection = Projection(model['version'], user_ids, coordinates, cluster_labels,
+                            {cluster: info['label'] for cluster, info in model['label_mapping'].items()},
+                            explained_variance, solver)
+    print(f"[OK] Projected {len(projection)} students to 2D ({solver} PCA, "
+          f"{sum(projection.explained_variance):.0%} of variance, {time.perf_counter() - started:.2f}s)")
+    return projection
+
+def save_projection(projection, model_dir=MODEL_DIR):
+    """Write the projection next to its model artifact and drop those of pruned models"""
+    os.makedirs(model_dir, exist_ok=True)
+    path = os.path.join(model_dir, PROJECTION_PATTERN.format(version=projection.model_version))
+    metadata = {
+        'format': PROJECTION_FORMAT,
+        'model_version': projection.model_version,
+        'created_at': projection.created_at,
+        'solver': projection.solver,
+        'explained_variance': projection.explained_variance,
+        'labels': {str(cluster): label for cluster, label in projection.labels.items()}
+    }
+    _write_atomic(path, lambda handle: np.savez_compressed(
+        handle,
+        user_ids=projection.user_ids,
+        coordinates=projection.coordinates,
+        clusters=projection.clusters.astype(np.int16),
+        sample=projection.sample,
+        grid=projection.grid,
+        metadata=np.array(json.dumps(metadata))
+    ))
+    prune_run_files(model_dir, 'projection', '.npz')
+
+    print(f"[OK] Saved projection for model v{projection.model_version} to {path}")
+    return path
+
+def load_projection(model, model_dir=MODEL_DIR):
+    """Saved projection of the given model, or None when the model has none"""
+    if model is None:
+        return None
+    path = os.path.join(model_dir, PROJECTION_PATTERN.format(version=model['version']))
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with np.load(path) as data:
+            metadata = json.loads(str(data['metadata']))
+            if metadata.get('format') != PROJECTION_FORMAT:
+                print(f"[ERROR] Projection {path} has unsupported format {metadata.get('format')}")
+                return None
+            return Projection(metadata['model_version'], data['user_ids'], data['coordinates'],
+                              data['clusters'], metadata['labels'], metadata['explained_variance'],
+                              metadata['solver'], data['sample'], data['grid'], metadata['created_at'])
+    except (OSError, KeyError, ValueError) as e:
+        print(f"[ERROR] Could not read projection {path}: {e}")
+        return None
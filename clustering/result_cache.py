@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Clustering Result Cache
+Stores finished run results keyed by a fingerprint of the input data and the
+run parameters, so repeated requests on unchanged data skip reclustering
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+# Cache database lives next to the scripts unless CLUSTERING_RESULT_CACHE is set
+RESULT_CACHE_PATH = os.environ.get(
+    'CLUSTERING_RESULT_CACHE',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models', 'result_cache.sqlite3')
+)
+
+# Seconds a cached result stays valid even when the data has not changed
+RESULT_CACHE_TTL = 3600
+
+# Parameters that do not change the result
+UNCACHED_PARAMS = ('profile', 'shards')
+
+# The history tables are only read through indexed MAX lookups (the primary
+# key, idx_completed), so the cost doesn't grow with them. Sessions are
+# inserted when they complete, which raises max_session_id and
+# last_completed_at. The two per-student tables are read in full, one row per
+# student: the active-user count (idx_active) catches (de)activated users and
+# MAX(updated_at) any progress change. Deleted or edited sessions aren't
+# seen; entries expire after RESULT_CACHE_TTL, and use_cache=false forces a run.
+FINGERPRINT_QUERY = """
+    SELECT
+        (SELECT COALESCE(MAX(session_id), 0) FROM game_sessions) AS max_session_id,
+        (SELECT MAX(completed_at) FROM game_sessions) AS last_completed_at,
+        (SELECT COUNT(*) FROM users WHERE is_active = 1) AS active_users,
+        (SELECT MAX(updated_at) FROM student_progress) AS progress_updated_at
+"""
+
+# What is persisted in clustering_results, from two indexed MAX lookups: every
+# write inserts rows, raising the max id (primary key) and the latest
+# analysis_date (idx_analysis_date). The only write that inserts nothing, a
+# delta write that just clears students who left, comes from a run on
+# different inputs, whose fingerprint already differs.
+RESULTS_MARKER_QUERY = """
+    SELECT
+        (SELECT COALESCE(MAX(cluster_id), 0) FROM clustering_results) AS max_result_id,
+        (SELECT MAX(analysis_date) FROM clustering_results) AS last_analysis_date
+"""
+
+CREATE_CACHE_TABLE = """
+    CREATE TABLE IF NOT EXISTS result_cache (
+        cache_key TEXT PRIMARY KEY,
+        fingerprint TEXT NOT NULL,
+        params TEXT NOT NULL,
+        result TEXT NOT NULL,
+        created_at REAL NOT NULL
+    )
+"""
+
+def dataset_fingerprint(connection):
+    """Current high-water marks of the clustering inputs"""
+    cursor = connection.cursor(dictionary=True)
+    cursor.execute(FINGERPRINT_QUERY)
+    row = cursor.fetchone()
+    cursor.close()
+
+    # Timestamps and Decimals become strings so the fingerprint is JSON-stable
+    return {column: (value if isinstance(value, int) or value is None else str(value))
+            for column, value in row.items()}
+
+def results_marker(connection):
+    """Last-write marker of clustering_results"""
+    cursor = connection.cursor(dictionary=True)
+    cursor.execute(RESULTS_MARKER_QUERY)
+    row = cursor.fetchone()
+    cursor.close()
+    return {column: (value if isinstance(value, int) or value is None else str(value))
+            for column, value in row.items()}
+
+def cache_key(fingerprint, params, marker):
+    """Hash of the data fingerprint, the results marker and the result-relevant parameters"""
+    relevant = {name: value for name, value in params.items() if name not in UNCACHED_PARAMS}
+    payload = json.dumps({'fingerprint': fingerprint, 'results': marker, 'params': relevant},
+                         sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+class ResultCache:
+    """SQLite-backed store of run results, shared by all app processes"""
+
+    def __init__(self, db_path=RESULT_CACHE_PATH, ttl=RESULT_CACHE_TTL):
+        self.db_path = db_path
+        self.ttl = ttl
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with self._connect() as db:
+            db.execute(CREATE_CACHE_TABLE)
+
+    def _connect(self):
+        db = sqlite3.connect(self.db_path, timeout=30)
+        db.execute("PRAGMA journal_mode=WAL")
+        return db
+
+    def get(self, key):
+        """Cached result for the key, or None when missing or older than the TTL"""
+        db = self._connect()
+        try:
+            row = db.execute(
+                "SELECT result, fingerprint, created_at FROM result_cache WHERE cache_key = ? AND created_at >= ?",
+                (key, time.time() - self.ttl)
+            ).fetchone()
+        finally:
+            db.close()
+
+        if row is None:
+            return None
+
+        result = json.loads(row[0])
+        result['cache'] = {
+            'hit': True,
+            'fingerprint': json.loads(row[1]),
+            'age_seconds': round(time.time() - row[2], 1)
+        }
+        return result
+
+    def put(self, key, fingerprint, params, result):
+        """Store a successful run result and drop expired entries"""
+        now = time.time()
+        db = self._connect()
+        try:
+            with db:
+                db.execute(
+                    "INSERT OR REPLACE INTO result_cache (cache_key, fingerprint, params, result, created_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (key, json.dumps(fingerprint), json.dumps(params), json.dumps(result), now)
+                )
+                db.execute("DELETE FROM result_cache WHERE created_at < ?", (now - self.ttl,))
+        finally:
+            db.close()
+
+    def invalidate(self, key=None):
+        """Drop one entry, or every entry when key is None; returns the number removed"""
+        db = self._connect()
+        try:
+            with db:
+                if key is None:
+                    removed = db.execute("DELETE FROM result_cache").rowcount
+                else:
+                    removed = db.execute("DELETE FROM result_cache WHERE cache_key = ?", (key,)).rowcount
+        finally:
+            db.close()
+
+        print(f"[OK] Invalidated {removed} cached clustering result(s)")
+        return removed
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Clustering Result Writer
+Persists clustering results with batched multi-row writes in one transaction,
+and compacts the history of non-current rows
+"""
+
+import json
+import time
+from datetime import datetime, timedelta
+
+from features import (ACCURACY, AVG_TIME, GAMES_PLAYED, LITERACY, MATH,
+                      TOTAL_HINTS, TOTAL_SCORE)
+
+# Rows per multi-row INSERT / per is_current UPDATE
+RESULT_BATCH_SIZE = 1000
+
+# 'full' writes a row for every student; 'delta' only for students whose
+# cluster changed since the current assignment
+WRITE_MODES = ('full', 'delta')
+WRITE_MODE = 'full'
+
+# Non-current rows older than this many days are removed by compaction
+HISTORY_KEEP_DAYS = 90
+
+INSERT_QUERY = """
+    INSERT INTO clustering_results (
+        user_id, cluster_number, cluster_label,
+        literacy_score, math_score, overall_performance,
+        features, analysis_date, is_current
+    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, 1)
+"""
+
+# Segmented runs also tag every row with its segment
+SEGMENT_INSERT_QUERY = """
+    INSERT INTO clustering_results (
+        user_id, cluster_number, cluster_label,
+        literacy_score, math_score, overall_performance,
+        features, analysis_date, is_current, segment
+    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, 1, %s)
+"""
+
+# Databases created before segmented runs lack the segment column and its
+# index; ensure_results_schema() adds them in place
+SEGMENT_COLUMN_QUERY = """
+    SELECT COUNT(*) FROM information_schema.COLUMNS
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'clustering_results'
+        AND COLUMN_NAME = 'segment'
+"""
+SEGMENT_INDEX_QUERY = """
+    SELECT COUNT(*) FROM information_schema.STATISTICS
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'clustering_results'
+        AND INDEX_NAME = 'idx_segment'
+"""
+ADD_SEGMENT_COLUMN = "ALTER TABLE clustering_results ADD COLUMN segment VARCHAR(64) DEFAULT NULL"
+ADD_SEGMENT_INDEX = "CREATE INDEX idx_segment ON clustering_results (segment, is_current)"
+
+# The current assignment of every student, in one pass
+CURRENT_ASSIGNMENT_QUERY = """
+    SELECT user_id, cluster_number, cluster_label, segment
+    FROM clustering_results
+    WHERE is_current = 1
+"""
+
+# Per-run cluster totals kept for compacted history; sums rather than
+# averages so a run compacted over several passes merges exactly
+SUMMARY_TABLE_QUERY = """
+    CREATE TABLE IF NOT EXISTS clustering_results_summary (
+        analysis_date TIMESTAMP NOT NULL,
+        segment VARCHAR(64) NOT NULL DEFAULT '',
+        cluster_number INT NOT NULL,
+        cluster_label VARCHAR(100),
+        students INT NOT NULL,
+        literacy_sum DOUBLE NOT NULL,
+        math_sum DOUBLE NOT NULL,
+        performance_sum DOUBLE NOT NULL,
+        PRIMARY KEY (analysis_date, segment, cluster_number)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+"""
+
+SUMMARIZE_QUERY = """
+    INSERT INTO clustering_results_summary (
+        analysis_date, segment, cluster_number, cluster_label,
+        students, literacy_sum, math_sum, performance_sum
+    )
+    SELECT analysis_date, COALESCE(segment, ''), cluster_number, MAX(cluster_label),
+           COUNT(*), COALESCE(SUM(literacy_score), 0), COALESCE(SUM(math_score), 0),
+           COALESCE(SUM(overall_performance), 0)
+    FROM clustering_results
+    WHERE cluster_id IN ({placeholders})
+    GROUP BY analysis_date, COALESCE(segment, ''), cluster_number
+    ON DUPLICATE KEY UPDATE
+        students = students + VALUES(students),
+        literacy_sum = literacy_sum + VALUES(literacy_sum),
+        math_sum = math_sum + VALUES(math_sum),
+        performance_sum = performance_sum + VALUES(performance_sum)
+"""
+
+# Oldest expired history rows first; served by idx_analysis_date
+EXPIRED_ROWS_QUERY = """
+    SELECT cluster_id FROM clustering_results
+    WHERE analysis_date < %s AND is_current = 0
+    ORDER BY analysis_date
+    LIMIT %s
+"""
+
+def _chunks(items, size):
+    """Yield consecutive slices of at most size items"""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def _result_row(user_id, cluster, row, label_mapping, analysis_date):
+    """Build the INSERT parameters for one student's raw feature row"""
+    cluster_info = label_mapping[cluster]
+
+    literacy_score = float(row[LITERACY])
+    math_score = float(row[MATH])
+    overall_performance = (literacy_score + math_score) / 2
+
+    # Create feature JSON
+    features = {
+        'literacy_score': literacy_score,
+        'math_score': math_score,
+        'total_score': float(row[TOTAL_SCORE]),
+        'games_played': int(row[GAMES_PLAYED]),
+        'avg_accuracy': float(row[ACCURACY]),
+        'avg_time': float(row[AVG_TIME]),
+        'total_hints': int(row[TOTAL_HINTS])
+    }
+
+    row = (
+        int(user_id),
+        cluster,
+        cluster_info['label'],
+        literacy_score,
+        math_score,
+        overall_performance,
+        json.dumps(features),
+        analysis_date
+    )
+    if 'segment' in cluster_info:
+        row += (cluster_info['segment'],)
+    return row
+
+def ensure_results_schema(connection):
+    """Add the segment column and idx_segment to an older clustering_results table"""
+    cursor = connection.cursor()
+    try:
+        cursor.execute(SEGMENT_COLUMN_QUERY)
+        if cursor.fetchone()[0] == 0:
+            cursor.execute(ADD_SEGMENT_COLUMN)
+            print("[OK] Added the segment column to clustering_results")
+        cursor.execute(SEGMENT_INDEX_QUERY)
+        if cursor.fetchone()[0] == 0:
+            cursor.execute(ADD_SEGMENT_INDEX)
+            print("[OK] Added idx_segment to clustering_results")
+    finally:
+        cursor.close()
+
+def clear_current_results(cursor, batch_size=RESULT_BATCH_SIZE, user_ids=None):
+    """
+    Flip is_current to 0 only on rows that are currently set.
+    Current user_ids are read from the covering idx_user_cluster index and
+    updated in user_id batches so each UPDATE is an index range lookup
+    instead of a scan over the whole history table. Pass user_ids to clear
+    only those students.
+    """
+    if user_ids is None:
+        cursor.execute("""
+            SELECT DISTINCT user_id FROM clustering_results FORCE INDEX (idx_user_cluster)
+            WHERE is_current = 1
+        """)
+        current_ids = [row[0] for row in cursor.fetchall()]
+    else:
+        current_ids = [int(uid) for uid in user_ids]
+
+    cleared = 0
+    for batch in _chunks(current_ids, batch_size):
+        placeholders = ', '.join(['%s'] * len(batch))
+        cursor.execute(
+            f"UPDATE clustering_results SET is_current = 0 "
+            f"WHERE user_id IN ({placeholders}) AND is_current = 1",
+            batch
+        )
+        cleared += cursor.rowcount
+
+    return cleared
+
+def load_current_assignments(cursor, user_ids=None, batch_size=RESULT_BATCH_SIZE):
+    """
+    Map user_id -> (cluster_number, cluster_label, segment) of the current rows.
+    All students come from a single query; pass user_ids to look up only
+    those, in user_id batches.
+    """
+    if user_ids is None:
+        cursor.execute(CURRENT_ASSIGNMENT_QUERY)
+        rows = cursor.fetchall()
+    else:
+        rows = []
+        for batch in _chunks([int(uid) for uid in user_ids], batch_size):
+            placeholders = ', '.join(['%s'] * len(batch))
+            cursor.execute(CURRENT_ASSIGNMENT_QUERY + f" AND user_id IN ({placeholders})", batch)
+            rows.extend(cursor.fetchall())
+
+    return {int(user_id): (int(cluster), label, segment)
+            for user_id, cluster, label, segment in rows}
+
+def changed_students(cluster_labels, user_ids, label_mapping, current, replace_all=True):
+    """
+    Compare new labels against the current assignment.
+    Returns the positions of students whose cluster number, label or segment
+    changed (or who have no current row), and the ids of students that only
+    have a current row and are no longer part of a full run.
+    """
+    changed = []
+    for i, user_id in enumerate(user_ids):
+        cluster = int(cluster_labels[i])
+        cluster_info = label_mapping[cluster]
+        assignment = (cluster, cluster_info['label'], cluster_info.get('segment'))
+        if current.get(int(user_id)) != assignment:
+            changed.append(i)
+
+    dropped = []
+    if replace_all:
+        run_ids = {int(uid) for uid in user_ids}
+        dropped = [uid for uid in current if uid not in run_ids]
+
+    return changed, dropped
+
+def save_clustering_results(connection, cluster_labels, user_ids, raw_features, label_mapping,
+                            batch_size=RESULT_BATCH_SIZE, replace_all=True, write_mode=WRITE_MODE):
+    """
+    Save clustering results to database.
+    replace_all=False only replaces the current rows of the given students.
+    write_mode='delta' keeps the current rows of students whose assignment did
+    not change and only writes the others.
+    Rows are tagged with a segment when label_mapping entries carry one.
+    """
+    if write_mode not in WRITE_MODES:
+        raise ValueError(f"write_mode must be one of {', '.join(WRITE_MODES)}")
+
+    # Schema changes commit implicitly, so they run before the transaction
+    ensure_results_schema(connection)
+
+    started = time.perf_counter()
+    cursor = connection.cursor()
+
+    try:
+        # One timestamp for the whole run, taken from the database clock
+        cursor.execute("SELECT NOW()")
+        analysis_date = cursor.fetchone()[0]
+
+        if write_mode == 'delta':
+            current = load_current_assignments(cursor, None if replace_all else user_ids, batch_size)
+            positions, dropped = changed_students(cluster_labels, user_ids, label_mapping,
+                                                  current, replace_all)
+            # Students that left the run lose their current row as in a full write
+            cleared = clear_current_results(
+                cursor, batch_size, [int(user_ids[i]) for i in positions] + dropped
+            )
+        else:
+            positions = range(len(user_ids))
+            # Mark previous current results as not current
+            cleared = clear_current_results(cursor, batch_size, None if replace_all else user_ids)
+
+        # Insert new clustering results as multi-row VALUES batches
+        rows = [
+            _result_row(user_ids[i], int(cluster_labels[i]), raw_features[i], label_mapping, analysis_date)
+            for i in positions
+        ]
+        segmented = any('segment' in info for info in label_mapping.values())
+        query = SEGMENT_INSERT_QUERY if segmented else INSERT_QUERY
+        for batch in _chunks(rows, batch_size):
+            cursor.executemany(query, batch)
+
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    elapsed = time.perf_counter() - started
+    rows_per_sec = len(rows) / elapsed if elapsed > 0 else float(len(rows))
+    unchanged = len(user_ids) - len(rows)
+
+    print(f"[OK] Saved {len(rows)} clustering results to database "
+          f"({cleared} previous rows cleared, {unchanged} unchanged, "
+          f"{elapsed:.2f}s, {rows_per_sec:.0f} rows/sec)")
+
+    return {
+        'write_mode': write_mode,
+        'rows_written': len(rows),
+        'rows_cleared': cleared,
+        'rows_unchanged': unchanged,
+        'batch_size': batch_size,
+        'seconds': round(elapsed, 3),
+        'rows_per_sec': round(rows_per_sec, 1)
+    }
+
+
+def compact_results(connection, keep_days=HISTORY_KEEP_DAYS, summarize=True,
+                    batch_size=RESULT_BATCH_SIZE):
+    """
+    Delete non-current result rows older than keep_days.
+    With summarize=True each run's expired rows are first folded into
+    clustering_results_summary (students and score sums per cluster), so the
+    history of cluster sizes survives the pruning. Current rows are never
+    touched. Each batch commits on its own to keep locks short.
+    """
+    ensure_results_schema(connection)
+
+    started = time.perf_counter()
+    cursor = connection.cursor()
+    deleted = 0
+
+    try:
+        if summarize:
+            cursor.execute(SUMMARY_TABLE_QUERY)
+
+        # Computed here rather than with INTERVAL arithmetic so the query stays portable
+        cutoff = (datetime.now() - timedelta(days=int(keep_days))).strftime('%Y-%m-%d %H:%M:%S')
+
+        while True:
+            cursor.execute(EXPIRED_ROWS_QUERY, (cutoff, batch_size))
+            batch = [row[0] for row in cursor.fetchall()]
+            if not batch:
+                break
+
+            placeholders = ', '.join(['%s'] * len(batch))
+            if summarize:
+                cursor.execute(SUMMARIZE_QUERY.format(placeholders=placeholders), batch)
+            cursor.execute(f"DELETE FROM clustering_results WHERE cluster_id IN ({placeholders})",
+                           batch)
+            deleted += cursor.rowcount
+            connection.commit()
+
+            if len(batch) < batch_size:
+                break
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"[OK] Compacted clustering history: {deleted} rows older than {keep_days} days "
+          f"{'summarized and ' if summarize else ''}deleted ({elapsed:.2f}s)")
+
+    return {
+        'rows_deleted': deleted,
+        'keep_days': keep_days,
+        'summarized': summarize,
+        'cutoff': str(cutoff),
+        'seconds': round(elapsed, 3)
+    }
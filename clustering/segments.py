@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Segmented Clustering
+Partitions students by a segment key and fits every segment independently
+on a process pool that reads one shared-memory copy of the feature matrix
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+from threadpoolctl import threadpool_limits
+
+from cluster_stats import cluster_overall_means
+from clustering_engine import fit_clusters, performance_labels
+from features import standardize_features
+
+# Segment keys and the query returning (user_id, segment) for each
+SEGMENT_QUERIES = {
+    # Level set by update_student_progress(): low / medium / high
+    'performance_level': """
+        SELECT user_id, performance_level AS segment
+        FROM student_progress
+    """,
+    # Game type each student has completed most often (ties: first by name)
+    'primary_game': """
+        SELECT user_id, game_type AS segment, COUNT(*) AS plays
+        FROM game_sessions
+        WHERE completed_at IS NOT NULL
+        GROUP BY user_id, game_type
+    """
+}
+SEGMENT_KEYS = tuple(SEGMENT_QUERIES)
+
+# Students the segment query does not cover
+UNASSIGNED_SEGMENT = 'unassigned'
+
+SEGMENT_WORKERS = min(4, os.cpu_count() or 1)
+
+# Set in each worker by _attach_features()
+_SHARED = {}
+
+def load_segments(connection, user_ids, key):
+    """Segment name for every user id, in user_ids order"""
+    if key not in SEGMENT_QUERIES:
+        raise ValueError(f"Unknown segment key '{key}' (expected one of {', '.join(SEGMENT_KEYS)})")
+
+    cursor = connection.cursor()
+    cursor.execute(SEGMENT_QUERIES[key])
+    rows = cursor.fetchall()
+    cursor.close()
+
+    if key == 'primary_game' and rows:
+        # Highest play count per user, then the alphabetically first game type
+        rows.sort(key=lambda row: (row[0], -int(row[2]), str(row[1])))
+        first = [row for i, row in enumerate(rows) if i == 0 or rows[i - 1][0] != row[0]]
+        rows = first
+
+    lookup = {int(row[0]): str(row[1]) for row in rows if row[1] is not None}
+    return np.array([lookup.get(int(uid), UNASSIGNED_SEGMENT) for uid in user_ids], dtype=object)
+
+def _attach_features(name, shape, dtype):
+    """Worker initializer: map the shared feature buffer without copying it"""
+    buffer = shared_memory.SharedMemory(name=name)
+    _SHARED['buffer'] = buffer
+    _SHARED['features'] = np.ndarray(shape, dtype=dtype, buffer=buffer.buf)
+
+def _fit_segment(start, end, n_clusters, engine):
+    """Standardize and cluster rows start:end of the shared matrix (runs in a worker)"""
+    raw_features = _SHARED['features'][start:end]
+    n_clusters = min(n_clusters, end - start)
+
+    if n_clusters < 2:
+        return np.zeros(end - start, dtype=np.int64), 0.0, 'none'
+
+    # One BLAS/OpenMP thread per worker so parallel segments don't oversubscribe
+    with threadpool_limits(limits=1):
+        # The shared rows are this worker's own copy, so scale them in place
+        features, _ = standardize_features(raw_features, copy=False)
+        labels, model, engine_used = fit_clusters(features, n_clusters, engine)
+
+    return labels.astype(np.int64), float(model.inertia_), engine_used
+
+def cluster_segments(raw_features, segments, n_clusters, engine='auto', workers=SEGMENT_WORKERS):
+    """
+    Cluster each segment separately; features are standardized per segment.
+    Cluster numbers are made unique across segments, and label_mapping
+    entries carry their 'segment'. Returns (cluster_labels, label_mapping,
+    segment_summary).
+    """
+    # Stable sort by segment so every segment is one contiguous slice
+    names, inverse = np.unique(segments.astype(str), return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    counts = np.bincount(inverse, minlength=len(names))
+    ends = np.cumsum(counts)
+    starts = ends - counts
+
+    sorted_features = np.ascontiguousarray(raw_features[order])
+    buffer = shared_memory.SharedMemory(create=True, size=max(sorted_features.nbytes, 1))
+    try:
+        shared = np.ndarray(sorted_features.shape, dtype=sorted_features.dtype, buffer=buffer.buf)
+        shared[:] = sorted_features
+        del sorted_features
+
+        tasks = [(int(starts[i]), int(ends[i]), n_clusters, engine) for i in range(len(names))]
+        if workers > 1 and len(tasks) > 1:
+            with ProcessPoolExecutor(max_workers=min(workers, len(tasks)), initializer=_attach_features,
+                                     initargs=(buffer.name, shared.shape, shared.dtype)) as pool:
+                fits = list(pool.map(_fit_segment, *zip(*tasks)))
+        else:
+            _attach_features(buffer.name, shared.shape, shared.dtype)
+            fits = [_fit_segment(*task) for task in tasks]
+            _SHARED.clear()
+    finally:
+        buffer.close()
+        buffer.unlink()
+
+    sorted_labels = np.empty(len(order), dtype=np.int64)
+    label_mapping = {}
+    summary = []
+    offset = 0
+    for i, (local_labels, inertia, engine_used) in enumerate(fits):
+        start, end = starts[i], ends[i]
+        rows = raw_features[order[start:end]]
+
+        # Label each segment's clusters by its own performance ranking
+        averages = cluster_overall_means(local_labels, rows)
+        ranked = sorted(averages.items(), key=lambda item: item[1], reverse=True)
+        labels = performance_labels(len(ranked))
+        for rank, (cluster, avg_score) in enumerate(ranked):
+            label_mapping[offset + cluster] = {
+                'label': labels[rank],
+                'avg_score': avg_score,
+                'segment': str(names[i]),
+                'segment_cluster': int(cluster)
+            }
+
+        sorted_labels[start:end] = local_labels + offset
+        summary.append({
+            'segment': str(names[i]),
+            'students': int(end - start),
+            'clusters': len(ranked),
+            'engine': engine_used,
+            'inertia': round(inertia, 2)
+        })
+        offset += int(local_labels.max()) + 1 if len(local_labels) else 0
+
+    cluster_labels = np.empty_like(sorted_labels)
+    cluster_labels[order] = sorted_labels
+
+    print(f"[OK] Clustered {len(names)} segments with up to {n_clusters} clusters each")
+    for segment in summary:
+        print(f"  {segment['segment']}: {segment['students']} students, "
+              f"{segment['clusters']} clusters ({segment['engine']})")
+
+    return cluster_labels, label_mapping, summary
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offline Feature Snapshots
+Exports completed game sessions and student progress to local columnar files
+and rebuilds the feature matrix from memory-mapped copies, so clustering can
+be rerun or tuned without touching the database
+"""
+
+import json
+import os
+from datetime import datetime
+
+import numpy as np
+
+from feature_builder import DIFFICULTY_LEVELS, GAME_TYPES, game_features_from_sessions
+from feature_store import LOWER_BOUND_ALL, LOWER_BOUND_OVERLAP, latest_completed_session, overlap_start
+from features import (ACCURACY, AVG_TIME, FEATURE_COLUMNS, GAMES_PLAYED, LITERACY, MATH,
+                      TOTAL_HINTS, TOTAL_SCORE)
+
+# Snapshots are written next to the scripts unless CLUSTERING_SNAPSHOT_DIR is set
+SNAPSHOT_DIR = os.environ.get(
+    'CLUSTERING_SNAPSHOT_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'snapshots')
+)
+
+# Bumped when the file layout changes; older snapshots must be rebuilt
+SNAPSHOT_FORMAT = 1
+
+MANIFEST_FILE = 'manifest.json'
+STUDENTS_FILE = 'students.npz'
+SESSIONS_DIR = 'sessions'
+
+# One raw little-endian file per column, appended in (completed_at, session_id)
+# order. NULL measures are stored as NaN; game_type and difficulty_level are
+# indexes into GAME_TYPES / DIFFICULTY_LEVELS (-1 for unknown values).
+SESSION_COLUMNS = {
+    'session_id': '<i8',
+    'user_id': '<i8',
+    'game_type': 'i1',
+    'difficulty_level': 'i1',
+    'completed_at': '<f8',
+    'accuracy': '<f8',
+    'time_taken': '<f8',
+    'hints_used': '<f8',
+    'streak_count': '<f8',
+    'score': '<f8'
+}
+
+STUDENT_COLUMNS = ('user_id', 'literacy_score', 'math_score', 'total_score', 'games_played')
+
+# Sessions fetched per round-trip and appended per write
+SNAPSHOT_CHUNK_SIZE = 50000
+
+# Sessions from the lower bound up to the (completed_at, session_id) mark
+SESSION_EXPORT_QUERY = """
+    SELECT
+        gs.session_id,
+        gs.user_id,
+        gs.game_type,
+        gs.difficulty_level,
+        UNIX_TIMESTAMP(gs.completed_at) AS completed_at,
+        gs.accuracy,
+        gs.time_taken,
+        gs.hints_used,
+        gs.streak_count,
+        gs.score
+    FROM game_sessions gs
+    WHERE gs.completed_at IS NOT NULL
+        AND {lower_bound}
+        AND (gs.completed_at < %(hi_at)s
+             OR (gs.completed_at = %(hi_at)s AND gs.session_id <= %(hi_id)s))
+    ORDER BY gs.completed_at, gs.session_id
+"""
+
+# Sessions the snapshot should hold once exported up to the mark
+SESSION_COUNT_QUERY = """
+    SELECT COUNT(*)
+    FROM game_sessions gs
+    WHERE gs.completed_at IS NOT NULL
+        AND (gs.completed_at < %(hi_at)s
+             OR (gs.completed_at = %(hi_at)s AND gs.session_id <= %(hi_id)s))
+"""
+
+# Progress columns of every active student, as the feature queries read them
+STUDENT_EXPORT_QUERY = """
+    SELECT
+        u.user_id,
+        COALESCE(sp.literacy_progress, 0) as literacy_score,
+        COALESCE(sp.math_progress, 0) as math_score,
+        COALESCE(sp.total_score, 0) as total_score,
+        COALESCE(sp.games_played, 0) as games_played
+    FROM users u
+    LEFT JOIN student_progress sp ON u.user_id = sp.user_id
+    WHERE u.is_active = 1
+    ORDER BY u.user_id
+"""
+
+def _column_path(snapshot_dir, column):
+    return os.path.join(snapshot_dir, SESSIONS_DIR, f'{column}.bin')
+
+def _timestamp():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+def read_manifest(snapshot_dir=SNAPSHOT_DIR):
+    """Manifest of the snapshot, or None when there is no usable snapshot"""
+    path = os.path.join(snapshot_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as handle:
+        manifest = json.load(handle)
+    if manifest.get('format') != SNAPSHOT_FORMAT or manifest.get('columns') != SESSION_COLUMNS:
+        return None
+    return manifest
+
+def _write_manifest(snapshot_dir, manifest):
+    # Replaced atomically: readers see the old or the new row count, never a mix
+    path = os.path.join(snapshot_dir, MANIFEST_FILE)
+    with open(path + '.tmp', 'w') as handle:
+        json.dump(manifest, handle, indent=2)
+    os.replace(path + '.tmp', path)
+
+def _codes(values, names):
+    lookup = {name: i for i, name in enumerate(names)}
+    return np.array([lookup.get(value, -1) for value in values], dtype=np.int8)
+
+def _session_arrays(rows):
+    """Column arrays for one chunk of SESSION_EXPORT_QUERY rows"""
+    columns = list(zip(*rows))
+    arrays = {}
+    for position, (column, dtype) in enumerate(SESSION_COLUMNS.items()):
+        if column == 'game_type':
+            arrays[column] = _codes(columns[position], GAME_TYPES)
+        elif column == 'difficulty_level':
+            arrays[column] = _codes(columns[position], DIFFICULTY_LEVELS)
+        else:
+            # None becomes NaN for the float columns
+            arrays[column] = np.array(columns[position], dtype=np.float64).astype(dtype)
+    return arrays
+
+def _open_columns(snapshot_dir, rows):
+    """Column files positioned for appending after the first rows rows"""
+    handles = {}
+    for column, dtype in SESSION_COLUMNS.items():
+        handle = open(_column_path(snapshot_dir, column), 'r+b' if rows else 'w+b')
+        # Drop anything a failed earlier append wrote past the manifest
+        handle.truncate(rows * np.dtype(dtype).itemsize)
+        handle.seek(0, os.SEEK_END)
+        handles[column] = handle
+    return handles
+
+def _exported_since(snapshot_dir, rows, since):
+    """Sorted ids of the first rows exported sessions completed at or after since (unix time)"""
+    if rows == 0:
+        return np.empty(0, dtype=np.int64)
+    completed_at = np.memmap(_column_path(snapshot_dir, 'completed_at'),
+                             dtype=SESSION_COLUMNS['completed_at'], mode='r', shape=(rows,))
+    session_ids = np.memmap(_column_path(snapshot_dir, 'session_id'),
+                            dtype=SESSION_COLUMNS['session_id'], mode='r', shape=(rows,))
+    return np.sort(session_ids[completed_at >= since])
+
+def _append_sessions(connection, snapshot_dir, rows, lower_bound, params, chunk_size,
+                     exported=None):
+    """
+    Append the window's sessions to the column files, skipping the sorted
+    session ids in exported; returns the new row count
+    """
+    handles = _open_columns(snapshot_dir, rows)
+    cursor = connection.cursor(buffered=False)
+    try:
+        cursor.execute(SESSION_EXPORT_QUERY.format(lower_bound=lower_bound), params)
+        while True:
+            chunk = cursor.fetchmany(chunk_size)
+            if not chunk:
+                break
+            arrays = _session_arrays(chunk)
+            if exported is not None and len(exported):
+                new = ~np.isin(arrays['session_id'], exported, assume_unique=True)
+                arrays = {column: values[new] for column, values in arrays.items()}
+            for column, values in arrays.items():
+                handles[column].write(values.tobytes())
+            rows += len(arrays['session_id'])
+    finally:
+        cursor.close()
+        for handle in handles.values():
+            handle.close()
+
+    return rows
+
+def _export_students(connection, snapshot_dir):
+    cursor = connection.cursor()
+    cursor.execute(STUDENT_EXPORT_QUERY)
+    rows = cursor.fetchall()
+    cursor.close()
+
+    columns = list(zip(*rows)) if rows else [()] * len(STUDENT_COLUMNS)
+    arrays = {'user_id': np.array(columns[0], dtype=np.int64)}
+    for position, column in enumerate(STUDENT_COLUMNS[1:], start=1):
+        arrays[column] = np.array(columns[position], dtype=np.float64)
+
+    path = os.path.join(snapshot_dir, STUDENTS_FILE)
+    np.savez(path + '.tmp.npz', **arrays)
+    os.replace(path + '.tmp.npz', path)
+    return len(rows)
+
+def update_snapshot(connection, snapshot_dir=SNAPSHOT_DIR, rebuild=False,
+                    chunk_size=SNAPSHOT_CHUNK_SIZE):
+    """
+    Append sessions completed since the snapshot's high-water mark and
+    refresh the student progress columns. The window starts
+    FOLD_OVERLAP_SECONDS before the mark so late commits are picked up;
+    sessions already exported are skipped. rebuild=True (or a missing or
+    outdated snapshot) exports everything from scratch, as does a snapshot
+    whose row count no longer matches the database (deleted sessions).
+    Returns the manifest.
+    """
+    os.makedirs(os.path.join(snapshot_dir, SESSIONS_DIR), exist_ok=True)
+    manifest = None if rebuild else read_manifest(snapshot_dir)
+
+    cursor = connection.cursor()
+    latest = latest_completed_session(cursor)
+    cursor.execute("SELECT UNIX_TIMESTAMP()")
+    reference_time = float(cursor.fetchone()[0])
+    cursor.close()
+
+    watermark = tuple(manifest['watermark']) if manifest and manifest['watermark'] else None
+    rows = manifest['rows'] if manifest else 0
+    appended = 0
+
+    if latest is not None:
+        hi_at, hi_id = str(latest[0]), int(latest[1])
+        if watermark is not None and (hi_at, hi_id) < watermark:
+            # The newest session was deleted; the mark never moves back
+            hi_at, hi_id = watermark
+        params = {'hi_at': hi_at, 'hi_id': hi_id}
+        exported = None
+        if watermark is None:
+            lower_bound = LOWER_BOUND_ALL
+        else:
+            # Re-read even when nothing is newer than the mark, to pick up late
+            # commits behind it
+            lower_bound = LOWER_BOUND_OVERLAP
+            params['since'] = overlap_start(watermark[0])
+            cursor = connection.cursor()
+            cursor.execute("SELECT UNIX_TIMESTAMP(%s)", (params['since'],))
+            exported = _exported_since(snapshot_dir, rows, float(cursor.fetchone()[0]))
+            cursor.close()
+
+        total = _append_sessions(connection, snapshot_dir, rows, lower_bound, params, chunk_size,
+                                 exported)
+        appended = total - rows
+        rows = total
+        watermark = (hi_at, hi_id)
+
+        if manifest is not None:
+            # Appends can't drop deleted sessions, nor catch ones that committed
+            # more than the overlap behind the mark; either leaves the count off
+            cursor = connection.cursor()
+            cursor.execute(SESSION_COUNT_QUERY, params)
+            expected = int(cursor.fetchone()[0])
+            cursor.close()
+            if expected != rows:
+                print(f"[WARNING] Snapshot holds {rows} sessions but the database has {expected} "
+                      f"up to its high-water mark, rebuilding")
+                return update_snapshot(connection, snapshot_dir, rebuild=True, chunk_size=chunk_size)
+    elif manifest is None:
+        # No completed sessions yet: start with empty column files
+        for handle in _open_columns(snapshot_dir, 0).values():
+            handle.close()
+
+    students = _export_students(connection, snapshot_dir)
+
+    mode = 'Exported' if manifest is None else 'Updated'
+    now = _timestamp()
+    manifest = {
+        'format': SNAPSHOT_FORMAT,
+        'rows': rows,
+        'students': students,
+        'watermark': list(watermark) if watermark else None,
+        'reference_time': reference_time,
+        'created_at': manifest['created_at'] if manifest else now,
+        'updated_at': now,
+        'columns': SESSION_COLUMNS
+    }
+    _write_manifest(snapshot_dir, manifest)
+
+    print(f"[OK] {mode} snapshot in {snapshot_dir}: {appended} new sessions "
+          f"({rows} total), {students} active students")
+    return manifest
+
+def open_snapshot(snapshot_dir=SNAPSHOT_DIR):
+    """
+    Memory-map the snapshot's session columns (read-only) and load the
+    student columns. Raises FileNotFoundError when there is no snapshot.
+    """
+    manifest = read_manifest(snapshot_dir)
+    if manifest is None:
+        raise FileNotFoundError(f"No snapshot in {snapshot_dir} (run with --export-snapshot first)")
+
+    sessions = {}
+    for column, dtype in SESSION_COLUMNS.items():
+        if manifest['rows'] == 0:
+            sessions[column] = np.empty(0, dtype=dtype)
+        else:
+            # Only the manifest's rows: a concurrent append may have written more
+            sessions[column] = np.memmap(_column_path(snapshot_dir, column), dtype=dtype,
+                                         mode='r', shape=(manifest['rows'],))
+
+    with np.load(os.path.join(snapshot_dir, STUDENTS_FILE)) as students:
+        students = {column: students[column] for column in STUDENT_COLUMNS}
+
+    return {'dir': snapshot_dir, 'manifest': manifest, 'sessions': sessions, 'students': students}
+
+def snapshot_fingerprint(manifest):
+    """Result-cache fingerprint of a snapshot (changes with every refresh)"""
+    return {
+        'source': 'snapshot',
+        'rows': manifest['rows'],
+        'watermark': manifest['watermark'],
+        'students': manifest['students'],
+        'updated_at': manifest['updated_at']
+    }
+
+def snapshot_feature_matrix(snapshot, feature_set='basic', dtype=np.float64):
+    """
+    Rebuild (user_ids, raw_features) from a snapshot: the same students and
+    columns as the full feature query (up to its DECIMAL rounding of AVG), plus
+    the extended columns for feature_set='extended'.
+    """
+    students = snapshot['students']
+    sessions = snapshot['sessions']
+
+    # Same row set as FULL_FEATURE_QUERY: active students with at least one game
+    keep = students['games_played'] > 0
+    user_ids = students['user_id'][keep]
+
+    # STUDENT_EXPORT_QUERY is ordered by user_id, so searchsorted finds each row
+    session_users = np.asarray(sessions['user_id'])
+    position = np.searchsorted(user_ids, session_users).clip(0, max(len(user_ids) - 1, 0))
+    found = (user_ids[position] == session_users) if len(user_ids) else np.zeros(len(session_users), bool)
+    index = position[found]
+
+    def grouped(column):
+        """Per-student sum and non-NULL count of one session column"""
+        values = np.asarray(sessions[column])[found]
+        present = ~np.isnan(values)
+        return (np.bincount(index, weights=np.where(present, values, 0.0), minlength=len(user_ids)),
+                np.bincount(index, weights=present, minlength=len(user_ids)))
+
+    accuracy_sum, accuracy_count = grouped('accuracy')
+    time_sum, time_count = grouped('time_taken')
+    hints_sum, _ = grouped('hints_used')
+
+    raw_features = np.empty((len(user_ids), len(FEATURE_COLUMNS)), dtype=dtype)
+    raw_features[:, LITERACY] = students['literacy_score'][keep]
+    raw_features[:, MATH] = students['math_score'][keep]
+    raw_features[:, GAMES_PLAYED] = students['games_played'][keep]
+    raw_features[:, TOTAL_SCORE] = students['total_score'][keep]
+    raw_features[:, TOTAL_HINTS] = hints_sum
+    with np.errstate(invalid='ignore', divide='ignore'):
+        raw_features[:, ACCURACY] = np.where(accuracy_count > 0, accuracy_sum / accuracy_count, 0.0)
+        raw_features[:, AVG_TIME] = np.where(time_count > 0, time_sum / time_count, 0.0)
+
+    if feature_set == 'extended':
+        game_features = game_features_from_sessions(user_ids, sessions,
+                                                    snapshot['manifest']['reference_time'], dtype=dtype)
+        raw_features = np.hstack([raw_features, game_features])
+
+    print(f"[OK] Loaded {len(user_ids)} students from snapshot "
+          f"({snapshot['manifest']['rows']} sessions, {feature_set} set: {raw_features.shape[1]} columns)")
+    return user_ids, raw_features
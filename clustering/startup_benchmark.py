@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Flask Cold Start Benchmark
+Starts the clustering service in fresh interpreters and measures the time
+to import it, to answer the first /health request and to finish the first
+/cluster run, with and without the warm-up thread
+"""
+
+import sys
+import io
+
+# Fix Windows console encoding issues
+if sys.platform == 'win32':
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
+    sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks')
+
+# Timings reported for every start, in seconds since the interpreter began importing the app
+STARTUP_TIMINGS = ('import_app', 'first_health', 'first_cluster')
+
+# Marks the child's result line among the pipeline output
+RESULT_PREFIX = 'STARTUP_RESULT '
+
+def measure_startup(cohort):
+    """Child process: start the app, call /health then /cluster, print the timings"""
+    started = time.perf_counter()
+    import complete_app
+    timings = {'import_app': time.perf_counter() - started}
+
+    client = complete_app.app.test_client()
+    response = client.get('/health')
+    timings['first_health'] = time.perf_counter() - started
+    if response.status_code != 200:
+        raise RuntimeError(f"/health returned {response.status_code}")
+
+    # Point the pool at the synthetic cohort; the driver import is part of the
+    # first /cluster cost either way
+    import mysql.connector
+    from synthetic_data import open_cohort
+    mysql.connector.connect = lambda **config: open_cohort(cohort)
+
+    # The SQLite stand-in has no feature store tables, so use the full query
+    result = client.post('/cluster', json={'wait': True, 'use_cache': False,
+                                           'feature_mode': 'full'}).get_json()
+    timings['first_cluster'] = time.perf_counter() - started
+    if not result.get('success'):
+        raise RuntimeError(f"/cluster failed: {result.get('error')}")
+
+    print(RESULT_PREFIX + json.dumps(timings))
+
+def run_child(cohort, warm_up, work_dir):
+    """One cold start in a new interpreter; returns its timings"""
+    env = dict(os.environ)
+    env.update({
+        'CLUSTERING_WARM_UP': '1' if warm_up else '0',
+        'CLUSTERING_MODEL_DIR': os.path.join(work_dir, 'models'),
+        'CLUSTERING_JOB_DB': os.path.join(work_dir, 'jobs.sqlite3'),
+        'CLUSTERING_RESULT_CACHE': os.path.join(work_dir, 'result_cache.sqlite3'),
+        'CLUSTERING_PROFILE_DIR': os.path.join(work_dir, 'profiles'),
+        'CLUSTERING_SNAPSHOT_DIR': os.path.join(work_dir, 'snapshots')
+    })
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--child', cohort],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+        capture_output=True, text=True, check=True
+    ).stdout
+
+    for line in output.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    raise RuntimeError("Child process did not report its timings")
+
+def parse_args():
+    """Parse command line options"""
+    parser = argparse.ArgumentParser(description='Cold start benchmark for the Flask clustering service')
+    parser.add_argument('--students', type=int, default=1000,
+                        help='synthetic cohort size for the first /cluster run (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='starts per configuration; timings are the median (default: %(default)s)')
+    parser.add_argument('--data-dir', default=os.path.join(BENCHMARK_DIR, 'data'),
+                        help='where generated cohorts are cached (default: %(default)s)')
+    parser.add_argument('--output',
+                        help='results file (default: benchmarks/startup_<commit>.json)')
+    parser.add_argument('--child', metavar='COHORT', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    if args.child:
+        measure_startup(args.child)
+        return
+
+    # Only the parent needs the generator and git helpers
+    from benchmark import cohort_path, git_commit
+    from synthetic_data import generate_cohort
+
+    print("\n[AI] Startup Benchmark")
+    print("="*60)
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    cohort = cohort_path(args.data_dir, args.students, 8.0, 1.0, 42)
+    if not os.path.exists(cohort):
+        generate_cohort(cohort, args.students)
+
+    results = {'commit': git_commit(), 'students': args.students, 'repeat': args.repeat,
+               'configurations': {}}
+
+    for warm_up in (False, True):
+        name = 'warm_up' if warm_up else 'lazy'
+        runs = []
+        for _ in range(args.repeat):
+            with tempfile.TemporaryDirectory() as work_dir:
+                runs.append(run_child(cohort, warm_up, work_dir))
+
+        medians = {timing: round(statistics.median(run[timing] for run in runs), 4)
+                   for timing in STARTUP_TIMINGS}
+        results['configurations'][name] = medians
+
+        print(f"\n[OK] {name}:")
+        for timing, seconds in medians.items():
+            print(f"  {timing:<14} {seconds:>8.3f}s")
+
+    output = args.output or os.path.join(BENCHMARK_DIR, f"startup_{results['commit'] or 'local'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as handle:
+        json.dump(results, handle, indent=2)
+    print(f"\n[OK] Results written to {output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Synthetic Cohort Data
+Generates users / student_progress / game_sessions rows for benchmarks and
+load tests, stored in a local SQLite database behind a mysql.connector-style
+connection so the clustering pipeline runs against it unchanged
+"""
+
+import os
+import re
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+GAME_TYPES = ('word_scramble', 'reading_comprehension', 'number_puzzle', 'math_challenge')
+LITERACY_GAMES = (0, 1)
+DIFFICULTY_LEVELS = ('easy', 'medium', 'hard')
+
+# Rows per executemany while loading
+INSERT_CHUNK = 50000
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        full_name TEXT NOT NULL,
+        is_active INTEGER DEFAULT 1
+    );
+    CREATE TABLE IF NOT EXISTS student_progress (
+        progress_id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL UNIQUE,
+        total_score INTEGER DEFAULT 0,
+        games_played INTEGER DEFAULT 0,
+        literacy_progress REAL DEFAULT 0,
+        math_progress REAL DEFAULT 0,
+        performance_level TEXT DEFAULT 'low',
+        updated_at TEXT
+    );
+    CREATE TABLE IF NOT EXISTS game_sessions (
+        session_id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        game_type TEXT NOT NULL,
+        score INTEGER DEFAULT 0,
+        difficulty_level TEXT DEFAULT 'medium',
+        time_taken INTEGER,
+        accuracy REAL,
+        streak_count INTEGER DEFAULT 0,
+        hints_used INTEGER DEFAULT 0,
+        started_at TEXT,
+        completed_at TEXT
+    );
+    CREATE TABLE IF NOT EXISTS clustering_results (
+        cluster_id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        cluster_number INTEGER NOT NULL,
+        cluster_label TEXT,
+        literacy_score REAL,
+        math_score REAL,
+        overall_performance REAL,
+        features TEXT,
+        analysis_date TEXT,
+        is_current INTEGER DEFAULT 1,
+        segment TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_user_game ON game_sessions (user_id, game_type);
+    CREATE INDEX IF NOT EXISTS idx_completed ON game_sessions (completed_at);
+    CREATE INDEX IF NOT EXISTS idx_session_user_date ON game_sessions (user_id, completed_at);
+    CREATE INDEX IF NOT EXISTS idx_user_cluster ON clustering_results (user_id, is_current);
+"""
+
+# information_schema tables the pipeline reads, as views over SQLite's pragmas
+INFORMATION_SCHEMA = {
+    'COLUMNS': """(SELECT 'main' AS TABLE_SCHEMA, m.name AS TABLE_NAME, p.name AS COLUMN_NAME
+                  FROM sqlite_master m, pragma_table_info(m.name) p WHERE m.type = 'table')""",
+    'STATISTICS': """(SELECT 'main' AS TABLE_SCHEMA, m.name AS TABLE_NAME, i.name AS INDEX_NAME
+                     FROM sqlite_master m, pragma_index_list(m.name) i WHERE m.type = 'table')"""
+}
+
+def _now():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+def _unix_timestamp(value=None):
+    """MySQL UNIX_TIMESTAMP(): now, or a local 'YYYY-MM-DD HH:MM:SS' time"""
+    if value is None:
+        return time.time()
+    return time.mktime(datetime.strptime(value, '%Y-%m-%d %H:%M:%S').timetuple())
+
+class SQLiteCursor:
+    """Cursor with the mysql.connector calls used by the clustering modules"""
+
+    def __init__(self, cursor, dictionary=False):
+        self._cursor = cursor
+        self._dictionary = dictionary
+
+    @staticmethod
+    def translate(query):
+        """Rewrite the MySQL dialect used by the pipeline into SQLite"""
+        query = re.sub(r'%\((\w+)\)s', r':\1', query)
+        query = query.replace('%s', '?')
+        for table, view in INFORMATION_SCHEMA.items():
+            query = query.replace(f'information_schema.{table}', view)
+        # Table options SQLite has no notion of
+        query = re.sub(r'\)\s*ENGINE=[^)]*$', ')', query)
+        # Upserts; VALUES(col) is the row that would have been inserted
+        if 'ON DUPLICATE KEY UPDATE' in query:
+            head, tail = query.split('ON DUPLICATE KEY UPDATE')
+            query = head + 'ON CONFLICT DO UPDATE SET' + re.sub(r'VALUES\((\w+)\)', r'excluded.\1', tail)
+        return re.sub(r'FORCE INDEX \((\w+)\)', r'INDEXED BY \1', query)
+
+    @property
+    def column_names(self):
+        return tuple(column[0] for column in self._cursor.description or ())
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    def _row(self, row):
+        if row is None or not self._dictionary:
+            return row
+        return dict(zip(self.column_names, row))
+
+    def execute(self, query, params=()):
+        self._cursor.execute(self.translate(query), params if params is not None else ())
+
+    def executemany(self, query, seq_params):
+        self._cursor.executemany(self.translate(query), seq_params)
+
+    def fetchone(self):
+        return self._row(self._cursor.fetchone())
+
+    def fetchmany(self, size):
+        return [self._row(row) for row in self._cursor.fetchmany(size)]
+
+    def fetchall(self):
+        return [self._row(row) for row in self._cursor.fetchall()]
+
+    def close(self):
+        self._cursor.close()
+
+class SQLiteConnection:
+    """mysql.connector-style connection over a local SQLite file"""
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.create_function('NOW', 0, _now)
+        self._db.create_function('DATABASE', 0, lambda: 'main')
+        self._db.create_function('UNIX_TIMESTAMP', -1, _unix_timestamp)
+        self._open = True
+
+    def cursor(self, dictionary=False, buffered=None, raw=False):
+        return SQLiteCursor(self._db.cursor(), dictionary)
+
+    def commit(self):
+        self._db.commit()
+
+    def rollback(self):
+        self._db.rollback()
+
+    def is_connected(self):
+        return self._open
+
+    def ping(self, reconnect=False):
+        return None
+
+    def close(self):
+        if self._open:
+            self._db.close()
+            self._open = False
+
+def _student_sessions(rng, n_students, sessions_per_student, skew):
+    """Skewed (log-normal) number of completed sessions per student, at least 1"""
+    mu = np.log(sessions_per_student) - skew ** 2 / 2
+    counts = np.maximum(1, np.round(rng.lognormal(mu, skew, n_students))).astype(np.int64)
+    return counts
+
+def generate_cohort(path, n_students, sessions_per_student=8.0, skew=1.0, seed=42):
+    """
+    Create a SQLite database with n_students active students in three
+    ability groups and a skewed number of completed sessions each.
+    Returns a summary dict.
+    """
+    started = time.perf_counter()
+    if os.path.exists(path):
+        os.remove(path)
+
+    rng = np.random.default_rng(seed)
+    db = sqlite3.connect(path)
+    db.executescript(SCHEMA)
+
+    # Three latent ability groups so the cohort has real cluster structure
+    group = rng.choice(3, n_students, p=[0.3, 0.45, 0.25])
+    ability = np.array([85.0, 65.0, 40.0])[group] + rng.normal(0, 8, n_students)
+    speed = np.array([150.0, 240.0, 360.0])[group] * rng.lognormal(0, 0.2, n_students)
+    hint_rate = np.array([0.3, 1.0, 2.5])[group]
+
+    user_ids = np.arange(1, n_students + 1)
+    db.executemany(
+        "INSERT INTO users (user_id, full_name, is_active) VALUES (?, ?, 1)",
+        ((int(uid), f'Student {uid}') for uid in user_ids)
+    )
+
+    counts = _student_sessions(rng, n_students, sessions_per_student, skew)
+    n_sessions = int(counts.sum())
+    owner = np.repeat(np.arange(n_students), counts)
+
+    game_type = rng.integers(0, len(GAME_TYPES), n_sessions)
+    difficulty = rng.integers(0, len(DIFFICULTY_LEVELS), n_sessions)
+    accuracy = np.clip(ability[owner] + rng.normal(0, 10, n_sessions) - (difficulty - 1) * 5, 0, 100).round(2)
+    time_taken = np.maximum(10, speed[owner] * rng.lognormal(0, 0.3, n_sessions)).astype(np.int64)
+    hints = rng.poisson(hint_rate[owner]).astype(np.int64)
+    streak = rng.poisson(np.maximum(accuracy / 20, 0.1)).astype(np.int64)
+    score = (accuracy * (1 + difficulty * 0.5) * 10).astype(np.int64)
+
+    # Sessions spread over the last 90 days, ordered by completion time
+    offsets = np.sort(rng.uniform(0, 90 * 86400, n_sessions))
+    base = datetime.now() - timedelta(days=90)
+    order = rng.permutation(n_sessions)
+    owner, game_type, difficulty = owner[order], game_type[order], difficulty[order]
+    accuracy, time_taken, hints, streak, score = (
+        accuracy[order], time_taken[order], hints[order], streak[order], score[order]
+    )
+
+    for start in range(0, n_sessions, INSERT_CHUNK):
+        end = min(start + INSERT_CHUNK, n_sessions)
+        rows = []
+        for i in range(start, end):
+            completed = base + timedelta(seconds=float(offsets[i]))
+            rows.append((
+                i + 1, int(user_ids[owner[i]]), GAME_TYPES[game_type[i]], int(score[i]),
+                DIFFICULTY_LEVELS[difficulty[i]], int(time_taken[i]), float(accuracy[i]),
+                int(streak[i]), int(hints[i]),
+                (completed - timedelta(seconds=int(time_taken[i]))).strftime('%Y-%m-%d %H:%M:%S'),
+                completed.strftime('%Y-%m-%d %H:%M:%S')
+            ))
+        db.executemany(
+            "INSERT INTO game_sessions (session_id, user_id, game_type, score, difficulty_level, "
+            "time_taken, accuracy, streak_count, hints_used, started_at, completed_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows
+        )
+
+    # student_progress mirrors update_student_progress(): literacy/math are the
+    # mean accuracy of the respective game types
+    is_literacy = np.isin(game_type, LITERACY_GAMES)
+    games_played = np.bincount(owner, minlength=n_students)
+    total_score = np.bincount(owner, weights=score, minlength=n_students)
+    literacy_n = np.bincount(owner, weights=is_literacy, minlength=n_students)
+    literacy_sum = np.bincount(owner, weights=accuracy * is_literacy, minlength=n_students)
+    math_n = games_played - literacy_n
+    math_sum = np.bincount(owner, weights=accuracy * ~is_literacy, minlength=n_students)
+    literacy = np.divide(literacy_sum, literacy_n, out=np.zeros(n_students), where=literacy_n > 0).round(2)
+    math = np.divide(math_sum, math_n, out=np.zeros(n_students), where=math_n > 0).round(2)
+
+    # Same thresholds as update_student_progress()
+    overall = (literacy + math) / 2
+    level = np.where(overall >= 80, 'high', np.where(overall >= 50, 'medium', 'low'))
+
+    updated = _now()
+    db.executemany(
+        "INSERT INTO student_progress (user_id, total_score, games_played, literacy_progress, "
+        "math_progress, performance_level, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        ((int(user_ids[i]), int(total_score[i]), int(games_played[i]), float(literacy[i]),
+          float(math[i]), str(level[i]), updated) for i in range(n_students))
+    )
+
+    db.commit()
+    db.close()
+
+    summary = {
+        'students': n_students,
+        'sessions': n_sessions,
+        'max_sessions_per_student': int(counts.max()),
+        'generate_seconds': round(time.perf_counter() - started, 3)
+    }
+    print(f"[OK] Generated {n_students} students / {n_sessions} sessions in "
+          f"{summary['generate_seconds']:.1f}s ({path})")
+    return summary
+
+def open_cohort(path):
+    """Open a generated cohort as a mysql.connector-style connection"""
+    return SQLiteConnection(path)
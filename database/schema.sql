@@ -4,6 +4,9 @@
 -- ============================================
 
 -- Drop existing tables if they exist
+DROP TABLE IF EXISTS clustering_results_summary;
+DROP TABLE IF EXISTS feature_store_state;
+DROP TABLE IF EXISTS student_feature_aggregates;
 DROP TABLE IF EXISTS clustering_results;
 DROP TABLE IF EXISTS achievements;
 DROP TABLE IF EXISTS game_sessions;
@@ -122,8 +125,11 @@ CREATE TABLE clustering_results (
     features JSON, -- Store feature vector used for clustering
     analysis_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     is_current BOOLEAN DEFAULT TRUE, -- Mark the most recent clustering
+    segment VARCHAR(64) DEFAULT NULL, -- Segment of a segmented run, NULL for global runs; added to
+                                      -- existing databases by result_writer.ensure_results_schema()
     FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE,
     INDEX idx_user_cluster (user_id, is_current),
+    INDEX idx_segment (segment, is_current),
     INDEX idx_cluster_number (cluster_number),
     INDEX idx_analysis_date (analysis_date)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
@@ -148,6 +154,55 @@ CREATE TABLE game_statistics (
     INDEX idx_game_stats (game_type, best_score)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
+-- ============================================
+-- 8. STUDENT_FEATURE_AGGREGATES TABLE
+-- Running per-student session aggregates used by the clustering
+-- feature store (maintained by clustering/feature_store.py)
+-- ============================================
+CREATE TABLE student_feature_aggregates (
+    user_id INT PRIMARY KEY,
+    session_count INT NOT NULL DEFAULT 0,
+    accuracy_count INT NOT NULL DEFAULT 0,
+    accuracy_sum DECIMAL(16,2) NOT NULL DEFAULT 0.00,
+    accuracy_sumsq DECIMAL(20,4) NOT NULL DEFAULT 0.0000,
+    time_count INT NOT NULL DEFAULT 0,
+    time_sum BIGINT NOT NULL DEFAULT 0,
+    time_sumsq BIGINT NOT NULL DEFAULT 0,
+    hints_sum BIGINT NOT NULL DEFAULT 0,
+    last_session_id INT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- ============================================
+-- 9. FEATURE_STORE_STATE TABLE
+-- High-water mark of the last game session folded into the feature store
+-- ============================================
+CREATE TABLE feature_store_state (
+    store_name VARCHAR(50) PRIMARY KEY,
+    last_completed_at TIMESTAMP NULL,
+    last_session_id INT NOT NULL DEFAULT 0,
+    rebuilt_at TIMESTAMP NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- ============================================
+-- 10. CLUSTERING_RESULTS_SUMMARY TABLE
+-- Per-run cluster totals of compacted clustering_results history
+-- (maintained by clustering/result_writer.py)
+-- ============================================
+CREATE TABLE clustering_results_summary (
+    analysis_date TIMESTAMP NOT NULL,
+    segment VARCHAR(64) NOT NULL DEFAULT '', -- '' for global runs
+    cluster_number INT NOT NULL,
+    cluster_label VARCHAR(100),
+    students INT NOT NULL,
+    literacy_sum DOUBLE NOT NULL,
+    math_sum DOUBLE NOT NULL,
+    performance_sum DOUBLE NOT NULL,
+    PRIMARY KEY (analysis_date, segment, cluster_number)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
 -- ============================================
 -- INSERT DEFAULT ADMIN ACCOUNT
 -- Username: admin, Password: admin123